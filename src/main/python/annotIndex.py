@@ -0,0 +1,195 @@
+# ---------------------------------------------------------------
+# -- UNote Annot Index File --
+#
+# Spatial index of the annotations of a page
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import numpy as np
+
+import fitz
+
+from filters import pathDistances, densifyLine, transformPoints
+
+
+class AnnotIndex():
+    '''
+    Maps the xref of every annotation of a page to its rect and type, and sorts the annotations into a uniform grid.
+    Queries only look at the annotations of the cells they touch instead of walking page.annots(), which creates an annot object per annotation.
+    Ink and line annotations keep their vertices, so hits can be tested against the strokes instead of the bounding rect
+    '''
+    CELLSIZE = 48   # pdf points
+
+    POLYLINETYPES = (fitz.PDF_ANNOT_INK, fitz.PDF_ANNOT_LINE)
+
+    def __init__(self):
+        super().__init__()
+
+        self.entries = dict()   # xref: (order, (x0, y0, x1, y1), type, width, [(xPoints, yPoints)])
+        self.cells = dict()     # (cx, cy): set of xrefs
+        self.nextOrder = 0
+
+    @staticmethod
+    def fromPage(page, matrix=None):
+        index = AnnotIndex()
+
+        for annot in page.annots():
+            index.add(annot, matrix)
+
+        return index
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, xref):
+        return xref in self.entries
+
+    def cellRange(self, x0, y0, x1, y1):
+        for cx in range(int(x0 // self.CELLSIZE), int(x1 // self.CELLSIZE) + 1):
+            for cy in range(int(y0 // self.CELLSIZE), int(y1 // self.CELLSIZE) + 1):
+                yield (cx, cy)
+
+    def add(self, annot, matrix=None, order=None):
+        '''
+        Indexes the annotation in its current state. matrix maps its vertices to the coordinates the queries use
+        '''
+        annotType = annot.type[0]
+        polylines = []
+        width = 0
+
+        if annotType in self.POLYLINETYPES:
+            vertices = annot.vertices or []
+
+            # Ink annotations have a list of strokes, lines a single list of points
+            if vertices and not isinstance(vertices[0][0], (list, tuple)):
+                vertices = [vertices]
+
+            for stroke in vertices:
+                if not stroke:
+                    continue
+
+                xPoints, yPoints = np.array(stroke, dtype=np.float64).reshape(-1, 2).T
+
+                if matrix is not None:
+                    xPoints, yPoints = transformPoints(xPoints, yPoints, matrix)
+
+                polylines.append((xPoints, yPoints))
+
+            width = max(annot.border.get("width", 0) or 0, 0)
+
+        if polylines:
+            margin = width / 2
+            rect = (min(xPoints.min() for xPoints, _ in polylines) - margin, min(yPoints.min() for _, yPoints in polylines) - margin,
+                    max(xPoints.max() for xPoints, _ in polylines) + margin, max(yPoints.max() for _, yPoints in polylines) + margin)
+        else:
+            rect = tuple(annot.rect)
+
+        if order is None:
+            order = self.nextOrder
+            self.nextOrder += 1
+
+        self.entries[annot.xref] = (order, rect, annotType, width, polylines)
+
+        for cell in self.cellRange(*rect):
+            self.cells.setdefault(cell, set()).add(annot.xref)
+
+    def remove(self, xref):
+        entry = self.entries.pop(xref, None)
+
+        if entry is None:
+            return
+
+        for cell in self.cellRange(*entry[1]):
+            xrefs = self.cells.get(cell)
+
+            if xrefs is not None:
+                xrefs.discard(xref)
+
+                if not xrefs:
+                    del self.cells[cell]
+
+    def update(self, annot, matrix=None):
+        '''
+        Re-indexes a moved or changed annotation. It keeps its position in the order of the page
+        '''
+        entry = self.entries.get(annot.xref)
+
+        self.remove(annot.xref)
+        self.add(annot, matrix, entry[0] if entry else None)
+
+    def rect(self, xref):
+        return self.entries[xref][1]
+
+    def type(self, xref):
+        return self.entries[xref][2]
+
+    def width(self, xref):
+        return self.entries[xref][3]
+
+    def polylines(self, xref):
+        '''
+        Strokes of ink and line annotations in query coordinates as (xPoints, yPoints)
+        '''
+        return self.entries[xref][4]
+
+    def sorted(self, xrefs):
+        '''
+        Returns the xrefs in the order of the page
+        '''
+        return sorted(xrefs, key=lambda xref: self.entries[xref][0])
+
+    def candidates(self, x0, y0, x1, y1):
+        xrefs = set()
+
+        for cell in self.cellRange(x0, y0, x1, y1):
+            xrefs.update(self.cells.get(cell, ()))
+
+        return xrefs
+
+    def query(self, x0, y0, x1, y1):
+        '''
+        Annotations whose rect intersects the provided one
+        '''
+        hits = []
+
+        for xref in self.candidates(x0, y0, x1, y1):
+            rx0, ry0, rx1, ry1 = self.entries[xref][1]
+
+            if rx0 <= x1 and x0 <= rx1 and ry0 <= y1 and y0 <= ry1:
+                hits.append(xref)
+
+        return self.sorted(hits)
+
+    def atPoint(self, x, y, types=None):
+        '''
+        Annotations whose rect contains the point, optionally only the provided types
+        '''
+        return [xref for xref in self.query(x, y, x, y) if types is None or self.entries[xref][2] in types]
+
+    def hitBy(self, xPoints, yPoints, radius):
+        '''
+        Annotations touched by a path of the provided radius, e.g. the eraser.
+        Strokes of ink and line annotations have to be touched, for all others their rect is enough
+        '''
+        # A fast eraser stroke can't skip over thin strokes that way
+        xPoints, yPoints = densifyLine(xPoints, yPoints, radius)
+
+        if len(xPoints) == 0:
+            return []
+
+        hits = []
+
+        for xref in self.candidates(xPoints.min() - radius, yPoints.min() - radius, xPoints.max() + radius, yPoints.max() + radius):
+            _, (x0, y0, x1, y1), _, width, polylines = self.entries[xref]
+
+            # Points of the path close to the annotation
+            near = (xPoints >= x0 - radius) & (xPoints <= x1 + radius) & (yPoints >= y0 - radius) & (yPoints <= y1 + radius)
+
+            if not near.any():
+                continue
+
+            if not polylines or any(pathDistances(xPoints[near], yPoints[near], xStroke, yStroke, radius + width / 2).min() <= radius + width / 2 for xStroke, yStroke in polylines):
+                hits.append(xref)
+
+        return self.sorted(hits)
+
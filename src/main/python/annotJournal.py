@@ -0,0 +1,419 @@
+# ---------------------------------------------------------------
+# -- UNote Annot Journal File --
+#
+# Write ahead journal of the annotation changes since the last save
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import fitz
+
+from PySide2.QtCore import QTimer
+
+from style.styledef import norm_rgb, pdf_annots
+
+
+class AnnotJournal():
+    '''
+    Appends a compact binary record for every annotation which is added to or deleted from the document to <document>.journal.
+    Pages which are inserted, deleted or resized are recorded as well, as the records refer to pages by their number.
+    Records are collected for FLUSHDELAY and written and synced in a background thread, so the pen input never waits for the disk.
+    The journal is cleared once the document is saved. A journal left from a crash is replayed when the document is opened again,
+    provided the document is unchanged since the journal was started
+
+    File: header (magic, size and mtime of the document) followed by records (op, page, payload length, crc32 of the payload, payload)
+    '''
+    MAGIC = b'UNJ1'
+    HEADER = struct.Struct('<4sQQ')
+    RECORD = struct.Struct('<BIII')
+
+    INK = 1
+    HIGHLIGHT = 2
+    LINE = 3
+    TEXT = 4
+    DELETE = 5
+    INSERTPAGE = 6
+    DELETEPAGE = 7
+    RESIZEPAGE = 8
+    QUADHIGHLIGHT = 9   # replaces HIGHLIGHT, which is only replayed from older journals
+
+    FLUSHDELAY = 250            # ms
+    FLUSHSIZE = 64 * 1024       # bytes
+
+    def __init__(self):
+        super().__init__()
+
+        self.path = None
+        self.header = None      # written before the first record
+        self.started = False    # the file has a header
+        self.size = 0           # bytes of records, see mark
+        self.buffer = bytearray()
+
+        self.flushTimer = QTimer()
+        self.flushTimer.setSingleShot(True)
+        self.flushTimer.timeout.connect(self.flush)
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    @staticmethod
+    def journalPath(filename):
+        return filename + '.journal'
+
+    @staticmethod
+    def documentHeader(filename):
+        stat = os.stat(filename)
+
+        return AnnotJournal.HEADER.pack(AnnotJournal.MAGIC, stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def pending(filename):
+        '''
+        True if records of this version of the document are left from a previous session, see open
+        '''
+        try:
+            with open(AnnotJournal.journalPath(filename), 'rb') as f:
+                data = f.read(AnnotJournal.HEADER.size + AnnotJournal.RECORD.size)
+
+            return len(data) > AnnotJournal.HEADER.size and data.startswith(AnnotJournal.documentHeader(filename))
+        except OSError:
+            return False
+
+    def open(self, filename, doc):
+        '''
+        Starts the journal of the document. Returns the number of records replayed from a previous session
+        '''
+        self.flushTimer.stop()
+        self.buffer = bytearray()
+        self.size = 0
+
+        self.path = self.journalPath(filename)
+
+        try:
+            self.header = self.documentHeader(filename)
+        except OSError as identifier:
+            print(str(identifier))
+            self.path = None
+            return 0
+
+        replayed = 0
+
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = None
+        except OSError as identifier:
+            print(str(identifier))
+            data = None
+
+        # The journal belongs to this version of the document only
+        if data and data.startswith(self.header):
+            replayed = self.replay(doc, data)
+            self.started = True
+            self.size = len(data) - self.HEADER.size
+        else:
+            self.started = False
+            self.executor.submit(self.remove, self.path)
+
+        if replayed:
+            print('Replayed ' + str(replayed) + ' journal records of ' + filename)
+
+        return replayed
+
+    def mark(self):
+        '''
+        Position of the next record, e.g. when a snapshot of the document is taken
+        '''
+        return self.size + len(self.buffer)
+
+    def reset(self, filename, since=None):
+        '''
+        The document was saved, so it contains everything recorded so far,
+        or everything recorded before the mark since, if the saved document is a snapshot
+        '''
+        keep = since is not None and self.path == self.journalPath(filename) and since < self.mark()
+
+        if keep:
+            self.flush()
+        else:
+            self.flushTimer.stop()
+            self.buffer = bytearray()
+
+        self.path = self.journalPath(filename)
+
+        try:
+            self.header = self.documentHeader(filename)
+        except OSError as identifier:
+            print(str(identifier))
+            self.path = None
+            keep = False
+
+        if keep:
+            self.executor.submit(self.rebase, self.path, self.header, self.HEADER.size + since)
+            self.size -= since
+        else:
+            self.executor.submit(self.remove, self.journalPath(filename))
+            self.started = False
+            self.size = 0
+
+    def discard(self):
+        '''
+        The user chose not to save the changes
+        '''
+        if self.path:
+            self.reset(self.path[:-len('.journal')])
+
+    def terminate(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+
+    #-----------------------------------------------------------------------
+    # Recording
+    #-----------------------------------------------------------------------
+
+    def append(self, op, pageNumber, payload):
+        if not self.path:
+            return
+
+        self.buffer += self.RECORD.pack(op, pageNumber, len(payload), zlib.crc32(payload)) + payload
+
+        if len(self.buffer) >= self.FLUSHSIZE:
+            self.flush()
+        elif not self.flushTimer.isActive():
+            self.flushTimer.start(self.FLUSHDELAY)
+
+    def flush(self):
+        self.flushTimer.stop()
+
+        if not self.buffer or not self.path:
+            return
+
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
+        self.size += len(data)
+
+        if not self.started:
+            data = self.header + data
+            self.started = True
+            self.executor.submit(self.write, self.path, data, 'wb')
+        else:
+            self.executor.submit(self.write, self.path, data, 'ab')
+
+    @staticmethod
+    def write(path, data, mode):
+        '''
+        Runs in the background thread
+        '''
+        try:
+            with open(path, mode) as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as identifier:
+            print(str(identifier))
+
+    @staticmethod
+    def rebase(path, header, offset):
+        '''
+        Runs in the background thread. Drops the records before offset, the rest belongs to the document with the new header
+        '''
+        tempPath = path + '.tmp'
+
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+
+            AnnotJournal.write(tempPath, header + data, 'wb')
+            os.replace(tempPath, path)
+        except OSError as identifier:
+            print(str(identifier))
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as identifier:
+            print(str(identifier))
+
+    @staticmethod
+    def packColor(color):
+        try:
+            return struct.pack('<3f', *color[:3])
+        except (TypeError, struct.error):
+            return struct.pack('<3f', 0, 0, 0)
+
+    def recordInk(self, pageNumber, xref, strokes, width, color):
+        payload = [struct.pack('<If', xref, width), self.packColor(color), struct.pack('<I', len(strokes))]
+
+        for stroke in strokes:
+            points = np.asarray(stroke, dtype='<f4').reshape(-1, 2)
+
+            payload.append(struct.pack('<I', len(points)))
+            payload.append(points.tobytes())
+
+        self.append(self.INK, pageNumber, b''.join(payload))
+
+    def recordHighlight(self, pageNumber, xref, vertices, color):
+        '''
+        vertices are the corners of the quads, four per highlighted line, see fitz.Annot.vertices
+        '''
+        points = np.asarray(vertices, dtype='<f4').reshape(-1, 2)
+
+        self.append(self.QUADHIGHLIGHT, pageNumber, struct.pack('<I', xref) + self.packColor(color) + struct.pack('<I', len(points)) + points.tobytes())
+
+    def recordLine(self, pageNumber, xref, start, end, width, color, arrow=False):
+        self.append(self.LINE, pageNumber, struct.pack('<I5f', xref, start.x, start.y, end.x, end.y, width) + self.packColor(color) + struct.pack('<?', arrow))
+
+    def recordText(self, pageNumber, xref, rect, fontsize, linkedXref, content):
+        self.append(self.TEXT, pageNumber, struct.pack('<I5fI', xref, *rect, fontsize, linkedXref or 0) + content.encode('utf-8'))
+
+    def recordDelete(self, pageNumber, xref):
+        self.append(self.DELETE, pageNumber, struct.pack('<I', xref))
+
+    def recordInsertPage(self, pageNumber, width, height):
+        self.append(self.INSERTPAGE, pageNumber, struct.pack('<2f', width or 0, height or 0))
+
+    def recordDeletePage(self, pageNumber):
+        self.append(self.DELETEPAGE, pageNumber, b'')
+
+    def recordResizePage(self, pageNumber, mediaBox):
+        self.append(self.RESIZEPAGE, pageNumber, struct.pack('<4f', *mediaBox))
+
+    #-----------------------------------------------------------------------
+    # Replay
+    #-----------------------------------------------------------------------
+
+    def records(self, data):
+        '''
+        Yields (op, page, payload) until the end or the first incomplete or damaged record
+        '''
+        offset = self.HEADER.size
+
+        while offset + self.RECORD.size <= len(data):
+            op, pageNumber, length, crc = self.RECORD.unpack_from(data, offset)
+            offset += self.RECORD.size
+
+            payload = data[offset:offset + length]
+            offset += length
+
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                print('Journal damaged after ' + str(offset) + ' bytes')
+                return
+
+            yield op, pageNumber, payload
+
+    def replay(self, doc, data):
+        # Recreated annotations get new xrefs
+        xrefs = dict()
+        count = 0
+
+        for op, pageNumber, payload in self.records(data):
+            try:
+                if op == self.INSERTPAGE:
+                    width, height = struct.unpack('<2f', payload)
+
+                    if width and height:
+                        doc.newPage(pageNumber, width=width, height=height)
+                    else:
+                        doc.newPage(pageNumber)
+
+                elif op == self.DELETEPAGE:
+                    doc.deletePage(pageNumber)
+
+                elif op == self.RESIZEPAGE:
+                    doc[pageNumber].setMediaBox(fitz.Rect(struct.unpack('<4f', payload)))
+
+                elif op == self.DELETE:
+                    page = doc[pageNumber]
+                    xref, = struct.unpack('<I', payload)
+                    annot = page.loadAnnot(xrefs.pop(xref, xref))
+
+                    if annot:
+                        page.deleteAnnot(annot)
+                else:
+                    page = doc[pageNumber]
+                    xref, annot = self.replayAdd(page, op, payload, xrefs)
+
+                    if annot:
+                        xrefs[xref] = annot.xref
+            except (RuntimeError, ValueError, IndexError, struct.error) as identifier:
+                print('Unable to replay journal record: ' + str(identifier))
+                continue
+
+            count += 1
+
+        return count
+
+    def replayAdd(self, page, op, payload, xrefs):
+        '''
+        Creates the annotation of the record the same way QPdfView does
+        '''
+        if op == self.INK:
+            xref, width, r, g, b, count = struct.unpack_from('<If3fI', payload)
+            offset = struct.calcsize('<If3fI')
+
+            strokes = []
+            for _ in range(count):
+                length, = struct.unpack_from('<I', payload, offset)
+                offset += 4
+
+                strokes.append(np.frombuffer(payload, dtype='<f4', count=length * 2, offset=offset).reshape(-1, 2).tolist())
+                offset += length * 8
+
+            annot = page.addInkAnnot(strokes)
+            annot.setBorder({"width": width})
+            annot.setColors({"stroke": (r, g, b)})
+
+        elif op == self.HIGHLIGHT:
+            xref, x0, y0, x1, y1, r, g, b = struct.unpack('<I4f3f', payload)
+
+            annot = page.addHighlightAnnot(fitz.Rect(x0, y0, x1, y1))
+            annot.setColors({"stroke": (r, g, b)})
+
+        elif op == self.QUADHIGHLIGHT:
+            xref, r, g, b, count = struct.unpack_from('<I3fI', payload)
+            points = np.frombuffer(payload, dtype='<f4', count=count * 2, offset=struct.calcsize('<I3fI')).reshape(-1, 2).tolist()
+
+            annot = page.addHighlightAnnot([fitz.Quad(points[i:i + 4]) for i in range(0, len(points), 4)])
+            annot.setColors({"stroke": (r, g, b)})
+
+        elif op == self.LINE:
+            xref, x0, y0, x1, y1, width, r, g, b, arrow = struct.unpack('<I5f3f?', payload)
+
+            annot = page.addLineAnnot(fitz.Point(x0, y0), fitz.Point(x1, y1))
+            annot.setBorder({"width": width})
+
+            if arrow:
+                annot.setLineEnds(fitz.PDF_ANNOT_LE_CIRCLE, fitz.PDF_ANNOT_LE_CIRCLE)
+                annot.update(border_color=(r, g, b), fill_color=(r, g, b))
+            else:
+                annot.setColors({"stroke": (r, g, b)})
+
+        elif op == self.TEXT:
+            xref, x0, y0, x1, y1, fontsize, linkedXref = struct.unpack_from('<I5fI', payload)
+            content = payload[struct.calcsize('<I5fI'):].decode('utf-8')
+
+            annot = page.addFreetextAnnot(fitz.Rect(x0, y0, x1, y1), content)
+            annot.setBorder({"width": pdf_annots.lineWidth, "dashes": [pdf_annots.dashLevel]})
+            annot.update(fontsize=fontsize, border_color=norm_rgb.main, fill_color=norm_rgb.white, text_color=norm_rgb.black)
+
+            if linkedXref:
+                info = annot.info
+                info["subject"] = str(xrefs.get(linkedXref, linkedXref))
+                annot.setInfo(info)
+
+        else:
+            return None, None
+
+        annot.update()
+
+        return xref, annot
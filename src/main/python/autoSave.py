@@ -0,0 +1,182 @@
+# ---------------------------------------------------------------
+# -- UNote Auto Save File --
+#
+# Periodically saves a copy of the document with unsaved changes
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import os
+import time
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide2.QtCore import QObject, QTimer, Slot
+
+from preferences import Preferences
+
+
+class AutoSaver(QObject):
+    '''
+    Saves the document to <home>/UNote/autosave/ in the interval selected by comboBoxAutosaveMode, as long as there are unsaved changes.
+    The document is serialized on the gui thread, which is cheap as nothing is compressed or cleaned up, and written to the disk in a background thread.
+    The autosave is removed once the document is saved or UNote is closed, a newer autosave found on opening the document is left from a crash
+    '''
+    AUTOSAVEDIR = Path.home() / "UNote" / "autosave"
+    INTERVALS = (0, 5, 10, 15, 20)  # minutes, by comboBoxAutosaveMode
+    RETRYDELAY = 5000               # ms, while the user is drawing
+    MAXREPORTED = 20
+
+    def __init__(self, graphicsView, autosaveDir=AUTOSAVEDIR):
+        super().__init__()
+
+        self.graphicsView = graphicsView
+        self.autosaveDir = Path(autosaveDir)
+
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.autoSave)
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pendingWrite = None
+
+        # (filename, bytes, snapshot seconds, write seconds)
+        self.durations = list()
+
+        self.graphicsView.documentSaved.connect(self.discard)
+
+    def terminate(self):
+        '''
+        UNote is closed properly, so the autosave of the document isn't a crash leftover, see staleAutosave.
+        It's kept if the changes couldn't be saved on exit, see GraphicsViewHandler.terminate
+        '''
+        self.timer.stop()
+
+        filename = self.graphicsView.rendererWorker.pdf.filename
+        if filename and not self.graphicsView.keepRecovery:
+            # Queued after a running write
+            self.executor.submit(self.remove, self.autosavePath(filename, self.autosaveDir))
+
+        self.executor.shutdown(wait=True)
+
+    @staticmethod
+    def autosavePath(filename, autosaveDir=AUTOSAVEDIR):
+        '''
+        One autosave per document path
+        '''
+        pathHash = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()[:12]
+
+        return Path(autosaveDir) / (Path(filename).stem + '_' + pathHash + '.pdf')
+
+    @staticmethod
+    def staleAutosave(filename, autosaveDir=AUTOSAVEDIR):
+        '''
+        Returns the autosave of the document if it's newer than the document itself
+        '''
+        path = AutoSaver.autosavePath(filename, autosaveDir)
+
+        try:
+            if path.stat().st_mtime > os.path.getmtime(filename):
+                return path
+        except OSError:
+            pass
+
+        return None
+
+    def interval(self):
+        try:
+            return self.INTERVALS[int(Preferences.data['comboBoxAutosaveMode'])]
+        except (ValueError, IndexError, KeyError):
+            return 0
+
+    @Slot()
+    def start(self):
+        '''
+        (Re)starts the timer with the interval of the preferences
+        '''
+        self.timer.stop()
+
+        if self.interval() > 0:
+            self.timer.start(self.interval() * 60 * 1000)
+
+    @Slot()
+    def autoSave(self):
+        pdf = self.graphicsView.rendererWorker.pdf
+
+        if not pdf.doc or not pdf.filename or pdf.history.recentChanges == 0:
+            self.start()
+            return
+
+        # Neither interrupt a stroke nor queue up writes on slow disks
+        if self.graphicsView.isEditing() or (self.pendingWrite and not self.pendingWrite.done()):
+            self.timer.start(self.RETRYDELAY)
+            return
+
+        self.graphicsView.commitPendingInk()
+
+        snapshotStart = time.perf_counter()
+        data = pdf.snapshot()
+        snapshotTime = time.perf_counter() - snapshotStart
+
+        if data:
+            self.pendingWrite = self.executor.submit(self.write, pdf.filename, data, snapshotTime)
+
+        self.start()
+
+    def write(self, filename, data, snapshotTime):
+        '''
+        Runs in the background thread. The previous autosave is replaced only once the new one is complete
+        '''
+        path = self.autosavePath(filename, self.autosaveDir)
+        tempPath = path.with_suffix('.tmp')
+
+        writeStart = time.perf_counter()
+
+        try:
+            self.autosaveDir.mkdir(parents=True, exist_ok=True)
+
+            with open(tempPath, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(tempPath, path)
+        except OSError as identifier:
+            print(str(identifier))
+            return
+
+        self.durations.append((filename, len(data), snapshotTime, time.perf_counter() - writeStart))
+        del self.durations[:-self.MAXREPORTED]
+
+        print('Autosaved ' + filename + ' to ' + str(path))
+
+    @Slot(str)
+    def discard(self, filename):
+        '''
+        The document was saved, so its autosave is outdated
+        '''
+        self.executor.submit(self.remove, self.autosavePath(filename, self.autosaveDir))
+
+        self.start()
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as identifier:
+            print(str(identifier))
+
+    def report(self):
+        if not self.durations:
+            return 'Autosave: nothing saved'
+
+        sizes = [size for _, size, _, _ in self.durations]
+        snapshotTimes = [snapshotTime for _, _, snapshotTime, _ in self.durations]
+        writeTimes = [writeTime for _, _, _, writeTime in self.durations]
+
+        return 'Autosave: %d saves of %.1f MB avg, snapshot %.0f ms avg / %.0f ms max, write %.0f ms avg / %.0f ms max' % (
+            len(self.durations), sum(sizes) / len(sizes) / 1e6,
+            sum(snapshotTimes) / len(snapshotTimes) * 1000, max(snapshotTimes) * 1000,
+            sum(writeTimes) / len(writeTimes) * 1000, max(writeTimes) * 1000)
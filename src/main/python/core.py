@@ -6,6 +6,7 @@
 # Author: Melvin Strobl
 # ---------------------------------------------------------------
 import os
+import re
 import sys
 import time
 from queue import Queue
@@ -13,23 +14,37 @@ from queue import Queue
 from indexed import IndexedOrderedDict
 from enum import Enum
 
-from PySide2.QtWidgets import QGraphicsView, QGraphicsScene, QApplication, QGraphicsPixmapItem, QGraphicsLineItem, QGraphicsEllipseItem, QScroller, QScrollerProperties
+from PySide2.QtWidgets import QGraphicsView, QGraphicsScene, QApplication, QGraphicsItem, QGraphicsPixmapItem, QGraphicsLineItem, QGraphicsEllipseItem, QScroller, QScrollerProperties
 from PySide2.QtCore import Qt, QRectF, QEvent, QThread, Signal, Slot, QObject, QPoint, QPointF, QTimer, QByteArray, QBuffer, QIODevice
-from PySide2.QtGui import QPixmap, QBrush, QColor, QImage, QPainter, QGuiApplication, QPen
+from PySide2.QtGui import QPixmap, QBrush, QColor, QImage, QPainter, QGuiApplication, QPen, QPainterPath
 # from PySide2.QtWebEngineWidgets import QWebEngineView
 
 import fitz
+import numpy as np
 
 from preferences import Preferences
 
 from pdfEngine import pdfEngine
+from renderPool import RenderPool
+from tileCache import TileCache
+from pageCache import PageCache
+from diskCache import DiskCache
+from pageLayout import PageLayout
+from documentLoader import DocumentLoader
+from documentSaver import DocumentSaver
+from savePlanner import SavePlanner
+from renderScheduler import RenderScheduler
+from liveStroke import LiveStroke
+from pendingInk import PendingStroke
+from annotIndex import AnnotIndex
+from strokeBuffer import StrokeBuffer
+from inputTrace import InputTrace, InputEvent
 from imageHelper import imageHelper
 from markdownHelper import markdownHelper
 
 from util import toBool
 from editHelper import editModes
-from filters import smoothLine, estimateLine, normalize
-from historyHandler import History
+from filters import MotionPredictor, smoothLine, smoothValues, estimateLine, normalize, transformPoints, widthSegments, simplifyLine, splitLine
 
 # sys.path.append('./style')
 from style.styledef import rgb, norm_rgb, pdf_annots
@@ -52,11 +67,16 @@ class EventHelper(QObject):
     requestTextInput = Signal(int, int, int, str)
     addIndicatorPoint = Signal(int, int)
     deleteLastIndicatorPoint = Signal()
+    # pageNumber
+    inkPending = Signal(int)
 
     settingsChanged = Signal()
 
 PRESSUREMULTIPLIER = 1.6
 DEFAULTPRESSURE = 0.8
+SIMPLIFYTOLERANCE = 0.5   # screen pixels a simplified stroke may deviate
+ERASERRADIUS = 3          # pdf points around the eraser path which are erased
+PENPREDICTION = 0         # ms the live stroke is extrapolated ahead of the pen, 0 disables it
 
 class QPdfView(QGraphicsPixmapItem):
 
@@ -68,7 +88,7 @@ class QPdfView(QGraphicsPixmapItem):
         self.eh = EventHelper()
 
         self.drawPoints = Queue()
-        self.tempPoints = Queue()
+        self.tempPoints = StrokeBuffer()
 
         self.startPos = 0
         self.endPos = 0
@@ -79,11 +99,42 @@ class QPdfView(QGraphicsPixmapItem):
         self.drawIndicators = []
 
         self.lastZoomFactor = -1
+        self.requestedZoomFactor = -1
 
         self.isDraft = False
 
+        # Size of the page while only a placeholder image is loaded
+        self.placeholderSize = None
+
+        # Tiles on top of the page image at high zoom levels. (tx, ty): (QRectF, QImage)
+        self.tiles = dict()
+        self.tileBucket = None
+
         self.penDraw = False
-        self.avPressure = 1
+
+        # Stroke which is currently drawn in freehand mode
+        self.liveStroke = LiveStroke(self.tempPoints)
+        self.predictor = MotionPredictor()
+
+        # Finished strokes which are painted on top of the page until they are written to the pdf in a batch,
+        # and those which are written but not rendered yet
+        self.pendingInk = []
+        self.committedInk = []
+        # History revision of the latest commit, see renderingFinished
+        self.committedRevision = 0
+
+        # Built on the first lookup, see annotations
+        self.annotIndex = None
+
+        # Derotation and rotation matrix of the page, see pageMatrices
+        self.matrices = None
+
+        # Undo history of the document
+        self.history = None
+        self.journal = None
+
+        # Provides the exposed rect, so live strokes only repaint what changed
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
 
         # Trigger this before any paint events occur
         self.settingsChangedReceiver()
@@ -91,9 +142,15 @@ class QPdfView(QGraphicsPixmapItem):
 
     def paint(self, painter, option, widget):
         res = super().paint(painter, option, widget)
+
+        for rect, tileImg in self.tiles.values():
+            painter.drawImage(rect, tileImg)
+
+        for stroke in self.committedInk + self.pendingInk:
+            stroke.paint(painter, option.exposedRect)
         # TODO: Fix the colors when changing theme
 
-        if self.tempPoints.qsize() > 0:
+        if len(self.tempPoints) > 0:
             if editMode == editModes.freehand or editMode == editModes.none:
                 # if Preferences.data['comboBoxThemeSelect'] == 0 and toBool(Preferences.data['radioButtonAffectsPDF']) == True:
                 #     try:
@@ -106,66 +163,57 @@ class QPdfView(QGraphicsPixmapItem):
                 #     except ValueError as identifier:
                 #         color = rgb.black
 
-                try:
-
-                    penSize = self.avPressure / self.tempPoints.qsize() * PRESSUREMULTIPLIER * self.freeHandSize
-                except ValueError:
-                    penSize = pdf_annots.defaultPenSize
-                except ZeroDivisionError:
-                    penSize = pdf_annots.defaultPenSize
-
-                try:
-                    tempList = list(zip(*list(self.tempPoints.queue)))
-                except TypeError as e:
-                    print(e)
-
-                if toBool(Preferences.data['radioButtonSmoothLines']):
-                    segment = smoothLine(tempList[0])
-                else:
-                    segment = normalize(tempList[0])
-                # if self.smooth:
-                #     segment = smoothLine(list(self.tempPoints.queue))
-                # else:
-                #     segment = list(self.tempPoints.queue)
-                    
-                # self.addDrawPoint(segment[-1], tempList[1][-1])
-
-
-                
-
-                painter.setPen(QPen(QColor(*self.freeHandColor), penSize))
-                # painter.setRenderHint(QPainter.SmoothPixmapTransform)
-                painter.drawPolyline(segment)
+                painter.setPen(QPen(QColor(*self.freeHandColor)))
+                self.liveStroke.paint(painter, option.exposedRect)
 
             elif editMode == editModes.marker:
                 
                 painter.setPen(QPen(QColor(*self.markerColor), self.markerSize))
                 painter.setRenderHint(QPainter.SmoothPixmapTransform)
-                painter.drawPolyline(list(self.tempPoints.queue))
+                painter.drawPolyline(self.tempPoints.qPoints())
 
             elif editMode == editModes.forms:
 
                 painter.setPen(QPen(QColor(*self.formColor), self.formSize))
                 painter.setRenderHint(QPainter.SmoothPixmapTransform)
-                lst = list(self.tempPoints.queue)
-
-                fStart, fStop = estimateLine(self.qPointToFPoint(lst[0][0]),self.qPointToFPoint(lst[-1][0]))
+                fStart, fStop = estimateLine(self.qPointToFPoint(self.tempPoints.firstQPoint()),self.qPointToFPoint(self.tempPoints.lastQPoint()))
 
                 painter.drawLine(self.fPointToQPointF(fStart),self.fPointToQPointF(fStop))
 
         return res
 
-    def renderingFinished(self):
-        self.clearTempPoints()
+    def renderingFinished(self, revision):
+        # Renderings from the render pool can arrive while drawing
+        if not self.ongoingEdit:
+            self.clearTempPoints()
+
+        # The rendering contains the committed strokes if it was started after they were written
+        if revision >= self.committedRevision:
+            self.committedInk = []
 
     def addTempPoint(self, qpos, pressure=DEFAULTPRESSURE):
-        self.avPressure += pressure
+        self.tempPoints.appendQPoint(qpos, pressure)
 
-        self.tempPoints.put([qpos,pressure])
+    def addStrokePoint(self, qpos, pressure=DEFAULTPRESSURE, predict=False):
+        '''
+        Extends the live stroke and repaints only the area around its end.
+        With predict, the stroke is painted up to where the pen is expected to be, see MotionPredictor
+        '''
+        self.addTempPoint(qpos, pressure)
+
+        dirtyRect = self.liveStroke.update()
+
+        if predict and self.predictionTime > 0:
+            self.predictor.update(qpos.x(), qpos.y(), self.tempPoints.timestamps[-1])
+            prediction = self.predictor.predict(self.predictionTime)
+
+            dirtyRect = dirtyRect.united(self.liveStroke.setPrediction(QPointF(*prediction) if prediction else None))
+
+        self.update(dirtyRect)
 
     def clearTempPoints(self):
-        with self.tempPoints.mutex:
-            self.tempPoints.queue.clear()
+        self.tempPoints.clear()
+        self.liveStroke.clear()
 
     def settingsChangedReceiver(self):
         if Preferences.data['comboBoxThemeSelect'] == '0' and toBool(Preferences.data['radioButtonAffectsPDF']) == True:
@@ -187,6 +235,16 @@ class QPdfView(QGraphicsPixmapItem):
         except ZeroDivisionError:
             self.freeHandSize = pdf_annots.defaultPenSize
 
+        try:
+            self.simplifyTolerance = float(Preferences.data['simplifyTolerance'])
+        except (KeyError, ValueError):
+            self.simplifyTolerance = SIMPLIFYTOLERANCE
+
+        try:
+            self.predictionTime = float(Preferences.data['penPrediction']) / 1000
+        except (KeyError, ValueError):
+            self.predictionTime = PENPREDICTION / 1000
+
         #------------------------------------------
 
         if Preferences.data['comboBoxThemeSelect'] == 0 and toBool(Preferences.data['radioButtonAffectsPDF']) == True:
@@ -234,6 +292,10 @@ class QPdfView(QGraphicsPixmapItem):
     def updateQImage(self, qImg, newZoomFactor=1):
         self.qImg = qImg
 
+        if self.placeholderSize:
+            self.prepareGeometryChange()
+            self.placeholderSize = None
+
         pixImg = QPixmap()
 
         pixImg.convertFromImage(self.qImg)
@@ -245,6 +307,58 @@ class QPdfView(QGraphicsPixmapItem):
     def setAsDraft(self):
         self.isDraft = True
 
+    def setPlaceholderSize(self, width, height):
+        '''
+        Keeps the page geometry while only the placeholder image is loaded, so the page can still be found in the viewport
+        '''
+        self.prepareGeometryChange()
+        self.placeholderSize = (width, height)
+
+    def boundingRect(self):
+        if self.placeholderSize:
+            return QRectF(0, 0, *self.placeholderSize)
+
+        return super().boundingRect()
+
+    def shape(self):
+        if self.placeholderSize:
+            path = QPainterPath()
+            path.addRect(self.boundingRect())
+            return path
+
+        return super().shape()
+
+    def imageBytes(self):
+        '''
+        Memory held by the page image and its pixmap
+        '''
+        pixImg = self.pixmap()
+
+        return self.qImg.sizeInBytes() + pixImg.width() * pixImg.height() * pixImg.depth() // 8
+
+    def setTileBucket(self, bucket):
+        '''
+        Tiles of a different zoom bucket don't fit anymore, so they are dropped
+        '''
+        if bucket != self.tileBucket:
+            self.tiles = dict()
+            self.tileBucket = bucket
+
+    def addTile(self, tile, rect, qImg):
+        self.tiles[tile] = (rect, qImg)
+        self.update(rect)
+
+    def pruneTiles(self, visibleTiles):
+        for tile in [tile for tile in self.tiles if tile not in visibleTiles]:
+            del self.tiles[tile]
+
+    def clearTiles(self):
+        if self.tiles:
+            self.tiles = dict()
+            self.update()
+
+        self.tileBucket = None
+
     def setAsOrigin(self):
         self.xOrigin = self.x()
         self.yOrigin = self.y()
@@ -261,16 +375,37 @@ class QPdfView(QGraphicsPixmapItem):
     def getSize(self):
         return (self.wOrigin, self.hOrigin)
 
-    def setPage(self, page, pageNumber):
+    def setPage(self, page, pageNumber, history, journal=None):
         self.page = page
         # print(page.rotationMatrix)
         self.pageNumber = pageNumber
+        self.history = history
+        self.journal = journal
+
+        self.annotIndex = None
+        self.matrices = None
 
 
     # def reloadQImg(self, zoomFactor):
     #     mat = fitz.Matrix(zoomFactor, zoomFactor)
     #     self.pixImg.convertFromImage(self.qImg)
 
+    def pageMatrices(self):
+        '''
+        Derotation and rotation matrix of the page, the latter None for unrotated pages.
+        Each access to them goes through MuPDF, so they are read once per page, see setPage
+        '''
+        if self.matrices is None:
+            self.matrices = (self.page.derotationMatrix, self.page.rotationMatrix if self.page.rotation != 0 else None)
+
+        return self.matrices
+
+    def derotationMatrix(self):
+        '''
+        Maps item to pdf coordinates
+        '''
+        return self.pageMatrices()[0]
+
     def qPointToFPoint(self, qPoint):
         return fitz.Point(qPoint.x(), qPoint.y())
 
@@ -333,46 +468,67 @@ class QPdfView(QGraphicsPixmapItem):
 
             textRect = self.calculateTextRectPos(textRect)
 
-            cyan  = norm_rgb.main
-            black = norm_rgb.black
-            white = norm_rgb.white
-
-            borderText = {"width": pdf_annots.lineWidth, "dashes": [pdf_annots.dashLevel]}
-            colors = {"stroke": black, "fill": cyan}
-
             try:
                 textSize = pdf_annots.defaultTextSize * (int(Preferences.data['textSize'])/100)
             except ValueError:
                 textSize = pdf_annots.defaultTextSize
 
-            textAnnot = self.page.addFreetextAnnot(textRect, content)
-            textAnnot.setBorder(borderText)
-            textAnnot.update(fontsize = textSize, border_color=cyan, fill_color=white, text_color=black)
+            arrowPoints = None
 
             if self.startPos != self.endPos:
-                fStart, fEnd = self.recalculateLinePoints(textRect, self.startPos)
-
-                nAnnot = self.addArrow(fStart, fEnd, "")
-
-                textAnnotInfo = textAnnot.info
-                textAnnotInfo["subject"] = str(nAnnot.xref)
-                textAnnot.setInfo(textAnnotInfo)
+                arrowPoints = self.recalculateLinePoints(textRect, self.startPos)
 
                 self.eh.deleteLastIndicatorPoint.emit()
 
             self.eh.deleteLastIndicatorPoint.emit()
 
-            textAnnot.update()
+            textAnnot = self.addTextAnnot(textRect, content, textSize, arrowPoints)
+
+            self.history.addToHistory(self.pageNumber, QPdfView.deleteText, textAnnot, QPdfView.insertText, (qpos, content))
 
-            History.addToHistory(self.deleteText, textAnnot, self.insertText, (qpos, content))
+            return textAnnot
 
         else:
             # Only when there is a line
             if self.startPos != self.endPos:
                 self.eh.deleteLastIndicatorPoint.emit()
 
-    def deleteText(self, annot):
-        self.deleteAnnot(annot)
+    def addTextAnnot(self, textRect, content, textSize, arrowPoints=None):
+        '''
+        Adds a textBox annotation, connected by an arrow if the start and end point of the arrow are provided
+        '''
+        cyan  = norm_rgb.main
+        black = norm_rgb.black
+        white = norm_rgb.white
+
+        borderText = {"width": pdf_annots.lineWidth, "dashes": [pdf_annots.dashLevel]}
+
+        textAnnot = self.page.addFreetextAnnot(textRect, content)
+        textAnnot.setBorder(borderText)
+        textAnnot.update(fontsize = textSize, border_color=cyan, fill_color=white, text_color=black)
+
+        linkedXref = 0
+
+        if arrowPoints:
+            fStart, fEnd = arrowPoints
+
+            nAnnot = self.addArrow(fStart, fEnd, "")
+            linkedXref = nAnnot.xref
+
+            textAnnotInfo = textAnnot.info
+            textAnnotInfo["subject"] = str(nAnnot.xref)
+            textAnnot.setInfo(textAnnotInfo)
+
+        textAnnot.update()
+        self.indexAnnot(textAnnot)
+
+        if self.journal:
+            self.journal.recordText(self.pageNumber, textAnnot.xref, textAnnot.rect, textSize, linkedXref, content)
+
+        return textAnnot
+
+    def deleteText(self, xRef):
+        self.deleteAnnotWithXref(xRef)
 
 
     def addArrow(self, fStart, fEnd, subj):
@@ -389,16 +545,23 @@ class QPdfView(QGraphicsPixmapItem):
         lineAnnot.setLineEnds(fitz.PDF_ANNOT_LE_CIRCLE , fitz.PDF_ANNOT_LE_CIRCLE)
         lineAnnot.update(border_color=cyan, fill_color=cyan)
         lineAnnot.update()
+        self.indexAnnot(lineAnnot)
+
+        if self.journal:
+            self.journal.recordLine(self.pageNumber, lineAnnot.xref, fStart, fEnd, borderLine["width"], cyan, arrow=True)
 
         return lineAnnot
 
-    def addLine(self, fStart, fEnd, subj):
+    def addLine(self, fStart, fEnd, subj, width=None, color=None):
         # fStart, fEnd, subj = line
 
-        try:
-            borderLine = {"width": pdf_annots.lineWidth * (int(Preferences.data['formSize'])/100)}
-        except ValueError:
-            borderLine = {"width": pdf_annots.lineWidth}
+        if width is not None:
+            borderLine = {"width": width}
+        else:
+            try:
+                borderLine = {"width": pdf_annots.lineWidth * (int(Preferences.data['formSize'])/100)}
+            except ValueError:
+                borderLine = {"width": pdf_annots.lineWidth}
 
         lineAnnot = self.page.addLineAnnot(fStart, fEnd)
 
@@ -408,18 +571,25 @@ class QPdfView(QGraphicsPixmapItem):
 
         lineAnnot.setBorder(borderLine)
 
-        try:
-            lineColor = tuple(map(lambda x: float(x), Preferences.data['formColor']))
-        except ValueError as identifier:
-            lineColor = norm_rgb.main
+        if color is not None:
+            lineColor = color
+        else:
+            try:
+                lineColor = tuple(map(lambda x: float(x), Preferences.data['formColor']))
+            except ValueError as identifier:
+                lineColor = norm_rgb.main
 
         lineAnnot.setColors({"stroke":lineColor})
         lineAnnot.update()
+        self.indexAnnot(lineAnnot)
+
+        if self.journal:
+            self.journal.recordLine(self.pageNumber, lineAnnot.xref, fStart, fEnd, borderLine["width"], lineColor)
 
         return lineAnnot
 
-    def deleteLine(self, annot):
-        self.deleteAnnot(annot)
+    def deleteLine(self, xRef):
+        self.deleteAnnotWithXref(xRef)
 
     def recalculateLinePoints(self, textBoxRect, startPoint):
         '''
@@ -448,7 +618,7 @@ class QPdfView(QGraphicsPixmapItem):
         '''
         Searches for a textBox at the current position and updates its content with the provided one
         '''
-        for annot in self.page.annots(types=(fitz.PDF_ANNOT_FREE_TEXT, fitz.PDF_ANNOT_TEXT)):
+        for annot in self.getAnnotsAtPos(qpos, types=(fitz.PDF_ANNOT_FREE_TEXT, fitz.PDF_ANNOT_TEXT)):
             if self.pointInArea(qpos, annot.rect):
                 if content != "":
                     h, w = self.calculateTextRectBounds(content)
@@ -459,6 +629,7 @@ class QPdfView(QGraphicsPixmapItem):
                     info["content"] = content
                     annot.setInfo(info)
                     annot.update()
+                    self.indexAnnot(annot)
                 else:
                     self.deleteAnnot(annot)
 
@@ -531,6 +702,21 @@ class QPdfView(QGraphicsPixmapItem):
         except Exception as identifier:
             print("Unable to add annot")
 
+        # Rebuilt on the next lookup
+        self.annotIndex = None
+
+    def deleteAnnotWithXref(self, xRef):
+        '''
+        History entries keep the xref of their annotations only, which changes when an annotation is added again
+        '''
+        if self.history:
+            xRef = self.history.resolveXref(xRef)
+
+        annot = self.loadAnnot(xRef)
+
+        if annot:
+            self.deleteAnnot(annot)
+
     def deleteAnnot(self, annot):
         '''
         Deletes the desired annot and the corresponding line if one is found
@@ -538,15 +724,56 @@ class QPdfView(QGraphicsPixmapItem):
         # Check if there is a corresponding line annot
         corrAnnot = self.getCorrespondingAnnot(annot)
         if corrAnnot:
+            self.unindexAnnot(corrAnnot)
+            self.deleteJournaledAnnot(corrAnnot)
+
+        self.unindexAnnot(annot)
+        self.deleteJournaledAnnot(annot)
+
+    def deleteJournaledAnnot(self, annot):
+        xRef = annot.xref
+
+        try:
+            self.page.deleteAnnot(annot)
+        except ValueError as identifier:
+            print(str(identifier))
+            return
+
+        if self.journal:
+            self.journal.recordDelete(self.pageNumber, xRef)
+
+    def annotations(self):
+        '''
+        Spatial index of the annotations of the page. It's built on the first lookup and kept up to date by the methods which add, change or delete annots
+        '''
+        if self.annotIndex is None:
             try:
-                self.page.deleteAnnot(corrAnnot)
+                self.annotIndex = AnnotIndex.fromPage(self.page, self.annotMatrix())
             except ValueError as identifier:
                 print(str(identifier))
+                return AnnotIndex()
+
+        return self.annotIndex
+
+    def annotMatrix(self):
+        '''
+        Strokes are stored derotated, this maps their vertices back to the coordinates of the view
+        '''
+        return self.pageMatrices()[1]
+
+    def indexAnnot(self, annot):
+        if self.annotIndex is not None and annot:
+            self.annotIndex.update(annot, self.annotMatrix())
+
+    def unindexAnnot(self, annot):
+        if self.annotIndex is None:
+            return
 
         try:
-            self.page.deleteAnnot(annot)
+            self.annotIndex.remove(annot.xref)
+        # Parent orphaned
         except ValueError as identifier:
-            print(str(identifier))
+            self.annotIndex = None
 
     def getCorrespondingAnnot(self, annot):
         try:
@@ -572,6 +799,19 @@ class QPdfView(QGraphicsPixmapItem):
 
         return None
 
+    def getLinkingTextAnnot(self, annot):
+        '''
+        Returns the textBox annotation the provided line belongs to, see addTextAnnot
+        '''
+        if annot.type[0] != fitz.PDF_ANNOT_LINE:
+            return None
+
+        for textAnnot in self.page.annots(types=[fitz.PDF_ANNOT_FREE_TEXT]):
+            if textAnnot.info.get("subject") == str(annot.xref):
+                return textAnnot
+
+        return None
+
     def startMoveObject(self, qpos, annot):
         self.ongoingEdit = True
         self.startPos = qpos
@@ -605,6 +845,7 @@ class QPdfView(QGraphicsPixmapItem):
 
         annot.setRect(nRect)
         annot.update()
+        self.indexAnnot(annot)
 
         # Now check if there is a line which needs to be redrawn
         corrAnnot = self.getCorrespondingAnnot(annot)
@@ -625,6 +866,7 @@ class QPdfView(QGraphicsPixmapItem):
             textInfo["subject"] = str(nAnnot.xref)
             annot.setInfo(textInfo)
             annot.update()
+            self.indexAnnot(annot)
 
         return annot
 
@@ -674,29 +916,39 @@ class QPdfView(QGraphicsPixmapItem):
         rect = fitz.Rect(xMin, yMin, xMax, yMax)
 
         if dx < dy:
-            rect = rect.transform(self.page.derotationMatrix)
+            rect = rect.transform(self.derotationMatrix())
             # rect = fitz.Rect(xMin, yMax, xMax, yMin)
 
         annot = self.addHighlightAnnot(rect)
 
-        History.addToHistory(self.deleteHighlightAnnot, annot, self.addHighlightAnnot, rect)
+        self.history.addToHistory(self.pageNumber, QPdfView.deleteHighlightAnnot, annot, QPdfView.addHighlightAnnot, rect)
 
 
-    def addHighlightAnnot(self, rect):
-        annot = self.page.addHighlightAnnot(rect)
+    def addHighlightAnnot(self, quads, color=None):
+        '''
+        quads is a rect or a list of quads, one per highlighted line
+        '''
+        annot = self.page.addHighlightAnnot(quads)
 
-        try:
-            markerColor = tuple(map(lambda x: float(x), Preferences.data['markerColor']))
-        except ValueError as identifier:
-            markerColor = norm_rgb.main
+        if color is not None:
+            markerColor = color
+        else:
+            try:
+                markerColor = tuple(map(lambda x: float(x), Preferences.data['markerColor']))
+            except ValueError as identifier:
+                markerColor = norm_rgb.main
 
         annot.setColors({"stroke":markerColor})         # make the lines blue
         annot.update()
+        self.indexAnnot(annot)
+
+        if self.journal:
+            self.journal.recordHighlight(self.pageNumber, annot.xref, annot.vertices, markerColor)
 
         return annot
 
-    def deleteHighlightAnnot(self, annot):
-        self.deleteAnnot(annot)
+    def deleteHighlightAnnot(self, xRef):
+        self.deleteAnnotWithXref(xRef)
 
     #-----------------------------------------------------------------------
     # Eraser
@@ -704,6 +956,9 @@ class QPdfView(QGraphicsPixmapItem):
 
 
     def startEraser(self, qpos):
+        # The eraser works on the annotations of the page
+        self.commitInk()
+
         self.ongoingEdit = True
 
         self.eraserPoints = []
@@ -720,12 +975,195 @@ class QPdfView(QGraphicsPixmapItem):
         self.eraserPoints.append(qpos)
 
     def applyEraser(self):
+        '''
+        Ink annotations are only cut where the eraser path touched their strokes, other annotations which are hit are deleted.
+        All changes of one eraser stroke are undone at once
+        '''
+        if not self.eraserPoints:
+            return
+
+        xPath = np.array([qpos.x() for qpos in self.eraserPoints])
+        yPath = np.array([qpos.y() for qpos in self.eraserPoints])
+
+        index = self.annotations()
+
+        self.history.beginCompound()
+
+        for xRef in index.hitBy(xPath, yPath, ERASERRADIUS):
+            annot = self.loadAnnot(xRef)
+
+            # Already gone, e.g. the line of a deleted text box
+            if not annot:
+                continue
+
+            # A text box and its arrow are erased together, otherwise the restored text box would lose its link to the arrow
+            textAnnot = self.getLinkingTextAnnot(annot)
+            if textAnnot:
+                annot = textAnnot
+                xRef = textAnnot.xref
+
+            if annot.type[0] != fitz.PDF_ANNOT_INK:
+                snapshot = self.annotSnapshot(annot)
+
+                # Only annotations which can be added again are erased
+                if snapshot is None:
+                    continue
+
+                # [snapshot, xref of the current version]
+                erased = [snapshot, xRef]
+                self.eraseAnnot(erased, annot)
+
+                self.history.addToHistory(self.pageNumber, QPdfView.restoreAnnot, erased, QPdfView.eraseAnnot, (erased,))
+                continue
+
+            strokes = []
+            touched = False
+
+            for xStroke, yStroke in index.polylines(xRef):
+                pieces = splitLine(xStroke, yStroke, xPath, yPath, ERASERRADIUS + index.width(xRef) / 2)
+
+                if pieces is None:
+                    strokes.append((xStroke, yStroke))
+                else:
+                    strokes += pieces
+                    touched = True
+
+            # Within the bounding box only, no stroke was touched
+            if not touched:
+                continue
+
+            removed = self.inkSnapshot(annot)
+            remaining = (self.toPdfStrokes(strokes), removed[1], removed[2]) if strokes else None
+
+            # [removed snapshot, remaining snapshot, xref of the removed version, xref of the remaining version]
+            cut = [removed, remaining, xRef, None]
+            self.redoCut(cut, annot)
+
+            self.history.addToHistory(self.pageNumber, QPdfView.undoCut, cut, QPdfView.redoCut, (cut,))
+
+        self.history.endCompound()
+
+    def inkSnapshot(self, annot):
+        '''
+        Everything needed to create the ink annotation again: strokes in pdf coordinates, width and color
+        '''
+        width = annot.border.get("width")
+
+        if width is None or width < 0:
+            width = pdf_annots.defaultPenSize
+
+        return (annot.vertices, width, annot.colors.get("stroke"))
+
+    def addInkSnapshot(self, snapshot):
+        strokes, width, color = snapshot
+
+        return self.addInkAnnot(strokes, penSize=width, color=color)
+
+    def toPdfStrokes(self, strokes):
+        return [np.column_stack(transformPoints(xPoints, yPoints, self.derotationMatrix())).tolist() for xPoints, yPoints in strokes]
+
+    def undoCut(self, cut):
+        removed, remaining, removedXref, remainingXref = cut
+
+        if remainingXref is not None:
+            self.deleteAnnotWithXref(remainingXref)
+
+        annot = self.addInkSnapshot(removed)
+
+        # Earlier entries, e.g. of the stroke itself, still know the previous xref
+        if annot:
+            self.history.remapXref(removedXref, annot.xref)
+            cut[2] = annot.xref
+
+    def redoCut(self, cut, annot=None):
+        '''
+        Replaces the ink annotation by what's left of it after the cut
+        '''
+        removed, remaining, removedXref, remainingXref = cut
+
+        if annot:
+            self.deleteAnnot(annot)
+        else:
+            self.deleteAnnotWithXref(removedXref)
+
+        if remaining:
+            annot = self.addInkSnapshot(remaining)
+
+            if annot:
+                if remainingXref is not None:
+                    self.history.remapXref(remainingXref, annot.xref)
+
+                cut[3] = annot.xref
+
+        return cut
+
+    def annotSnapshot(self, annot):
+        '''
+        Everything needed to create a highlight, line or textBox annotation again, None for other annotations
+        '''
+        annotType = annot.type[0]
 
-        annots = self.getAnnotsAtPoints(self.eraserPoints)
+        if annotType == fitz.PDF_ANNOT_HIGHLIGHT:
+            vertices = annot.vertices
+            quads = [fitz.Quad(vertices[i:i + 4]) for i in range(0, len(vertices), 4)]
 
-        for annot in annots:
-            # History.addToHistory(self.addAnnot, annot, self.deleteAnnot, annot)
+            return (annotType, quads, annot.colors.get("stroke"))
+
+        if annotType == fitz.PDF_ANNOT_LINE:
+            fStart, fEnd = annot.vertices[:2]
+            arrow = annot.lineEnds[0] == fitz.PDF_ANNOT_LE_CIRCLE
+
+            return (annotType, (fitz.Point(fStart), fitz.Point(fEnd)), arrow, annot.border.get("width"), annot.colors.get("stroke"), annot.info.get("subject", ""))
+
+        if annotType == fitz.PDF_ANNOT_FREE_TEXT:
+            # The font size is only part of the default appearance string
+            match = re.search(r'([\d.]+) Tf', self.page.parent.xrefObject(annot.xref))
+            textSize = float(match.group(1)) if match else pdf_annots.defaultTextSize
+
+            lineAnnot = self.getCorrespondingAnnot(annot)
+            arrowPoints = tuple(fitz.Point(point) for point in lineAnnot.vertices[:2]) if lineAnnot else None
+
+            return (annotType, annot.rect, annot.info.get("content", ""), textSize, arrowPoints)
+
+        return None
+
+    def addAnnotSnapshot(self, snapshot):
+        annotType = snapshot[0]
+
+        if annotType == fitz.PDF_ANNOT_HIGHLIGHT:
+            _, quads, color = snapshot
+
+            return self.addHighlightAnnot(quads, color)
+
+        if annotType == fitz.PDF_ANNOT_LINE:
+            _, (fStart, fEnd), arrow, width, color, subj = snapshot
+
+            if arrow:
+                return self.addArrow(fStart, fEnd, subj)
+
+            return self.addLine(fStart, fEnd, subj, width, color)
+
+        if annotType == fitz.PDF_ANNOT_FREE_TEXT:
+            _, textRect, content, textSize, arrowPoints = snapshot
+
+            return self.addTextAnnot(textRect, content, textSize, arrowPoints)
+
+        return None
+
+    def eraseAnnot(self, erased, annot=None):
+        if annot:
             self.deleteAnnot(annot)
+        else:
+            self.deleteAnnotWithXref(erased[1])
+
+        return erased
+
+    def restoreAnnot(self, erased):
+        annot = self.addAnnotSnapshot(erased[0])
+
+        if annot:
+            self.history.remapXref(erased[1], annot.xref)
+            erased[1] = annot.xref
 
 
     #-----------------------------------------------------------------------
@@ -743,26 +1181,34 @@ class QPdfView(QGraphicsPixmapItem):
         self.ongoingEdit = False
 
     def updateFormPoints(self, qpos):
-        self.formPoints.append(self.qPointToFPoint(qpos)*self.page.derotationMatrix)
+        # Transformed to pdf coordinates once the form is finished
+        self.formPoints.append((qpos.x(), qpos.y()))
 
 
     def applyFormPoints(self):
-        fStart, fStop = estimateLine(self.formPoints[0], self.formPoints[-1])
+        xPoints, yPoints = transformPoints(*np.array(self.formPoints, dtype=np.float64).T, self.derotationMatrix())
+
+        fStart, fStop = estimateLine(fitz.Point(xPoints[0], yPoints[0]), fitz.Point(xPoints[-1], yPoints[-1]))
 
         annot = self.addLine(fStart, fStop, "")
 
-        History.addToHistory(self.deleteLine, annot, self.addLine, (fStart, fStop, ""))
+        self.history.addToHistory(self.pageNumber, QPdfView.deleteLine, annot, QPdfView.addLine, (fStart, fStop, ""))
 
     #-----------------------------------------------------------------------
     # Draw
     #-----------------------------------------------------------------------
-    def startDraw(self, qpos, pressure=0):
+    def startDraw(self, qpos, pressure=DEFAULTPRESSURE):
         if self.ongoingEdit:
             return
         self.ongoingEdit = True
 
+        self.liveStroke.clear()
+        self.liveStroke.smooth = toBool(Preferences.data['radioButtonSmoothLines'])
+        self.liveStroke.widthScale = PRESSUREMULTIPLIER * self.freeHandSize
+        self.predictor.reset()
+
         # self.drawIndicators = []
-        self.addTempPoint(qpos, pressure)
+        self.addStrokePoint(qpos, pressure)
 
     def stopDraw(self, qpos, pressure=0):
 
@@ -784,58 +1230,128 @@ class QPdfView(QGraphicsPixmapItem):
 
 
     def applyDrawPoints(self):
-        if self.tempPoints.qsize() == 0:
+        if len(self.tempPoints) == 0:
             return
 
-        # segment = list(self.tempPoints.queue)
-        
-        
-        tempList = list(zip(*list(self.tempPoints.queue)))
-
         if toBool(Preferences.data['radioButtonSmoothLines']):
-            segment = smoothLine(tempList[0], asQPoints=False)
+            xPoints, yPoints = smoothLine(self.tempPoints.xs, self.tempPoints.ys)
+            pressures = smoothValues(self.tempPoints.pressures)
         else:
-            segment = normalize(tempList[0], asQPoints=False)
+            xPoints, yPoints = normalize(self.tempPoints.xs, self.tempPoints.ys)
+            pressures = self.tempPoints.pressures
 
-        # if self.smooth:
-        #     segment = smoothLine(list(self.tempPoints.queue))
-        # else:
-        #     segment = list(self.tempPoints.queue)
-            
-        # self.addDrawPoint(segment[-1], tempList[1][-1])
+        # Same width profile as the live stroke
+        widths = self.liveStroke.widths(pressures)
 
-        # self.qPointToFloatParirs(qpos, pressure)
+        runs = self.simplifyStroke(xPoints, yPoints, widths)
+        stroke = PendingStroke(runs, self.derotationMatrix(), self.freeHandColor, self.annotFreehandColor())
 
-        # Line smoothing
-        # self.estPoints = estimateLine(self.drawPoints)
+        self.ongoingEdit = False
 
-        pointList = list()
-        for point in zip(*segment):
-            fp = fitz.Point(point[0], point[1])
-            fpt = fp * self.page.derotationMatrix
-            pointList.append([fpt.x, fpt.y])
+        # The overlay takes over from the live stroke
+        self.update(self.liveStroke.bounds())
+        self.clearTempPoints()
 
-        
+        self.queueInk(stroke)
+        self.history.addToHistory(self.pageNumber, QPdfView.removeInk, stroke, QPdfView.queueInk, (stroke,))
 
+    def simplifyStroke(self, xPoints, yPoints, widths):
+        '''
+        Splits the stroke into runs of similar width and drops the points of each run which don't change its shape visibly at the current zoom.
+        The runs are simplified separately, so their boundaries and therefore the width profile are preserved
+        '''
+        tolerance = self.simplifyTolerance / self.viewZoomFactor()
 
-        self.ongoingEdit = False
+        runs = []
+
+        for start, stop, penSize in widthSegments(widths):
+            keep = simplifyLine(xPoints[start:stop], yPoints[start:stop], tolerance)
+
+            runs.append((xPoints[start:stop][keep], yPoints[start:stop][keep], penSize))
+
+        return runs
+
+    def viewZoomFactor(self):
+        '''
+        Zoom the page is shown at. The view is scaled by its absZoomFactor, see GraphicsViewHandler.applyZoom,
+        while lastZoomFactor is the zoom of the page image, which stops at the tile zoom
+        '''
+        views = self.scene().views() if self.scene() else []
+
+        if views:
+            return views[0].transform().m11()
+
+        return self.lastZoomFactor if self.lastZoomFactor > 0 else 1
+
+    def queueInk(self, stroke):
+        '''
+        Shows the stroke in the overlay. It's written to the pdf with the next batch, see commitInk
+        '''
+        self.pendingInk.append(stroke)
+        self.update(stroke.bounds)
+
+        self.eh.inkPending.emit(self.pageNumber)
+
+        return stroke
 
+    def removeInk(self, stroke):
+        if stroke in self.pendingInk:
+            self.pendingInk.remove(stroke)
+        elif stroke.isCommitted():
+            self.deletePressureInk(stroke.annots)
+            stroke.previousAnnots = stroke.annots
+            stroke.annots = None
 
-        pointList = [pointList]
+            if stroke in self.committedInk:
+                self.committedInk.remove(stroke)
 
-        # pressure = []
+        self.update(stroke.bounds)
 
-        # for point in points:
-        #     pressure.append(point[2])
+    def commitInk(self):
+        '''
+        Writes the pending strokes to the pdf. They stay in the overlay until the page is rendered again.
+        Returns False if there was nothing to write
+        '''
+        if not self.pendingInk:
+            return False
+
+        for stroke in self.pendingInk:
+            stroke.annots = [annot.xref for annot in self.addPressureInk(stroke.segments, stroke.annotColor)]
+
+            # Written again after an undo, e.g. erasures of the stroke know the previous xrefs
+            if stroke.previousAnnots and self.history:
+                for previousXref, xRef in zip(stroke.previousAnnots, stroke.annots):
+                    self.history.remapXref(previousXref, xRef)
+
+        self.committedInk += self.pendingInk
+        self.pendingInk = []
+
+        # The page changed only now, renderings started before don't show the strokes
+        if self.history:
+            self.history.pagesEdited([self.pageNumber])
+            self.committedRevision = self.history.revision
+
+        return True
+
+    def addPressureInk(self, segments, color=None):
+        '''
+        Ink annotations have a single border width, so variable width strokes are saved as one annotation per run of similar width
+        '''
+        annots = []
+
+        for points, penSize in segments:
+            annot = self.addInkAnnot([points], penSize=penSize, color=color)
 
-        annot = self.addInkAnnot(pointList, self.avPressure)
-        History.addToHistory(self.deleteInkAnnot, annot, self.addInkAnnot, (pointList, self.avPressure))
+            if annot:
+                annots.append(annot)
+
+        return annots
 
-        # with self.tempPoints.mutex:
-        #     self.tempPoints.queue.clear()
-        self.avPressure = 1
+    def deletePressureInk(self, xRefs):
+        for xRef in xRefs:
+            self.deleteAnnotWithXref(xRef)
 
-    def addInkAnnot(self, pointList, pressure = None):
+    def addInkAnnot(self, pointList, pressure = None, penSize = None, color = None):
         # if pressureList:
         #     it = 0
         #     for it in range(len(pointList[0])):
@@ -850,22 +1366,31 @@ class QPdfView(QGraphicsPixmapItem):
         except ValueError:
             return
 
-        try:
-            penSize = pressure / len(pointList[0]) * PRESSUREMULTIPLIER * pdf_annots.defaultPenSize * (int(Preferences.data['freehandSize'])/pdf_annots.freeHandScale)
-        except ValueError:
-            penSize = pdf_annots.defaultPenSize
+        if penSize is None:
+            try:
+                penSize = pressure / len(pointList[0]) * PRESSUREMULTIPLIER * pdf_annots.defaultPenSize * (int(Preferences.data['freehandSize'])/pdf_annots.freeHandScale)
+            except (ValueError, TypeError):
+                penSize = pdf_annots.defaultPenSize
 
-        try:
-            freehandColor = tuple(map(lambda x: float(x), Preferences.data['freehandColor']))
-        except ValueError as identifier:
-            freehandColor = norm_rgb.main
+        if color is None:
+            color = self.annotFreehandColor()
 
         annot.setBorder({"width":penSize})# line thickness, some dashing
-        annot.setColors({"stroke":freehandColor})         # make the lines blue
+        annot.setColors({"stroke":color})         # make the lines blue
         annot.update()
+        self.indexAnnot(annot)
+
+        if self.journal:
+            self.journal.recordInk(self.pageNumber, annot.xref, pointList, penSize, color)
 
         return annot
 
+    def annotFreehandColor(self):
+        try:
+            return tuple(map(lambda x: float(x), Preferences.data['freehandColor']))
+        except ValueError as identifier:
+            return norm_rgb.main
+
     def deleteInkAnnot(self, annot):
         pointList = []
         pointList.append(annot.vertices)
@@ -936,33 +1461,55 @@ class QPdfView(QGraphicsPixmapItem):
 
         return frect
 
+    def loadAnnot(self, xRef):
+        try:
+            return self.page.loadAnnot(xRef)
+        except (ValueError, RuntimeError) as identifier:
+            return None
+
+    def getAnnotsAtPos(self, qpos, types=None):
+        '''
+        Return the annots of the current page at the desired position, in the order of the page
+        '''
+        annots = []
+
+        for xRef in self.annotations().atPoint(qpos.x(), qpos.y(), types):
+            annot = self.loadAnnot(xRef)
+
+            if annot:
+                annots.append(annot)
+
+        return annots
+
     def getAnnotAtPos(self, qpos):
         '''
         Return the annot of the current page which is the first at the desired position
         '''
-        try:
-            for annot in self.page.annots():
-                if self.pointInArea(qpos, annot.rect):
-                    return annot
-        except ValueError as identifier:
-            return None
-
+        annots = self.getAnnotsAtPos(qpos)
 
+        if annots:
+            return annots[0]
 
         return None
 
     def getAnnotsAtPoints(self, qposList):
         '''
-        Return the annots of the current page which are hitted by the any point in the list
+        Return the annots of the current page which are hitted by the path along the points.
+        Strokes are only hit if the path comes close to their vertices
         '''
+        if not qposList:
+            return []
+
+        xPoints = [qpos.x() for qpos in qposList]
+        yPoints = [qpos.y() for qpos in qposList]
+
         annots = []
 
-        for annot in self.page.annots():
-            for qpos in qposList:
-                #TODO: Change that here
-                if self.pointInArea(qpos, annot.rect):
-                    annots.append(annot)
-                    break
+        for xRef in self.annotations().hitBy(xPoints, yPoints, ERASERRADIUS):
+            annot = self.loadAnnot(xRef)
+
+            if annot:
+                annots.append(annot)
 
         return annots
 
@@ -970,22 +1517,20 @@ class QPdfView(QGraphicsPixmapItem):
         '''
         Return the annot of the current page, which matches the provided xRef
         '''
-        for annot in self.page.annots():
-            if annot.xref == xRef:
-                return annot
+        if xRef not in self.annotations():
+            return None
 
-        return None
+        return self.loadAnnot(xRef)
 
     def getTextBoxContent(self, qpos):
         '''
         Return the content of the annot of the current page which is the first at the desired position
         '''
         try:
-            for annot in self.page.annots(types=(fitz.PDF_ANNOT_FREE_TEXT, fitz.PDF_ANNOT_TEXT)):
-                if self.pointInArea(qpos, annot.rect):
-                    info = annot.info
+            for annot in self.getAnnotsAtPos(qpos, types=(fitz.PDF_ANNOT_FREE_TEXT, fitz.PDF_ANNOT_TEXT)):
+                info = annot.info
 
-                    return info["content"]
+                return info["content"]
         except ValueError as identifier:
             return None
 
@@ -1154,8 +1699,7 @@ class QPdfView(QGraphicsPixmapItem):
         if self.ongoingEdit and not self.penDraw:
             if editMode == editModes.freehand:
                 # self.addDrawPoint(self.toPdfCoordinates(event.pos()))
-                self.addTempPoint(self.toPdfCoordinates(event.pos()))
-                self.update()
+                self.addStrokePoint(self.toPdfCoordinates(event.pos()))
             elif editMode == editModes.eraser:
                 self.updateEraserPoints(self.toPdfCoordinates(event.pos()))
             elif editMode == editModes.forms:
@@ -1218,12 +1762,11 @@ class QPdfView(QGraphicsPixmapItem):
                 self.addTempPoint(self.toWidgetCoordinates(highResPos, zoom, xOff, yOff))
                 self.update()
             elif editMode == editModes.marker:
-                self.tempPoints.put(self.toWidgetCoordinates(highResPos, zoom, xOff, yOff))
+                self.addTempPoint(self.toWidgetCoordinates(highResPos, zoom, xOff, yOff), pressure)
                 self.update()
             elif editMode == editModes.freehand or toBool(Preferences.data['radioButtonUsePenAsDefault']):
                 # self.addDrawPoint(self.fromSceneCoordinates(highResPos, zoom, xOff, yOff), pressure)
-                self.addTempPoint(self.toWidgetCoordinates(highResPos, zoom, xOff, yOff), pressure)
-                self.update()
+                self.addStrokePoint(self.toWidgetCoordinates(highResPos, zoom, xOff, yOff), pressure, predict=True)
         elif eventType == QEvent.TabletPress:
             self.clearTempPoints()
             self.penDraw = True
@@ -1235,7 +1778,7 @@ class QPdfView(QGraphicsPixmapItem):
             elif editMode == editModes.forms:
                 self.startForms(self.fromSceneCoordinates(highResPos, zoom, xOff, yOff))
             elif editMode == editModes.freehand or toBool(Preferences.data['radioButtonUsePenAsDefault']):
-                self.startDraw(self.fromSceneCoordinates(highResPos, zoom, xOff, yOff))
+                self.startDraw(self.fromSceneCoordinates(highResPos, zoom, xOff, yOff), pressure)
         elif eventType == QEvent.TabletRelease:
             if editMode == editModes.marker:
                 self.stopMarkText(self.fromSceneCoordinates(highResPos, zoom, xOff, yOff))
@@ -1285,11 +1828,7 @@ class QPdfView(QGraphicsPixmapItem):
 
     def toWidgetCoordinates(self, qPos, zoom, xOff, yOff):
         # pPos = self.mapFromParent(qPos)
-        qPos = qPos / zoom
-
-        qPos.setX(abs(qPos.x())+xOff - self.x())
-        qPos.setY(abs(qPos.y())+yOff - self.y())
-        return qPos
+        return QPointF(abs(qPos.x())/zoom + xOff - self.x(), abs(qPos.y())/zoom + yOff - self.y())
 
     def singleFromSceneCoordinates(self, qPos, zoom, xOff, yOff):
         # pPos = self.mapFromParent(qPos)
@@ -1300,11 +1839,7 @@ class QPdfView(QGraphicsPixmapItem):
 
     def fromSceneCoordinates(self, qPos, zoom, xOff, yOff):
         # pPos = self.mapFromParent(qPos)
-        qPos = qPos / zoom
-
-        qPos.setX(abs(qPos.x())+xOff - self.xOrigin)
-        qPos.setY(abs(qPos.y())+yOff - self.yOrigin)
-        return qPos
+        return QPointF(abs(qPos.x())/zoom + xOff - self.xOrigin, abs(qPos.y())/zoom + yOff - self.yOrigin)
 
     def nfromSceneCoordinates(self, qPos, zoom, xOff, yOff):
         # pPos = self.mapFromParent(qPos)
@@ -1358,19 +1893,30 @@ class QPdfView(QGraphicsPixmapItem):
 class Renderer(QObject):
     DEFAULTPAGESPACE = 7
     LOWRESZOOM = float(0.3)
+    TILEZOOM = float(3)
+    THUMBNAILCHUNK = 4
+    DEFERREDOPENDELAY = 50      # ms
+    MATERIALIZEDISTANCE = RenderScheduler.MAXLOOKAHEAD
 
     itemRenderFinished = Signal(QPdfView, int, int)
     pdfRenderFinished = Signal()
+    layoutChanged = Signal()
 
     pageRenderStart = Signal(QPdfView, float)
 
-    nextRenderingPage = 0
-    enableBackgroundRendering = False
 
     def __init__(self, parent):
         QObject.__init__(self)
 
+        # Scene items of the pages close to the viewport only
         self.pages = IndexedOrderedDict()
+        self.recycledPages = list()
+        self.layout = PageLayout(self.DEFAULTPAGESPACE)
+
+        self.documentLoader = None
+        # The pdf views got no pages yet, see openDeferredPdf
+        self.pdfDeferred = False
+
         self.absZoomFactor = float(1)
 
         self.pdf = pdfEngine()
@@ -1378,369 +1924,1195 @@ class Renderer(QObject):
 
         self.backgroundRenderTimer = QTimer()
 
-        self.parent = parent
+        self.tileCache = TileCache()
 
-        self.pageRenderStart.connect(self.updatePageAsync)
+        self.pageCache = PageCache()
+        self.visibleRange = (0, 0)
 
-    def updateReceiver(self, zoom):
-        self.rendererWorker.absZoomFactor = zoom
+        self.diskCache = DiskCache()
 
-    def getPageSize(self, page=0):
-        return self.pdf.getPageSize(0)
+        self.thumbnails = dict()        # pageNumber: (qImg, history revision), counted by the page cache
+        self.thumbnailQueue = list()
 
-    def backgroundRenderer(self):
-        for pIt in range(self.pdf.doc.pageCount):
-            if pIt == (self.nextRenderingPage):
-                if self.pages[pIt].isDraft:
-                    print("Rendering " + str(pIt))
-                    self.updatePage(self.pages[pIt], self.absZoomFactor)
-                    self.nextRenderingPage = pIt + 1
+        self.renderPool = None
+        self.renderPoolJobs = dict()    # jobId: (pageNumber, history revision, callback(qImg, zoom))
+        self.renderPoolTimer = QTimer()
+        self.renderPoolTimer.timeout.connect(self.renderPoolReceiver)
 
-                    self.enableBackgroundRenderer()
-                    self.startBackgroundRenderer()
-                    return
-                else:
-                    self.nextRenderingPage = pIt + 1
+        self.diskCacheJobs = list()     # (future, pageNumber, history revision, callback(qImg, zoom))
+        self.diskCacheTimer = QTimer()
+        self.diskCacheTimer.timeout.connect(self.diskCacheReceiver)
 
-    def startBackgroundRenderer(self):
-        if self.nextRenderingPage < self.pdf.doc.pageCount and self.enableBackgroundRendering:
-            self.stopBackgroundRenderer()
-            self.backgroundRenderTimer.singleShot(300, self.backgroundRenderer)
+        self.parent = parent
 
+        self.pageRenderStart.connect(self.updatePageAsync)
 
-    def stopBackgroundRenderer(self):
-        self.enableBackgroundRendering = False
+    def startRenderPool(self):
+        '''
+        Starts the render processes for the currently opened pdf
+        '''
+        self.stopRenderPool()
 
-    def enableBackgroundRenderer(self):
-        self.enableBackgroundRendering = True
+        if not self.pdf.filename or not os.path.isfile(self.pdf.filename):
+            return
 
-    @Slot(int)
-    def renderPdfToCurrentView(self, startPage):
-        self.startPage = startPage
-        t = QTimer()
+        try:
+            self.renderPool = RenderPool(self.pdf.filename)
+        except OSError as identifier:
+            print("Unable to start render pool: " + str(identifier))
+            self.renderPool = None
 
-        t.singleShot(0, self.delayedRenderer)
+    def stopRenderPool(self):
+        self.renderPoolTimer.stop()
+        self.renderPoolJobs.clear()
 
+        if self.renderPool:
+            self.renderPool.terminate()
+            self.renderPool = None
 
-    def delayedRenderer(self):
-        # Start at the top
-        posX = float(0)
-        posY = float(0)
+    def reloadRenderPool(self, filename):
+        '''
+        Called after the pdf was saved, so the render processes see the latest changes
+        '''
+        if self.renderPool and filename:
+            self.renderPool.reload(filename)
 
-        width, height = self.getPageSize()
+    def useRenderPool(self, pageNumber):
+        '''
+        The render processes only know the pdf as it is on the disk.
+        Pages which were changed since the last save are rendered locally, as well as all pages once the render processes stopped, see renderPoolDied
+        '''
+        return self.renderPool is not None and self.pdf.history.isSaved(pageNumber)
 
-        print('Rendering PDF from page ' + str(self.startPage))
-        self.start_time = time.time()
+    def renderPoolReceiver(self):
+        for jobId, key, zoom, samples, width, height, stride, alpha in self.renderPool.poll():
+            job = self.renderPoolJobs.pop(jobId, None)
+
+            if not job:
+                continue
 
-        for pIt in range(self.pdf.doc.pageCount):
+            pageNumber, revision, callback = job
 
-            if pIt <= self.startPage + 2 and pIt >= self.startPage - 2:
-                self.loadPdfPageToCurrentView(pIt, posX, posY, self.absZoomFactor)
-            # elif pIt <= self.startPage + 10 and pIt >= self.startPage - 10:
-            #     self.loadPdfPageToCurrentView(pIt, posX, posY, self.LOWRESZOOM)
-            #     self.pages[pIt].setAsDraft()
-            else:
-                self.loadBlankImageToCurrentView(pIt, posX, posY, width, height)
-                self.pages[pIt].setAsDraft()
+            # The page was changed after the job was submitted
+            if self.pdf.history.pageRevision(pageNumber) > revision:
+                continue
 
-            posY += height + self.DEFAULTPAGESPACE
+            callback(self.pdf.getQImageFromSamples(samples, width, height, stride, alpha), zoom)
 
-        self.pdfRenderFinished.emit()
-        self.enableBackgroundRendering = True
+        if not self.renderPool.isAlive():
+            self.renderPoolDied()
+            return
+
+        if not self.renderPool.isBusy():
+            self.renderPoolJobs.clear()
+            self.renderPoolTimer.stop()
 
-    def loadBlankImageToCurrentView(self, pageNumber, posX, posY, width, height):
+    def renderPoolDied(self):
         '''
-        Creates a qpdf instance and loads an empty image.
-        This is intended to be used in combination with the initial pdf loading
+        None of the render processes is able to open the pdf anymore. Their unfinished jobs are rendered locally from now on
         '''
-        # Create a qpdf instance
-        pdfView = QPdfView()
-        pdfView.setPage(self.pdf.getPage(pageNumber), pageNumber)
+        print('Render pool stopped, rendering locally')
 
-        # Render a blank image
-        self.updateEmptyPdf(pdfView, width, height)
+        jobs = [(job, self.renderPoolJobs.get(job[0])) for job in self.renderPool.unfinishedJobs()]
 
-        # Store instance locally
-        self.pages[pageNumber] = pdfView
+        self.stopRenderPool()
+
+        for (jobId, key, pageNumber, zoom, clip, alpha, invert), poolJob in jobs:
+            if not poolJob:
+                continue
+
+            # There might be lots of them, so they are rendered in chunks
+            if key == ('thumbnail', pageNumber):
+                self.thumbnailQueue.append(pageNumber)
+                continue
 
-        self.connectPageSignals(self.pages[pageNumber])
+            try:
+                pixmap = self.pdf.renderPixmap(pageNumber, mat=fitz.Matrix(zoom, zoom), clip=fitz.Rect(clip) if clip else None, invert=invert)
+            except RuntimeError as identifier:
+                print(str(identifier))
+                continue
 
-        # add and arrange the new page in the scene
-        self.itemRenderFinished.emit(self.pages[pageNumber], posX, posY)
+            poolJob[2](self.pdf.getQImage(pixmap), zoom)
 
+        self.thumbnailRenderer()
 
-    def loadPdfPageToCurrentView(self, pageNumber, posX, posY, zoom):
+    def submitToRenderPool(self, pageNumber, zoom, callback, clip=None, key=None, urgent=True):
         '''
-        Creates a qpdfView instance from the desired page and renders it at the provided position with the zoomfactor.
-        A lower zoomFactor will dramatically improve speed, as it always correlates to the dpi of the page
+        Hands a render job to the render pool. The callback receives the rendered image and the zoom,
+        unless the page was changed before the job is done
         '''
-        # Create a qpdf instance
-        pdfView = QPdfView()
-        pdfView.setPage(self.pdf.getPage(pageNumber), pageNumber)
+        jobId = self.renderPool.submit(pageNumber, zoom, clip=clip, invert=self.imageHelper.invertsPdf(), key=key, urgent=urgent)
+        self.renderPoolJobs[jobId] = (pageNumber, self.pdf.history.revision, callback)
 
-        # Render according to the parameters
-        self.updatePage(pdfView, zoom = zoom, thread=False)
+        if not self.renderPoolTimer.isActive():
+            self.renderPoolTimer.start(15)
 
-        if pageNumber in self.pages:
-            pagesCache = self.pages.copy()
+    def loadFromDiskCache(self, pageNumber, zoom, signature, callback):
+        '''
+        Decodes the cached image of the page in the background. The callback receives the image and the zoom it was rendered at,
+        or (None, None) if there is none or the page was changed in the meantime
+        '''
+        future = self.diskCache.loadAsync(pageNumber, zoom, signature, self.imageHelper.invertsPdf())
+        self.diskCacheJobs.append((future, pageNumber, self.pdf.history.revision, callback))
 
-            for pageNumberIt in sorted(pagesCache.keys(), reverse=True):
-                if pageNumberIt >= pageNumber:
-                    self.pages[pageNumber+1] = pagesCache[pageNumberIt]
-                else:
-                    break
+        if not self.diskCacheTimer.isActive():
+            self.diskCacheTimer.start(15)
 
-        # Store instance locally
-        self.pages[pageNumber] = pdfView
+    def diskCacheReceiver(self):
+        jobs = self.diskCacheJobs
+        self.diskCacheJobs = list()
 
-        self.connectPageSignals(self.pages[pageNumber])
+        for job in jobs:
+            future, pageNumber, revision, callback = job
 
-        # add and arrange the new page in the scene
-        self.itemRenderFinished.emit(self.pages[pageNumber], posX, posY)
+            if not future.done():
+                self.diskCacheJobs.append(job)
+                continue
 
-    def connectPageSignals(self, page):
-        # # Connect event handlers
-        page.eh.requestTextInput.connect(self.parent.toolBoxTextInputRequestedEvent)
-        page.eh.addIndicatorPoint.connect(self.parent.addIndicatorPoint)
-        page.eh.deleteLastIndicatorPoint.connect(self.parent.deleteLastIndicatorPoint)
+            qImg, zoom = future.result()
 
-        self.parent.settingsChanged.connect(page.settingsChangedReceiver)
+            # The page was changed after the job was submitted
+            if self.pdf.history.pageRevision(pageNumber) > revision:
+                qImg, zoom = None, None
+
+            callback(qImg, zoom)
 
-    def removePdfPageFromCurrentView(self, pdfView):
-        pagesCache = self.pages.copy()
+        if not self.diskCacheJobs:
+            self.diskCacheTimer.stop()
 
-        for pageNumberIt in sorted(pagesCache.keys(), reverse=True):
-            if pdfView.pageNumber < pageNumberIt:
-                self.pages[pageNumberIt-1] = pagesCache[pageNumberIt]
+    def updateReceiver(self, zoom):
+        self.rendererWorker.absZoomFactor = zoom
+
+    def getPageSize(self, page=0):
+        return self.pdf.getPageSize(0)
 
-            self.pages[pageNumberIt] = self.pdf.getPage(pageNumberIt)
+    @Slot(int)
+    def renderPdfToCurrentView(self, startPage):
+        self.startPage = startPage
+        t = QTimer()
 
+        t.singleShot(0, self.delayedRenderer)
 
-        # del self.pages[self.pages.keys()[-1]]
 
-    def updatePage(self, pdfViewInstance, zoom, clip=None, off=None, thread=True):
+    def delayedRenderer(self):
         '''
-        Update the provided pdf file at the desired page to render only the zoom and clip
-        This methods is used when instantiating the pdf and later, when performance optimization and zooming is required
+        Synchronous counterpart of loadPdfAsync for documents which are already open
         '''
+        print('Rendering PDF from page ' + str(self.startPage))
+        self.start_time = time.time()
 
-        if thread:
-            # self.updatePageAsync(pdfViewInstance, zoom, clip, off)
-            # return
-            # print(time.time())
-            self.pdfViewInst = pdfViewInstance
-            self.zoomFactor = zoom
+        if self.pdf.filename and os.path.isfile(self.pdf.filename):
+            self.diskCache.openDocument(self.pdf.filename)
 
-            t = QTimer()
-            # t.singleShot(300, self.scrollTo)
-            t.singleShot(0, self.dirtyThread)
-        else:
-            self.pageRenderStart.emit(pdfViewInstance, zoom)
+        self.prepareDocument(self.pdf.getPageSizes())
 
+        firstPage = max(0, self.startPage - 2)
+        lastPage = min(self.layout.pageCount() - 1, self.startPage + 2)
 
-    def dirtyThread(self):
-        self.pageRenderStart.emit(self.pdfViewInst, self.zoomFactor)
-    
-    @Slot(QPdfView, int)
-    def updatePageAsync(self, pdfViewInstance, zoom, clip=None, off=None):
-        clip = None
-        if clip:
-            try:
-                # qpos = QPointF(clip.x(), clip.y())
-                # fpos = pdfViewInstance.fromSceneCoordinates(qpos, zoom, clip.x(), clip.y())
-                qClip = pdfViewInstance.cropAndAlign(clip, zoom, off)
-                fClip = pdfViewInstance.qRectToFRect(qClip)
-                # fClip = None
+        self.materializePages(firstPage, lastPage)
 
-                
-            except Exception as identifier:
-                fClip = None
+        # Pages are not arranged yet, so these are rendered right away
+        for pageNumber in range(firstPage, lastPage + 1):
+            self.updatePage(self.pages[pageNumber], zoom=self.absZoomFactor, thread=False)
 
-        else:
-            fClip = None
+        self.finishDocument()
 
-        try:
-            pixmap = self.pdf.renderPixmap(pdfViewInstance.pageNumber, mat=fitz.Matrix(zoom, zoom), clip=fClip)
-        except RuntimeError as identifier:
-            print(str(identifier))
-            return
+    def prepareDocument(self, sizes):
+        '''
+        Resets all per document state and builds the page layout
+        '''
+        self.startRenderPool()
 
-        try:
-            qImg = self.pdf.getQImage(pixmap)
-        except ValueError as identifier:
-            return
+        self.releaseAllPages()
 
-        qImg.setDevicePixelRatio(zoom)
-        qImg = self.imageHelper.applyTheme(qImg)
+        self.thumbnails.clear()
+        self.pageCache.clear()
+        self.tileCache.clear()
 
-        
+        self.layout.build(sizes)
+        self.layoutChanged.emit()
 
-        # if pdfViewInstance.pageNumber:
-        if fClip:
-            self.qp = QPainter(pdfViewInstance.qImg)
-            self.qp.drawImage(fClip.x0, fClip.y0, qImg)
-            self.qp.end()
+    def finishDocument(self):
+        '''
+        All pages are laid out. Everything which isn't rendered yet gets a thumbnail
+        '''
+        self.thumbnailQueue = [pageNumber for pageNumber in range(self.layout.pageCount()) if not (pageNumber in self.pages and not self.pages[pageNumber].isDraft)]
 
-        pdfViewInstance.setQImage(qImg, pdfViewInstance.pageNumber, zoom)
+        self.pdfRenderFinished.emit()
 
-        pdfViewInstance.renderingFinished()
-        # else:
-        #     if fClip:
-        #         qp = QPainter(pdfViewInstance.qImg)
-        #         qp.drawImage(fClip.x, fClip.y, qImg)
+        self.startThumbnailRenderer()
 
-        #     pdfViewInstance.updateQImage(qImg, zoom)
+    def loadPdfAsync(self, filename, startPage=0):
+        '''
+        Opens the document in a worker process, so the window keeps responding for large or damaged files.
+        The layout starts with the size of the start page for every page and is refined while the real page sizes arrive
+        '''
+        print('Loading PDF from page ' + str(startPage))
+        self.start_time = time.time()
+        self.startPage = startPage
 
-        # if fClip != None:
-        #     xCorr = pdfViewInstance.xOrigin + off.x()
-        #     yCorr = pdfViewInstance.yOrigin + off.y()
+        self.stopDocumentLoader()
+        self.stopRenderPool()
 
-        #     pdfViewInstance.setPos(xCorr, yCorr)
+        self.releaseAllPages()
+        self.layout.build([])
+        self.layoutChanged.emit()
 
-        # print(time.time()-start)
+        # Set once the worker hashed the file
+        self.diskCache.setDocument(None)
 
-    def updateEmptyPdf(self, pdfViewInstance, width, height):
-        '''
-        Update the provided pdf file at the desired page to render only the zoom and clip
-        This methods is used when instantiating the pdf and later, when performance optimization and zooming is required
-        '''
+        self.documentLoader = DocumentLoader(filename, startPage, self.absZoomFactor, self.imageHelper.invertsPdf())
 
-        qImg = QImage(1, 1, QImage.Format_Mono)
-        qImg.fill(0)
+        self.documentLoader.pageCountReady.connect(self.documentOpened)
+        self.documentLoader.firstPageReady.connect(self.firstPageRendered)
+        self.documentLoader.documentHashReady.connect(self.diskCache.setDocument)
+        self.documentLoader.pageSizesReady.connect(self.pageSizesReceived)
+        self.documentLoader.finished.connect(self.documentLoaded)
+        self.documentLoader.failed.connect(self.documentFailed)
 
-        if pdfViewInstance.pageNumber:
-            pdfViewInstance.setQImage(qImg, pdfViewInstance.pageNumber)
-        else:
-            pdfViewInstance.updateQImage(qImg)
+        self.documentLoader.start()
 
-class GraphicsViewHandler(QGraphicsView):
-    # pages = IndexedOrderedDict()
+    def stopDocumentLoader(self):
+        if self.documentLoader:
+            self.documentLoader.terminate()
+            self.documentLoader = None
 
-    updatePages = Signal()
-    renderPdf = Signal(int)
+    @Slot(int, int, float, float)
+    def documentOpened(self, pageCount, startPage, width, height):
+        # Opening damaged files blocks until MuPDF repaired them, so the gui opens the document once the start page is shown, see openDeferredPdf
+        self.pdf.openPdf(self.documentLoader.filename, lazy=True)
+        self.pdfDeferred = True
 
-    # absZoomFactor = float(1)
-    LOWRESZOOM = float(0.1)
+        self.startPage = startPage
 
-    # x, y, pageNumber, currentContent
-    requestTextInput = Signal(int, int, int, str)
-    changesMade = Signal(bool)
+        self.prepareDocument([(width, height)] * pageCount)
 
-    settingsChanged = Signal()
+        self.materializePages(max(0, startPage - 2), min(pageCount - 1, startPage + 2))
 
-    tempObj = list()
-    updateIndicator = False
+    @Slot(int, float, object)
+    def firstPageRendered(self, pageNumber, zoom, pixmapInfo):
+        pdfViewInstance = self.pages.get(pageNumber)
 
-    colorOverride = False
+        if type(pdfViewInstance) != QPdfView or not pdfViewInstance.isDraft:
+            return
 
-    lastZoomTime = 0.0
+        self.applyRenderedImage(pdfViewInstance, self.pdf.getQImageFromSamples(*pixmapInfo), zoom)
 
-    def __init__(self, parent):
-        '''
-        Creates the graphic view handler instance, which is a main feature of the unote application
+        print("--- First page within %s seconds ---" % (self.documentLoader.elapsed()))
 
-        :param parent: Parent editor widget.
+        # After the page got painted
+        QTimer.singleShot(self.DEFERREDOPENDELAY, self.openDeferredPdf)
+
+    def openDeferredPdf(self):
         '''
-        QGraphicsView.__init__(self, parent)
+        Opens the document in the gui, the pdf views got no pages until then, see acquirePage
+        '''
+        if not self.pdfDeferred:
+            return
 
-        self.gotoScrollPos = 0
-        self.startPage = 0
+        self.pdfDeferred = False
 
-        # self.pdf = pdfEngine()
-        # self.imageHelper = imageHelper()
+        self.pdf.loadPending()
+        self.documentReopened()
 
-        self.setMouseTracking(True)
-        self.setTabletTracking(True)
-        self.setObjectName("graphicsView")
-        self.setRenderHint(QPainter.Antialiasing)
-        self.setAttribute(Qt.WA_AcceptTouchEvents)
-        self.viewport().setAttribute(Qt.WA_AcceptTouchEvents)
-        # self.setDragMode(self.ScrollHandDrag)
-        # self.setFrameShape(QGraphicsView.NoFrame)
-        # # self.resize(parent.size())
+        # Renderings of the worker don't know the replayed journal
+        if self.pdf.history.recentChanges != 0:
+            for pdfView in self.pages.values():
+                if type(pdfView) == QPdfView:
+                    self.updatePage(pdfView, zoom=self.absZoomFactor)
 
+    @Slot(int, object)
+    def pageSizesReceived(self, firstPage, sizes):
+        self.layout.resizePages(firstPage, sizes)
+        self.layoutChanged.emit()
 
-        self.scroller = QScroller.scroller(self.viewport())
-        self.scroller.grabGesture(self.viewport(), QScroller.TouchGesture)
-        self.scroller.stateChanged.connect(self.scrollerStateChanged)
+        self.arrangePages()
 
-        self.scrollerProperties = self.scroller.scrollerProperties()
-        self.scrollerProperties.setScrollMetric(QScrollerProperties.VerticalOvershootPolicy, QScrollerProperties.OvershootAlwaysOff)
+    @Slot()
+    def documentLoaded(self):
+        print("--- Page layout within %s seconds ---" % (self.documentLoader.elapsed()))
 
-        self.scrollerProperties.setScrollMetric(QScrollerProperties.HorizontalOvershootPolicy, QScrollerProperties.OvershootAlwaysOff)
+        self.stopDocumentLoader()
 
-        self.scroller.setScrollerProperties(self.scrollerProperties)
+        # The start page failed to render in the worker
+        self.openDeferredPdf()
 
-        self.rendererThread = QThread(parent)
-        self.rendererWorker = Renderer(self)
+        self.finishDocument()
 
-        self.userFinishedTimer = QTimer()
+    @Slot(str)
+    def documentFailed(self, message):
+        print("Unable to load PDF: " + message)
 
-        self.setupScene()
+        self.stopDocumentLoader()
 
-        self.instructRenderer()
+    def arrangePages(self):
+        '''
+        Moves the pdf views to their position in the layout, e.g. after the page sizes changed
+        '''
+        for pageNumber, pdfView in self.pages.items():
+            x, y, width, height = self.layout.pageRect(pageNumber)
 
+            if pdfView.placeholderSize:
+                pdfView.setPlaceholderSize(width, height)
 
-    def paintEvent(self, event):
+            pdfView.setPos(x, y)
+            pdfView.setAsOrigin()
 
+    def startThumbnailRenderer(self):
+        '''
+        First pass of the progressive rendering. All draft pages get a cheap thumbnail, which is replaced by the full resolution rendering once the page gets visible
+        '''
+        self.thumbnailQueue = [pageNumber for pageNumber in self.thumbnailQueue if not self.loadCachedThumbnail(pageNumber)]
 
-        res = super().paintEvent(event)
+        localQueue = list()
 
-        # self.rendererWorker.startBackgroundRenderer()
+        for pageNumber in self.thumbnailQueue:
+            if not self.useRenderPool(pageNumber):
+                localQueue.append(pageNumber)
+                continue
 
-        return res
+            signature = self.pageSignature(pageNumber)
+            self.submitToRenderPool(pageNumber, self.LOWRESZOOM, lambda qImg, zoom, pageNumber=pageNumber, signature=signature: self.applyThumbnail(pageNumber, qImg, signature), key=('thumbnail', pageNumber), urgent=False)
 
-    def terminate(self):
-        print("Terminating Viewer")
+        self.thumbnailQueue = localQueue
+        self.thumbnailRenderer()
 
-        self.rendererThread.terminate()
+    def thumbnailRenderer(self):
+        '''
+        Renders the thumbnails locally in small chunks, so the ui keeps responding
+        '''
+        for _ in range(self.THUMBNAILCHUNK):
+            if not self.thumbnailQueue:
+                return
 
-        if toBool(Preferences.data['radioButtonSaveOnExit']):
-            if History.recentChanges != 0:
-                self.saveCurrentPdf()
+            pageNumber = self.thumbnailQueue.pop(0)
+            signature = self.pageSignature(pageNumber)
 
-    def setupScene(self):
-        self.scene = QGraphicsScene()
-        self.setScene(self.scene)
+            try:
+                pixmap = self.pdf.renderPixmap(pageNumber, mat=fitz.Matrix(self.LOWRESZOOM, self.LOWRESZOOM), invert=self.imageHelper.invertsPdf())
+            except RuntimeError as identifier:
+                print(str(identifier))
+                continue
 
-        self.setAlignment(Qt.AlignLeft | Qt.AlignTop)
+            self.applyThumbnail(pageNumber, self.pdf.getQImage(pixmap), signature)
 
+        self.backgroundRenderTimer.singleShot(0, self.thumbnailRenderer)
 
-    def createNewPdf(self, fileName):
+    def pageSignature(self, pageNumber):
         '''
-        Creates a new PDf from the given fileName
+        Annotation signature of the page for the disk cache. Pages which are unchanged since the document was opened
+        are identified by the document hash already, which spares reading their annotations
+        '''
+        if not self.pdf.history.isEdited(pageNumber):
+            return DiskCache.UNEDITED
+
+        return DiskCache.annotSignature(self.pdf.getPage(pageNumber))
+
+    def loadCachedThumbnail(self, pageNumber):
+        '''
+        Applies the thumbnail from the disk cache. Returns False if there is none for the current annotations
+        '''
+        # Pages without scene item load their thumbnail once they get one
+        if pageNumber not in self.pages:
+            return self.diskCache.contains(pageNumber, self.LOWRESZOOM, self.pageSignature(pageNumber), self.imageHelper.invertsPdf())
+
+        qImg = self.cachedThumbnail(pageNumber)
+
+        if qImg is None:
+            return False
+
+        self.applyThumbnail(pageNumber, qImg)
+
+        return True
+
+    def cachedThumbnail(self, pageNumber):
+        qImg = self.keptThumbnail(pageNumber)
+
+        if qImg is not None:
+            return qImg
+
+        qImg, _ = self.diskCache.load(pageNumber, self.LOWRESZOOM, self.pageSignature(pageNumber), self.imageHelper.invertsPdf())
+
+        return qImg
+
+    def applyThumbnail(self, pageNumber, qImg, signature=None):
+        '''
+        Shows the thumbnail unless the full resolution rendering was faster.
+        Thumbnails which were not taken from the disk cache are stored there with the annotation signature they were rendered with.
+        Only the thumbnails of pages with a scene item are kept in memory, the others are loaded from the disk cache once needed
+        '''
+        qImg.setDevicePixelRatio(self.LOWRESZOOM)
+
+        if signature is not None:
+            self.diskCache.store(pageNumber, self.LOWRESZOOM, signature, qImg, self.imageHelper.invertsPdf())
+
+        pdfViewInstance = self.pages.get(pageNumber)
+
+        if type(pdfViewInstance) != QPdfView:
+            return
+
+        self.keepThumbnail(pageNumber, qImg)
+
+        if pdfViewInstance.isDraft:
+            pdfViewInstance.setQImage(qImg, pageNumber, self.LOWRESZOOM)
+
+    def keepThumbnail(self, pageNumber, qImg):
+        self.thumbnails[pageNumber] = (qImg, self.pdf.history.revision)
+        self.pageCache.addThumbnail(pageNumber, qImg.sizeInBytes())
+
+    def dropThumbnail(self, pageNumber):
+        self.thumbnails.pop(pageNumber, None)
+        self.pageCache.removeThumbnail(pageNumber)
+
+    def keptThumbnail(self, pageNumber):
+        '''
+        Thumbnail of the page in memory, unless the page was changed since it was rendered
+        '''
+        qImg, revision = self.thumbnails.get(pageNumber, (None, 0))
+
+        if qImg is not None and self.pdf.history.pageRevision(pageNumber) > revision:
+            self.dropThumbnail(pageNumber)
+            return None
+
+        return qImg
+
+    def materializePages(self, firstVisible, lastVisible):
+        '''
+        Makes sure there are scene items for the pages around the visible ones. Items of pages farther away are recycled
+        '''
+        firstPage = max(0, firstVisible - self.MATERIALIZEDISTANCE)
+        lastPage = min(self.layout.pageCount() - 1, lastVisible + self.MATERIALIZEDISTANCE)
+
+        for pageNumber in [pageNumber for pageNumber in self.pages.keys() if pageNumber < firstPage or pageNumber > lastPage]:
+            self.releasePage(pageNumber)
+
+        for pageNumber in range(firstPage, lastPage + 1):
+            if pageNumber not in self.pages:
+                self.acquirePage(pageNumber)
+
+    def acquirePage(self, pageNumber):
+        '''
+        Places a (recycled) pdf view at the page position. It shows the thumbnail or a placeholder until it gets rendered
+        '''
+        x, y, width, height = self.layout.pageRect(pageNumber)
+
+        if self.recycledPages:
+            pdfView = self.recycledPages.pop()
+            newItem = False
+        else:
+            pdfView = QPdfView()
+            self.connectPageSignals(pdfView)
+            newItem = True
+
+        # Until the document is opened, see openDeferredPdf
+        page = None if self.pdfDeferred else self.pdf.getPage(pageNumber)
+        pdfView.setPage(page, pageNumber, self.pdf.history, self.pdf.journal)
+
+        # The disk cache doesn't know the document before it's hashed anyway
+        thumbnail = None if self.pdfDeferred else self.cachedThumbnail(pageNumber)
+
+        if thumbnail is not None:
+            self.keepThumbnail(pageNumber, thumbnail)
+            pdfView.setQImage(thumbnail, pageNumber, self.LOWRESZOOM)
+        else:
+            self.updateEmptyPdf(pdfView, width, height)
+
+        pdfView.setAsDraft()
+        pdfView.lastZoomFactor = -1
+        pdfView.requestedZoomFactor = -1
+
+        self.pages[pageNumber] = pdfView
+
+        pdfView.setPos(x, y)
+        pdfView.setAsOrigin()
+        pdfView.setVisible(True)
+
+        if newItem:
+            # add the new page to the scene
+            self.itemRenderFinished.emit(pdfView, x, y)
+
+    def documentReopened(self):
+        '''
+        The pdf was opened again after it was saved, the pdf views still hold pages of the previous document
+        '''
+        for pageNumber, pdfView in self.pages.items():
+            if type(pdfView) == QPdfView:
+                pdfView.setPage(self.pdf.getPage(pageNumber), pageNumber, self.pdf.history, self.pdf.journal)
+
+    def releasePage(self, pageNumber, force=False):
+        '''
+        Hands the pdf view of the page back for recycling. Pages which are edited right now are kept unless forced
+        '''
+        pdfView = self.pages.get(pageNumber)
+
+        if type(pdfView) != QPdfView or (pdfView.ongoingEdit and not force):
+            return
+
+        del self.pages[pageNumber]
+
+        # Strokes of the overlay must not get lost with the page image
+        pdfView.commitInk()
+        pdfView.committedInk = []
+
+        if self.renderPool:
+            self.renderPool.cancel(pageNumber)
+
+        self.pageCache.remove(pageNumber)
+        self.dropThumbnail(pageNumber)
+
+        pdfView.setVisible(False)
+        pdfView.clearTiles()
+        pdfView.ongoingEdit = False
+
+        # Drop the page image
+        self.updateEmptyPdf(pdfView, 0, 0)
+
+        self.recycledPages.append(pdfView)
+
+    def releaseAllPages(self):
+        for pageNumber in list(self.pages.keys()):
+            self.releasePage(pageNumber, force=True)
+
+    def relayoutPages(self, pageNumber, delta=0):
+        '''
+        Called after a page was inserted (delta 1), deleted (delta -1) or resized (delta 0) at pageNumber.
+        Cached renderings of the following pages are moved along, those of the page itself are dropped
+        '''
+        self.releaseAllPages()
+
+        if delta > 0:
+            self.layout.insertPage(pageNumber, self.pdf.getPageSize(pageNumber))
+        elif delta < 0:
+            self.layout.removePage(pageNumber)
+        else:
+            self.layout.resizePage(pageNumber, self.pdf.getPageSize(pageNumber))
+
+        if delta == 0:
+            self.tileCache.invalidate(pageNumber)
+            self.diskCache.dropPage(pageNumber)
+        else:
+            self.tileCache.shiftPages(pageNumber, delta)
+            self.diskCache.shiftPages(pageNumber, delta)
+
+        self.layoutChanged.emit()
+
+    def connectPageSignals(self, page):
+        # # Connect event handlers
+        page.eh.requestTextInput.connect(self.parent.toolBoxTextInputRequestedEvent)
+        page.eh.addIndicatorPoint.connect(self.parent.addIndicatorPoint)
+        page.eh.deleteLastIndicatorPoint.connect(self.parent.deleteLastIndicatorPoint)
+        page.eh.inkPending.connect(self.parent.inkPending)
+
+        self.parent.settingsChanged.connect(page.settingsChangedReceiver)
+
+    def updatePage(self, pdfViewInstance, zoom, clip=None, off=None, thread=True):
+        '''
+        Update the provided pdf file at the desired page to render only the zoom and clip
+        This methods is used when instantiating the pdf and later, when performance optimization and zooming is required
+        '''
+
+        if thread:
+            # self.updatePageAsync(pdfViewInstance, zoom, clip, off)
+            # return
+            # print(time.time())
+            t = QTimer()
+            # t.singleShot(300, self.scrollTo)
+            t.singleShot(0, lambda: self.pageRenderStart.emit(pdfViewInstance, zoom))
+        else:
+            self.pageRenderStart.emit(pdfViewInstance, zoom)
+
+    def updateTiles(self, pdfViewInstance, zoom, visibleRect):
+        '''
+        Renders the tiles of the page which intersect the visible rect (in page coordinates).
+        Tiles are rendered for the zoom bucket closest to the provided zoom and taken from the tile cache if possible
+        '''
+        bucket = TileCache.zoomBucket(zoom)
+        tileZoom = TileCache.bucketZoom(bucket)
+
+        pdfViewInstance.setTileBucket(bucket)
+
+        visibleTiles = TileCache.tilesInRect(visibleRect.left(), visibleRect.top(), visibleRect.right(), visibleRect.bottom(), tileZoom)
+        pdfViewInstance.pruneTiles(visibleTiles)
+
+        for tx, ty in visibleTiles:
+            if (tx, ty) in pdfViewInstance.tiles:
+                continue
+
+            key = (pdfViewInstance.pageNumber, bucket, tx, ty)
+
+            tileImg = self.tileCache.get(key)
+            if tileImg is not None:
+                pdfViewInstance.addTile((tx, ty), self.tileRect(pdfViewInstance, tx, ty, tileZoom), tileImg)
+                continue
+
+            clip = self.tileRect(pdfViewInstance, tx, ty, tileZoom)
+
+            if self.useRenderPool(pdfViewInstance.pageNumber):
+                self.submitToRenderPool(pdfViewInstance.pageNumber, tileZoom, lambda qImg, zoom, pdfViewInstance=pdfViewInstance, key=key: self.applyRenderedTile(pdfViewInstance, key, qImg), clip=clip.getCoords(), key=key)
+                continue
+
+            try:
+                pixmap = self.pdf.renderPixmap(pdfViewInstance.pageNumber, mat=fitz.Matrix(tileZoom, tileZoom), clip=fitz.Rect(clip.getCoords()), invert=self.imageHelper.invertsPdf())
+            except RuntimeError as identifier:
+                print(str(identifier))
+                return
+
+            self.applyRenderedTile(pdfViewInstance, key, self.pdf.getQImage(pixmap))
+
+    def tileRect(self, pdfViewInstance, tx, ty, tileZoom):
+        '''
+        Returns the area of the tile in page coordinates, cropped to the page
+        '''
+        pageRect = pdfViewInstance.boundingRect()
+        x0, y0, x1, y1 = TileCache.tileRect(tx, ty, tileZoom)
+
+        return QRectF(QPointF(x0, y0), QPointF(min(x1, pageRect.right()), min(y1, pageRect.bottom())))
+
+    def applyRenderedTile(self, pdfViewInstance, key, qImg):
+        pageNumber, bucket, tx, ty = key
+
+        self.tileCache.put(key, qImg)
+
+        # The page might have been zoomed or recycled in the meantime
+        if self.pages.get(pageNumber) is pdfViewInstance and pdfViewInstance.tileBucket == bucket:
+            pdfViewInstance.addTile((tx, ty), self.tileRect(pdfViewInstance, tx, ty, TileCache.bucketZoom(bucket)), qImg)
+    
+    @Slot(QPdfView, int)
+    def updatePageAsync(self, pdfViewInstance, zoom, clip=None, off=None):
+        # Rendering needs the page before the start page was shown
+        self.openDeferredPdf()
+
+        clip = None
+        if clip:
+            try:
+                # qpos = QPointF(clip.x(), clip.y())
+                # fpos = pdfViewInstance.fromSceneCoordinates(qpos, zoom, clip.x(), clip.y())
+                qClip = pdfViewInstance.cropAndAlign(clip, zoom, off)
+                fClip = pdfViewInstance.qRectToFRect(qClip)
+                # fClip = None
+
+                
+            except Exception as identifier:
+                fClip = None
+
+        else:
+            fClip = None
+
+        pdfViewInstance.requestedZoomFactor = zoom
+
+        signature = None
+
+        if not fClip:
+            signature = self.pageSignature(pdfViewInstance.pageNumber)
+
+            if self.diskCache.contains(pdfViewInstance.pageNumber, zoom, signature, self.imageHelper.invertsPdf()):
+                # Pages which are not arranged yet need their geometry right away
+                if not pdfViewInstance.scene():
+                    cachedImg, cachedZoom = self.diskCache.load(pdfViewInstance.pageNumber, zoom, signature, self.imageHelper.invertsPdf())
+                    self.applyCachedImage(pdfViewInstance.pageNumber, pdfViewInstance, zoom, signature, cachedImg, cachedZoom)
+                    return
+
+                self.loadFromDiskCache(pdfViewInstance.pageNumber, zoom, signature, lambda qImg, cachedZoom, pageNumber=pdfViewInstance.pageNumber: self.applyCachedImage(pageNumber, pdfViewInstance, zoom, signature, qImg, cachedZoom))
+                return
+
+        self.renderPage(pdfViewInstance, zoom, fClip, signature)
+
+    def applyCachedImage(self, pageNumber, pdfViewInstance, zoom, signature, qImg, cachedZoom):
+        '''
+        Results of the disk cache might arrive later on, when the pdf view was recycled or zoomed again in the meantime.
+        Pages without a usable image are rendered
+        '''
+        if self.pages.get(pageNumber) is not pdfViewInstance or pdfViewInstance.requestedZoomFactor != zoom:
+            return
+
+        if qImg is not None:
+            if self.diskCache.matchesZoom(cachedZoom, zoom):
+                if self.renderPool:
+                    self.renderPool.cancel(pageNumber)
+
+                self.applyRenderedImage(pdfViewInstance, qImg, cachedZoom)
+                return
+
+            # Close enough to bridge the time until the rendering finished
+            if pdfViewInstance.isDraft:
+                pdfViewInstance.setQImage(qImg, pageNumber, cachedZoom)
+        else:
+            # The page might have been changed in the meantime
+            signature = self.pageSignature(pageNumber)
+
+        self.renderPage(pdfViewInstance, zoom, None, signature)
+
+    def renderPage(self, pdfViewInstance, zoom, fClip=None, signature=None):
+        '''
+        Renders the page in the render pool if possible, otherwise right away
+        '''
+        # Pages which are not arranged yet need their geometry right away, so those are rendered locally
+        if self.useRenderPool(pdfViewInstance.pageNumber) and not fClip and pdfViewInstance.scene():
+            revision = self.pdf.history.revision
+            self.submitToRenderPool(pdfViewInstance.pageNumber, zoom, lambda qImg, zoom, pageNumber=pdfViewInstance.pageNumber: self.applyPooledImage(pageNumber, pdfViewInstance, qImg, zoom, signature, revision))
+            return
+
+        # Rendered locally, so make sure a pending job doesn't overwrite this result
+        if self.renderPool:
+            self.renderPool.cancel(pdfViewInstance.pageNumber)
+
+        try:
+            pixmap = self.pdf.renderPixmap(pdfViewInstance.pageNumber, mat=fitz.Matrix(zoom, zoom), clip=fClip, invert=self.imageHelper.invertsPdf())
+        except RuntimeError as identifier:
+            print(str(identifier))
+            return
+
+        try:
+            qImg = self.pdf.getQImage(pixmap)
+        except ValueError as identifier:
+            return
+
+        self.applyRenderedImage(pdfViewInstance, qImg, zoom, fClip, signature)
+
+    def applyPooledImage(self, pageNumber, pdfViewInstance, qImg, zoom, signature=None, revision=None):
+        '''
+        Results of the render pool arrive later on. In the meantime the pdf view might have been recycled for another page
+        '''
+        if self.pages.get(pageNumber) is not pdfViewInstance:
+            return
+
+        self.applyRenderedImage(pdfViewInstance, qImg, zoom, signature=signature, revision=revision)
+
+    def applyRenderedImage(self, pdfViewInstance, qImg, zoom, fClip=None, signature=None, revision=None):
+        '''
+        Hands the rendered image over to the pdf view. The theme is already applied by the renderer.
+        Full page renderings are stored in the disk cache if the annotation signature is given.
+        revision is the history revision the rendering was started at, if it wasn't rendered right now
+        '''
+        qImg.setDevicePixelRatio(zoom)
+
+        if signature is not None and not fClip:
+            self.diskCache.store(pdfViewInstance.pageNumber, zoom, signature, qImg, self.imageHelper.invertsPdf())
+
+        
+
+        # if pdfViewInstance.pageNumber:
+        if fClip:
+            self.qp = QPainter(pdfViewInstance.qImg)
+            self.qp.drawImage(fClip.x0, fClip.y0, qImg)
+            self.qp.end()
+
+        pdfViewInstance.setQImage(qImg, pdfViewInstance.pageNumber, zoom)
+        pdfViewInstance.isDraft = False
+
+        pdfViewInstance.renderingFinished(self.pdf.history.revision if revision is None else revision)
+
+        self.pageCache.add(pdfViewInstance.pageNumber, pdfViewInstance.imageBytes())
+        self.evictPages()
+        # else:
+        #     if fClip:
+        #         qp = QPainter(pdfViewInstance.qImg)
+        #         qp.drawImage(fClip.x, fClip.y, qImg)
+
+        #     pdfViewInstance.updateQImage(qImg, zoom)
+
+        # if fClip != None:
+        #     xCorr = pdfViewInstance.xOrigin + off.x()
+        #     yCorr = pdfViewInstance.yOrigin + off.y()
+
+        #     pdfViewInstance.setPos(xCorr, yCorr)
+
+        # print(time.time()-start)
+
+    def updateEmptyPdf(self, pdfViewInstance, width, height):
+        '''
+        Update the provided pdf file at the desired page to render only the zoom and clip
+        This methods is used when instantiating the pdf and later, when performance optimization and zooming is required
+        '''
+
+        qImg = QImage(1, 1, QImage.Format_Mono)
+        qImg.fill(0)
+
+        if pdfViewInstance.pageNumber:
+            pdfViewInstance.setQImage(qImg, pdfViewInstance.pageNumber)
+        else:
+            pdfViewInstance.updateQImage(qImg)
+
+        pdfViewInstance.setPlaceholderSize(width, height)
+
+    def setVisibleRange(self, firstVisible, lastVisible):
+        self.visibleRange = (firstVisible, lastVisible)
+
+    def evictPages(self):
+        '''
+        Drops the images of pages far off the viewport once the page cache exceeds its budget
+        '''
+        for pageNumber in self.pageCache.evictionCandidates(*self.visibleRange):
+            pdfViewInstance = self.pages.get(pageNumber)
+
+            if type(pdfViewInstance) != QPdfView or pdfViewInstance.ongoingEdit:
+                self.pageCache.remove(pageNumber)
+                continue
+
+            self.evictPage(pdfViewInstance)
+
+    def evictPage(self, pdfViewInstance):
+        '''
+        Replaces the page image with the placeholder. The page gets rendered again once it's requested
+        '''
+        _, _, width, height = self.layout.pageRect(pdfViewInstance.pageNumber)
+
+        pdfViewInstance.clearTiles()
+
+        thumbnail = self.keptThumbnail(pdfViewInstance.pageNumber)
+
+        # Fall back to the thumbnail if there is one
+        if thumbnail is not None:
+            pdfViewInstance.setQImage(thumbnail, pdfViewInstance.pageNumber, self.LOWRESZOOM)
+        else:
+            self.updateEmptyPdf(pdfViewInstance, width, height)
+
+        pdfViewInstance.setAsDraft()
+        pdfViewInstance.lastZoomFactor = -1
+        pdfViewInstance.requestedZoomFactor = -1
+
+        self.pageCache.evict(pdfViewInstance.pageNumber)
+
+class GraphicsViewHandler(QGraphicsView):
+    # pages = IndexedOrderedDict()
+
+    updatePages = Signal()
+    renderPdf = Signal(int)
+
+    # absZoomFactor = float(1)
+    LOWRESZOOM = float(0.1)
+
+    # x, y, pageNumber, currentContent
+    requestTextInput = Signal(int, int, int, str)
+    changesMade = Signal(bool)
+    documentSaved = Signal(str)
+    # percent, stage of a save in the background
+    saveProgress = Signal(int, str)
+
+    settingsChanged = Signal()
+
+    tempObj = list()
+
+    colorOverride = False
+
+    lastZoomTime = 0.0
+    ZOOMSETTLETIME = 150 # ms
+    INKCOMMITDELAY = 1000 # ms without a new stroke until the pending ones are written to the pdf
+
+    def __init__(self, parent):
+        '''
+        Creates the graphic view handler instance, which is a main feature of the unote application
+
+        :param parent: Parent editor widget.
+        '''
+        QGraphicsView.__init__(self, parent)
+
+        self.gotoScrollPos = 0
+        self.startPage = 0
+
+        # self.pdf = pdfEngine()
+        # self.imageHelper = imageHelper()
+
+        self.setMouseTracking(True)
+        self.setTabletTracking(True)
+        self.setObjectName("graphicsView")
+        self.setRenderHint(QPainter.Antialiasing)
+        # Pages are scaled by the view transform while zooming, until they are rendered again
+        self.setRenderHint(QPainter.SmoothPixmapTransform)
+        self.setAttribute(Qt.WA_AcceptTouchEvents)
+        self.viewport().setAttribute(Qt.WA_AcceptTouchEvents)
+        # self.setDragMode(self.ScrollHandDrag)
+        # self.setFrameShape(QGraphicsView.NoFrame)
+        # # self.resize(parent.size())
+
+
+        self.scroller = QScroller.scroller(self.viewport())
+        self.scroller.grabGesture(self.viewport(), QScroller.TouchGesture)
+        self.scroller.stateChanged.connect(self.scrollerStateChanged)
+
+        self.scrollerProperties = self.scroller.scrollerProperties()
+        self.scrollerProperties.setScrollMetric(QScrollerProperties.VerticalOvershootPolicy, QScrollerProperties.OvershootAlwaysOff)
+
+        self.scrollerProperties.setScrollMetric(QScrollerProperties.HorizontalOvershootPolicy, QScrollerProperties.OvershootAlwaysOff)
+
+        self.scroller.setScrollerProperties(self.scrollerProperties)
+
+        self.rendererThread = QThread(parent)
+        self.rendererWorker = Renderer(self)
+
+        self.userFinishedTimer = QTimer()
+        self.userFinishedTimer.setSingleShot(True)
+        self.userFinishedTimer.timeout.connect(self.zoomFinished)
+
+        self.renderScheduler = RenderScheduler(self.renderScheduledPage)
+        self.lastWheelTime = 0.0
+
+        # Strokes are written to the pdf and rendered in batches
+        self.inkCommitTimer = QTimer()
+        self.inkCommitTimer.setSingleShot(True)
+        self.inkCommitTimer.timeout.connect(self.inkCommitTimeout)
+        self.pendingInkPage = -1
+
+        # Scene position of the viewport corner for mapping pointer events, see viewportOrigin
+        self.cachedViewportOrigin = None
+
+        # Pointer events are only recorded on request, for replaying them later
+        self.inputTrace = None
+        self.inputTracePath = None
+
+        # Documents which can't be saved incrementally are written in the background
+        self.documentSaver = DocumentSaver()
+        self.documentSaver.progress.connect(self.saveProgress)
+        self.documentSaver.finished.connect(self.fullSaveFinished)
+        self.documentSaver.failed.connect(self.fullSaveFailed)
+        self.saveQueued = False
+        # State of the document when its snapshot was taken, see startFullSave
+        self.savingPdf = None
+        self.savingFilename = None
+        self.savingDecision = None
+        self.savedChanges = 0
+        self.savedRevision = 0
+        self.savedJournalMark = 0
+        # The exit save failed, see terminate
+        self.keepRecovery = False
+
+        self.setupScene()
+
+        self.instructRenderer()
+
+
+    def paintEvent(self, event):
+
+
+        res = super().paintEvent(event)
+
+        return res
+
+    def terminate(self):
+        print("Terminating Viewer")
+
+        self.rendererThread.terminate()
+
+        if toBool(Preferences.data['radioButtonSaveOnExit']):
+            if self.rendererWorker.pdf.history.recentChanges != 0:
+                self.saveCurrentPdf(compact=False)
+
+        # Quitting would leave the document as it was before the running save
+        while self.documentSaver.isBusy():
+            self.documentSaver.wait()
+
+        # Unless the changes were saved or left unsaved on purpose, the journal and autosave recover them next time, see AutoSaver.terminate
+        saveOnExit = toBool(Preferences.data['radioButtonSaveOnExit'])
+        self.keepRecovery = saveOnExit and self.rendererWorker.pdf.history.recentChanges != 0
+
+        if self.keepRecovery:
+            print('Unable to save the pdf on exit, the changes are kept for recovery')
+        else:
+            self.rendererWorker.pdf.journal.discard()
+
+        self.rendererWorker.pdf.journal.terminate()
+
+        self.rendererWorker.stopDocumentLoader()
+        self.rendererWorker.stopRenderPool()
+        self.rendererWorker.diskCache.terminate()
+
+        print(self.rendererWorker.pageCache.report())
+
+        self.stopInputRecording()
+
+    def startInputRecording(self, path):
+        '''
+        Records all pointer events to the provided csv file, see replayPerfTest.py
+        '''
+        self.inputTrace = InputTrace()
+        self.inputTracePath = path
+
+    def stopInputRecording(self):
+        if self.inputTrace is None:
+            return
+
+        self.inputTrace.save(self.inputTracePath)
+        print('Recorded ' + str(len(self.inputTrace)) + ' input events to ' + self.inputTracePath)
+
+        self.inputTrace = None
+
+    def recordInput(self, source, eventType, localPos, pressure=0.0, button=0):
+        '''
+        Stores the viewport position of an event as scene position
+        '''
+        scenePos = localPos / self.rendererWorker.absZoomFactor + self.viewportOrigin()
+
+        self.inputTrace.record(source, eventType, scenePos.x(), scenePos.y(), pressure, int(button))
+
+    def setupScene(self):
+        self.scene = QGraphicsScene()
+        self.setScene(self.scene)
+
+        self.setAlignment(Qt.AlignLeft | Qt.AlignTop)
+
+
+    def createNewPdf(self, fileName):
+        '''
+        Creates a new PDf from the given fileName
         '''
         self.rendererWorker.pdf.newPdf(fileName)
 
         self.loadPdfToCurrentView(fileName)
 
-    def saveCurrentPdf(self, cleanup=True):
+    def saveCurrentPdf(self, cleanup=True, compact=True):
         '''
-        Just handles saving the pdf
+        Appends the changes to the pdf or writes it as a whole in the background, as decided by the SavePlanner.
+        Without changes the pdf is cleaned up and compressed. Returns the filename if the pdf was saved right away
         '''
-        if self.rendererWorker.pdf.filename:
-            if History.recentChanges != 0 or cleanup == False:
-                return self.rendererWorker.pdf.savePdf()
-            else:
-                print("Cleaning up pdf")
-                return self.rendererWorker.pdf.savePdf(cleanup=True)
+        self.commitPendingInk()
+
+        pdf = self.rendererWorker.pdf
+
+        if not pdf.filename:
+            return None
+
+        # Saved again once the running save is done
+        if self.documentSaver.isBusy():
+            self.saveQueued = True
+            return None
+
+        decision = pdf.savePlanner.plan(pdf, cleanup)
+
+        if decision.mode == SavePlanner.INCREMENTAL:
+            saveStart = time.perf_counter()
+            fileName = pdf.savePdf()
+
+            if fileName:
+                pdf.savePlanner.incrementalSaved(decision, time.perf_counter() - saveStart, SavePlanner.fileSize(fileName))
+
+                self.rendererWorker.reloadRenderPool(fileName)
+                self.rendererWorker.diskCache.rekey(fileName, pdf.history.pageRevisions)
+
+                pdf.journal.reset(pdf.filename)
+                pdf.history.resetHistoryChanges()
+                pdf.history.pagesSaved()
+                self.documentSaved.emit(pdf.filename)
+
+                # The appended revisions are merged in the background
+                compaction = pdf.savePlanner.needsCompaction(SavePlanner.fileSize(fileName)) if compact else None
+                if compaction:
+                    self.startFullSave(compaction)
+
+                return fileName
+
+            decision = pdf.savePlanner.incrementalFailed(decision)
+
+        self.startFullSave(decision)
+
+        return None
+
+    def startFullSave(self, decision):
+        '''
+        Hands a snapshot of the pdf to the DocumentSaver. Changes made while saving are kept for the next save
+        '''
+        pdf = self.rendererWorker.pdf
+
+        snapshotStart = time.perf_counter()
+        data = pdf.snapshot()
+        decision.snapshotTime = time.perf_counter() - snapshotStart
+
+        if not data:
+            return
+
+        self.savingDecision = decision
+        self.savingPdf = pdf
+        self.savingFilename = pdf.filename
+        self.savedChanges = pdf.history.recentChanges
+        self.savedRevision = pdf.history.revision
+        self.savedJournalMark = pdf.journal.mark()
+
+        self.documentSaver.start(data, pdf.filename, pdf.FULLSAVEOPTIONS)
+
+    @Slot(str, int)
+    def fullSaveFinished(self, savedFileName, size):
+        pdf = self.rendererWorker.pdf
+
+        print('PDF saved in the background within %.2f seconds (%.1f MB)' % (self.documentSaver.elapsed(), size / 1e6))
+
+        self.savingPdf.savePlanner.fullSaved(self.savingDecision, self.savingDecision.snapshotTime + self.documentSaver.elapsed(), size)
+
+        # Another document was opened or this one saved under another name meanwhile
+        if pdf is not self.savingPdf or pdf.filename != self.savingFilename:
+            self.saveQueued = False
+            return
+
+        changed = pdf.history.revision != self.savedRevision
+
+        if changed:
+            pdf.history.recentChanges -= self.savedChanges
+
+            # Net zero, but still different from the saved pdf
+            if pdf.history.recentChanges == 0:
+                pdf.history.recentChanges = 1
+        else:
+            pdf.history.resetHistoryChanges()
+
+        if pdf.fullSaveDone(savedFileName, reopen=not changed and not self.isEditing()):
+            self.rendererWorker.documentReopened()
+
+        # With the file still in use, the journal stays with the previous version of it
+        if savedFileName == pdf.filename:
+            pdf.journal.reset(pdf.filename, since=self.savedJournalMark if changed else None)
+
+        self.rendererWorker.reloadRenderPool(savedFileName)
+        self.rendererWorker.diskCache.rekey(savedFileName, pdf.history.pageRevisions)
+        pdf.history.pagesSaved(self.savedRevision)
+
+        self.documentSaved.emit(pdf.filename)
+        self.changesMade.emit(pdf.history.recentChanges != 0)
+
+        if self.saveQueued:
+            self.saveQueued = False
+            self.saveCurrentPdf()
+
+    @Slot(str)
+    def fullSaveFailed(self, message):
+        print('Unable to save the pdf: ' + message)
+
+        self.saveQueued = False
+        self.saveProgress.emit(100, 'Failed')
 
     def saveCurrentPdfAs(self, fileName):
         '''
         Just handles saving the pdf
         '''
+        self.commitPendingInk()
+
+        previousFileName = self.rendererWorker.pdf.filename
+
         self.rendererWorker.pdf.savePdfAs(fileName)
         print('PDF saved as\t' + fileName)
 
+        self.rendererWorker.reloadRenderPool(self.rendererWorker.pdf.filename)
+        self.rendererWorker.pdf.history.pagesSaved()
+
+        # The changes are saved, even though not to the previous file
+        if previousFileName:
+            self.rendererWorker.pdf.journal.reset(previousFileName)
+            self.documentSaved.emit(previousFileName)
+        self.rendererWorker.pdf.journal.reset(self.rendererWorker.pdf.filename)
+        self.documentSaved.emit(self.rendererWorker.pdf.filename)
+
+    def isEditing(self):
+        '''
+        True while a stroke, marking or form is drawn on one of the pages
+        '''
+        return any(pdfView.ongoingEdit for pdfView in self.rendererWorker.pages.values())
+
     def loadPdfToCurrentView(self, pdfFilePath, startPage=0):
         '''
-        Renderes the whole pdf file in the current graphic view instance
+        Renderes the whole pdf file in the current graphic view instance.
+        The file is opened in the background, the start page is shown as soon as it's rendered
         '''
         self.start_time = time.time()
+        self.startPage = startPage
 
-        self.rendererWorker.pdf.openPdf(pdfFilePath)
-
-        self.renderPdfToCurrentView(startPage)
+        self.rendererWorker.loadPdfAsync(pdfFilePath, startPage)
 
     def loadPdfInstanceToCurrentView(self, pdfInstance, startPage=0):
         self.start_time = time.time()
@@ -1756,6 +3128,12 @@ class GraphicsViewHandler(QGraphicsView):
         self.renderPdf.connect(self.rendererWorker.renderPdfToCurrentView, Qt.QueuedConnection)
         self.rendererWorker.itemRenderFinished.connect(self.retrieveRenderedItem, Qt.QueuedConnection)
         self.rendererWorker.pdfRenderFinished.connect(self.rendererFinished)
+        self.rendererWorker.layoutChanged.connect(self.layoutChanged)
+
+        self.verticalScrollBar().valueChanged.connect(self.updateVisiblePages)
+
+        self.verticalScrollBar().valueChanged.connect(self.invalidateViewportOrigin)
+        self.horizontalScrollBar().valueChanged.connect(self.invalidateViewportOrigin)
 
         self.rendererWorker.absZoomFactor = self.rendererWorker.absZoomFactor
 
@@ -1763,9 +3141,9 @@ class GraphicsViewHandler(QGraphicsView):
 
     @Slot(QPdfView, int, int)
     def retrieveRenderedItem(self, renderedItem, posX, posY):
-        self.scene.addItem(renderedItem)
-        renderedItem.setPos(posX, posY)
-        renderedItem.setAsOrigin()
+        # The item is already arranged by the renderer and might even have been recycled for another page in the meantime
+        if renderedItem.scene() is None:
+            self.scene.addItem(renderedItem)
 
 
 
@@ -1780,6 +3158,38 @@ class GraphicsViewHandler(QGraphicsView):
         t.singleShot(600, self.updateRenderedPages)
 
 
+    @Slot()
+    def layoutChanged(self):
+        layout = self.rendererWorker.layout
+
+        self.scene.setSceneRect(0, 0, layout.width(), layout.height())
+
+        self.updateVisiblePages()
+
+    def visiblePageRange(self):
+        '''
+        Returns the first and the last page within the viewport, or (-1, -1) without a document
+        '''
+        sRect = self.mapToScene(self.viewport().rect()).boundingRect()
+
+        return self.rendererWorker.layout.pagesInRange(sRect.top(), sRect.bottom())
+
+    @Slot()
+    def updateVisiblePages(self):
+        '''
+        Creates the scene items of the pages which scroll into view. Rendering is left to updateRenderedPages
+        '''
+        lIdx, hIdx = self.visiblePageRange()
+
+        if lIdx < 0:
+            return
+
+        # Don't keep strokes of pages which were scrolled away in the overlay
+        if self.pendingInkPage >= 0 and not lIdx <= self.pendingInkPage <= hIdx:
+            self.commitPendingInk()
+
+        self.rendererWorker.materializePages(lIdx, hIdx)
+
     def scrollTo(self):
         if self.gotoScrollPos != 0:
             self.verticalScrollBar().setMaximum(self.verticalScrollBar().maximumHeight())
@@ -1805,46 +3215,91 @@ class GraphicsViewHandler(QGraphicsView):
         #     self.lastZoomTime = time.time()
 
 
-        # Get all visible pages
-        try:
-            renderedItems = self.scene.items(self.mapToScene(self.viewport().geometry()))
-        except Exception as identifier:
-            print(str(identifier))
+        lIdx, hIdx = self.visiblePageRange()
+
+        if lIdx < 0:
             return
 
-        if onlyPage != -1:
-            for renderedItem in renderedItems:
-                if renderedItem.pageNumber == onlyPage:
-                    self.rendererWorker.updatePage(renderedItem, zoom=self.rendererWorker.absZoomFactor, clip=self.viewport().geometry(), off=self.mapToScene(self.viewport().geometry()).boundingRect())
-                    return
+        self.rendererWorker.materializePages(lIdx, hIdx)
 
-        hIdx = 1
-        lIdx = len(self.rendererWorker.pages)
+        if onlyPage >= lIdx and onlyPage <= hIdx:
+            self.renderScheduler.scheduleUrgent(onlyPage, self.rendererWorker.absZoomFactor)
+            return
 
-        # Iterate all visible items (shouldn't be that much normally)
-        for renderedItem in renderedItems:
-            # Check if we have a pdf view here (visible could be anything)
-            if type(renderedItem) != QPdfView:
-                continue
+        for pageNumber in range(lIdx, hIdx + 1):
+            if self.pageNeedsRender(pageNumber, True) or force:
+                self.rendererWorker.pageCache.miss()
+            else:
+                self.rendererWorker.pageCache.hit(pageNumber)
 
-            if renderedItem.lastZoomFactor == self.rendererWorker.absZoomFactor and not force:
-                return
+        self.rendererWorker.setVisibleRange(lIdx, hIdx)
 
-            if renderedItem.pageNumber > hIdx:
-                hIdx = renderedItem.pageNumber
-            if renderedItem.pageNumber < lIdx:
-                lIdx = renderedItem.pageNumber
+        self.renderScheduler.schedule(lIdx, hIdx, self.rendererWorker.layout.pageCount(), self.rendererWorker.absZoomFactor, self.pageNeedsRender, force)
 
-            self.rendererWorker.updatePage(renderedItem, zoom=self.rendererWorker.absZoomFactor, clip=self.viewport().geometry(), off=self.mapToScene(self.viewport().geometry()).boundingRect())
+        self.lastZoomTime = time.time()
+
+    def pageNeedsRender(self, pageNumber, visible):
+        '''
+        Checks if the page has neither been rendered nor requested for the current zoom
+        '''
+        pdfViewInstance = self.rendererWorker.pages.get(pageNumber)
 
-        for pIt in [lIdx-3,lIdx-2,lIdx-1,hIdx+1,hIdx+2,hIdx+3]:
-            if pIt > -1 and pIt < len(self.rendererWorker.pages):
-                if self.rendererWorker.pages[pIt].isDraft:
-                    self.rendererWorker.updatePage(self.rendererWorker.pages[pIt], zoom=self.rendererWorker.absZoomFactor, clip=self.viewport().geometry(), off=self.mapToScene(self.viewport().geometry()).boundingRect())
+        if type(pdfViewInstance) != QPdfView:
+            return False
 
-                    self.rendererWorker.pages[pIt].isDraft = False
+        zoom = self.rendererWorker.absZoomFactor
 
-        self.lastZoomTime = time.time()
+        if zoom > self.rendererWorker.TILEZOOM:
+            # Visible tiles have to follow the viewport. Off screen pages never need more than the base image
+            return visible or pdfViewInstance.requestedZoomFactor != self.rendererWorker.TILEZOOM
+
+        return pdfViewInstance.requestedZoomFactor != zoom
+
+    def renderScheduledPage(self, pageNumber, zoom, visible, force):
+        '''
+        Called by the render scheduler for every job
+        '''
+        pdfViewInstance = self.rendererWorker.pages.get(pageNumber)
+
+        if type(pdfViewInstance) != QPdfView:
+            return
+
+        # Superseded by another zoom in the meantime
+        if zoom != self.rendererWorker.absZoomFactor:
+            return
+
+        if visible:
+            self.updateRenderedPage(pdfViewInstance, force)
+        else:
+            self.rendererWorker.updatePage(pdfViewInstance, zoom=min(zoom, self.rendererWorker.TILEZOOM), thread=False)
+
+    def updateRenderedPage(self, renderedItem, force=False):
+        '''
+        Renders a single visible page. Above the tile zoom, the page image is kept at the tile zoom and only the visible tiles are rendered at full resolution
+        '''
+        zoom = self.rendererWorker.absZoomFactor
+
+        if force:
+            self.rendererWorker.tileCache.invalidate(renderedItem.pageNumber)
+            renderedItem.clearTiles()
+
+        if zoom > self.rendererWorker.TILEZOOM:
+            if force or renderedItem.requestedZoomFactor != self.rendererWorker.TILEZOOM:
+                self.rendererWorker.updatePage(renderedItem, zoom=self.rendererWorker.TILEZOOM, thread=False)
+
+            self.rendererWorker.updateTiles(renderedItem, zoom, self.visibleItemRect(renderedItem))
+        else:
+            renderedItem.clearTiles()
+
+            self.rendererWorker.updatePage(renderedItem, zoom=zoom, clip=self.viewport().geometry(), off=self.mapToScene(self.viewport().geometry()).boundingRect(), thread=False)
+
+    def visibleItemRect(self, item):
+        '''
+        Returns the visible part of the item in item coordinates
+        '''
+        sceneRect = self.mapToScene(self.viewport().rect()).boundingRect()
+
+        return item.mapRectFromScene(sceneRect).intersected(item.boundingRect())
 
     def getPageSize(self, page=0):
         return self.rendererWorker.pdf.getPageSize(0)
@@ -1879,14 +3334,13 @@ class GraphicsViewHandler(QGraphicsView):
                 else:
                     relZoomFactor = 1
 
-                self.rendererWorker.absZoomFactor = self.rendererWorker.absZoomFactor * relZoomFactor
-                self.scale(relZoomFactor, relZoomFactor)
+                self.applyZoom(relZoomFactor)
 
-                self.updateIndicator = True
+        recentChanges = self.rendererWorker.pdf.history.recentChanges
 
-        if History.recentChanges == 1:
+        if recentChanges == 1:
             self.changesMade.emit(True)
-        elif History.recentChanges == 0:
+        elif recentChanges == 0:
             self.changesMade.emit(False)
 
         return super().viewportEvent(event)
@@ -1895,8 +3349,6 @@ class GraphicsViewHandler(QGraphicsView):
         '''
         Overrides the default event
         '''
-        self.rendererWorker.stopBackgroundRenderer()
-
         if not self.scene:
             return
 
@@ -1914,51 +3366,70 @@ class GraphicsViewHandler(QGraphicsView):
             else:
                 relZoomFactor = zoomOutFactor
 
-            self.rendererWorker.absZoomFactor = self.rendererWorker.absZoomFactor * relZoomFactor
-            self.scale(relZoomFactor, relZoomFactor)
-
-            # if time.time() - lastZoomTime > 1
+            self.applyZoom(relZoomFactor)
 
+        else:
+            scrollPos = self.verticalScrollBar().value()
 
-            # if time.time() - self.lastZoomTime < 0.1 or time.time() - self.lastZoomTime > 2:
-            #     self.userFinishedTimer.stop()
-            #     print(time.time() - self.lastZoomTime)
+            super(GraphicsViewHandler, self).wheelEvent(event)
 
+            self.updateScrollVelocity(self.verticalScrollBar().value() - scrollPos)
 
-            # self.userFinishedTimer.singleShot(120, self.updateRenderedPages)
-            
-            
-            
-            # t.singleShot(300, self.scrollTo)
+            # Pages are rendered once the zoom gesture is finished
+            if not self.userFinishedTimer.isActive():
+                self.updateRenderedPages()
 
-        else:
-            super(GraphicsViewHandler, self).wheelEvent(event)
+    def applyZoom(self, relZoomFactor):
+        '''
+        Zooms by scaling the current page images with the view transform.
+        The pages are rendered again only once the zoom settled for ZOOMSETTLETIME
+        '''
+        self.rendererWorker.absZoomFactor = self.rendererWorker.absZoomFactor * relZoomFactor
+        self.scale(relZoomFactor, relZoomFactor)
 
-            # if not self.userFinishedTimer.isActive():
+        self.invalidateViewportOrigin()
 
+        self.userFinishedTimer.start(self.ZOOMSETTLETIME)
 
+    @Slot()
+    def zoomFinished(self):
         self.updateRenderedPages()
 
-        # self.updateIndicator = True
-        # self.rendererWorker.enableBackgroundRenderer()
+    def updateScrollVelocity(self, delta):
+        '''
+        Estimates the scroll velocity from the scroll delta since the last wheel event
+        '''
+        now = time.time()
+
+        # A new scroll gesture starts from standstill
+        dt = min(max(now - self.lastWheelTime, 0.016), 0.5)
+        self.lastWheelTime = now
 
+        self.renderScheduler.updateVelocity(delta / dt)
 
-    # def mousePressEvent(self, event):
-    #     '''
-    #     Overrides the default event
-    #     '''
-    #     self.rendererWorker.stopBackgroundRenderer()
+    def mousePressEvent(self, event):
+        '''
+        Overrides the default event
+        '''
+        # No background rendering while the user is drawing
+        if event.button() == Qt.LeftButton and editMode != editModes.none:
+            self.renderScheduler.pause()
 
-    #     super(GraphicsViewHandler, self).mousePressEvent(event)
+        if self.inputTrace is not None:
+            self.recordInput(InputEvent.MOUSE, InputEvent.PRESS, event.localPos(), button=event.button())
 
-    #     self.rendererWorker.enableBackgroundRenderer()
+        super(GraphicsViewHandler, self).mousePressEvent(event)
 
 
     def mouseReleaseEvent(self, event):
         '''
         Overrides the default event
         '''
-        self.rendererWorker.stopBackgroundRenderer()
+        self.renderScheduler.resume()
+
+        if self.inputTrace is not None:
+            self.recordInput(InputEvent.MOUSE, InputEvent.RELEASE, event.localPos(), button=event.button())
+
         modifiers = QApplication.keyboardModifiers()
 
         Mmodo = QApplication.mouseButtons()
@@ -1970,13 +3441,12 @@ class GraphicsViewHandler(QGraphicsView):
                 item.insertContent(event.pos(), self.rendererWorker.absZoomFactor, rect.x(), rect.y())
         else:
             item = self.itemAt(event.pos())
-            if type(item) == QPdfView:
+            # Pending strokes are rendered with their batch
+            if type(item) == QPdfView and not item.pendingInk:
                 # if item.ongoingEdit:
                 self.updateRenderedPages(item.pageNumber, force=True)
                 # item.clearTempPoints()
-        # self.rendererWorker.stopBackgroundRenderer()
 
-        self.rendererWorker.enableBackgroundRenderer()
         super(GraphicsViewHandler, self).mouseReleaseEvent(event)
 
 
@@ -1985,13 +3455,11 @@ class GraphicsViewHandler(QGraphicsView):
         '''
         Overrides the default event
         '''
-        self.rendererWorker.stopBackgroundRenderer()
+        if self.inputTrace is not None:
+            self.recordInput(InputEvent.MOUSE, InputEvent.MOVE, event.localPos(), button=event.buttons())
 
         super(GraphicsViewHandler, self).mouseMoveEvent(event)
 
-        if self.updateIndicator:
-            self.updateRenderedPages()
-            self.updateIndicator = False
         # if self.touching:
         #     distance = self.touching - event.pos()
         #     deltaX = int(distance.x())
@@ -2002,12 +3470,12 @@ class GraphicsViewHandler(QGraphicsView):
 
         #     self.touching = event.pos()
 
-        self.rendererWorker.enableBackgroundRenderer()
-
 
     @Slot(QScroller.State)
     def scrollerStateChanged(self, newState):
-        if newState == QScroller.Inactive:
+        if newState == QScroller.Scrolling:
+            self.renderScheduler.updateVelocity(self.scroller.velocity().y())
+        elif newState == QScroller.Inactive:
             self.updateRenderedPages()
 
 
@@ -2016,27 +3484,27 @@ class GraphicsViewHandler(QGraphicsView):
         Overrides the default event
         '''
         # self.updateRenderedPages()
-        self.rendererWorker.stopBackgroundRenderer()
-
         super(GraphicsViewHandler, self).keyPressEvent(event)
 
-        self.rendererWorker.enableBackgroundRenderer()
-
 
     def keyReleaseEvent(self, event):
         '''
         Overrides the default event
         '''
-        self.rendererWorker.stopBackgroundRenderer()
-
         self.updateRenderedPages(force=True)
 
         super(GraphicsViewHandler, self).keyReleaseEvent(event)
 
-        self.rendererWorker.enableBackgroundRenderer()
-
     def tabletEvent(self, event):
-        self.rendererWorker.stopBackgroundRenderer()
+        # No background rendering while the user is drawing
+        if event.type() == QEvent.Type.TabletPress:
+            self.renderScheduler.pause()
+        elif event.type() == QEvent.Type.TabletRelease:
+            self.renderScheduler.resume()
+
+        if self.inputTrace is not None:
+            eventType = {QEvent.Type.TabletPress: InputEvent.PRESS, QEvent.Type.TabletRelease: InputEvent.RELEASE}.get(event.type(), InputEvent.MOVE)
+            self.recordInput(InputEvent.TABLET, eventType, self.mapFromGlobalHighRes(event.pos(), event.globalPos(), event.hiResGlobalX(), event.hiResGlobalY()), event.pressure(), event.buttons())
 
         item = self.itemAt(event.pos())
         if type(item) == QPdfView:
@@ -2045,12 +3513,12 @@ class GraphicsViewHandler(QGraphicsView):
             # elif event.buttons() == Qt.LeftButton:
 
 
-            # get the rectable of the current viewport
-            rect = self.mapToScene(self.viewport().geometry()).boundingRect()
+            # get the origin of the current viewport
+            origin = self.viewportOrigin()
             # Store those properties for easy access
-            item.tabletEvent(event.type(), event.pressure(), self.mapFromGlobalHighRes(event.pos(), event.globalPos(), event.hiResGlobalX(), event.hiResGlobalY()), self.rendererWorker.absZoomFactor, rect.x(), rect.y())
+            item.tabletEvent(event.type(), event.pressure(), self.mapFromGlobalHighRes(event.pos(), event.globalPos(), event.hiResGlobalX(), event.hiResGlobalY()), self.rendererWorker.absZoomFactor, origin.x(), origin.y())
 
-            if event.type() == QEvent.Type.TabletRelease:
+            if event.type() == QEvent.Type.TabletRelease and not item.pendingInk:
                 self.updateRenderedPages(item.pageNumber, force=True)
 
             #     if self.colorOverride:
@@ -2069,11 +3537,31 @@ class GraphicsViewHandler(QGraphicsView):
 
                 #     item.editMode = editModes.eraser
 
-        self.rendererWorker.enableBackgroundRenderer()
-
 
         return super(GraphicsViewHandler, self).tabletEvent(event)
 
+    def viewportOrigin(self):
+        '''
+        Scene position of the top left corner of the viewport. Mapping the viewport polygon for every pointer event is expensive,
+        so it's cached until the view is scrolled, zoomed or resized
+        '''
+        if self.cachedViewportOrigin is None:
+            self.cachedViewportOrigin = self.mapToScene(self.viewport().geometry()).boundingRect().topLeft()
+
+        return self.cachedViewportOrigin
+
+    @Slot()
+    def invalidateViewportOrigin(self):
+        self.cachedViewportOrigin = None
+
+    def resizeEvent(self, event):
+        '''
+        Overrides the default event
+        '''
+        self.invalidateViewportOrigin()
+
+        super(GraphicsViewHandler, self).resizeEvent(event)
+
     def mapFromGlobalHighRes(self, localPos, globalPos, globalHighResPosX, globalHighResPosY):
         # get high res global pos (floatPoint)
         highResGlobalQPos = QPointF(globalHighResPosX, globalHighResPosY)
@@ -2116,155 +3604,68 @@ class GraphicsViewHandler(QGraphicsView):
         return newRect
 
     def pageInsertHere(self):
-        # Get all visible pages
-        try:
-            renderedItems = self.scene.items(self.mapToScene(self.viewport().geometry()))
-        except Exception as e:
-            return
-
-        # Iterate all visible items (shouldn't be that much normally)
-        for renderedItem in reversed(renderedItems):
-            # Check if we have a pdf view here (visible could be anything)
-            if type(renderedItem) != QPdfView:
-                continue
+        pIt = self.getCurrentPageNumber()
 
-
-
-            # Ok this needs to be reworked since there is to much overhead for just inserting a single page
-
-            # fileName = self.saveCurrentPdf()
-            # self.rendererWorker.pdf.closePdf()
-            # os.replace(fileName, self.rendererWorker.pdf.filename)
-
-            # prevScroll = self.verticalScrollBar().value()
-
-            # self.setupScene()
-
-            # self.loadPdfToCurrentView(self.rendererWorker.pdf.filename, renderedItem.pageNumber+2)
-
-            x1, y1 = renderedItem.getEndPos()
-            width, height = renderedItem.getSize()
-            pIt = renderedItem.pageNumber+1
-
-            # Insert after current page
-            newPage = self.rendererWorker.pdf.insertPage(pIt)
-
-            self.rendererWorker.loadPdfPageToCurrentView(pIt, 0, y1 + self.rendererWorker.DEFAULTPAGESPACE, self.rendererWorker.absZoomFactor)
-
-            self.saveCurrentPdf(cleanup=False)
-
-            items = self.scene.items()
-
-
-            for item in items:
-                if type(item) != QPdfView:
-                    continue
-
-                if item.pageNumber >= pIt:
-
-                    item.pageNumber += 1
-                    item.yOrigin = item.hOrigin + height + self.rendererWorker.DEFAULTPAGESPACE
-                    item.setPos(item.x(), item.y() + (height+self.rendererWorker.DEFAULTPAGESPACE))
-
-            return
-
-    def pageExtendActive(self):
-        # Get all visible pages
-        try:
-            renderedItems = self.scene.items(self.mapToScene(self.viewport().geometry()))
-        except Exception as e:
+        if pIt is None:
             return
 
-        # Iterate all visible items (shouldn't be that much normally)
-        for renderedItem in reversed(renderedItems):
-            # Check if we have a pdf view here (visible could be anything)
-            if type(renderedItem) != QPdfView:
-                continue
-
-            renderedItem.page = self.rendererWorker.pdf.resizePage(renderedItem.page, 10, 10)
-
+        # Insert after current page
+        self.rendererWorker.pdf.insertPage(pIt + 1)
 
-            # self.updateRenderedPages()
+        self.rendererWorker.relayoutPages(pIt + 1, 1)
 
-            # self.gotoScrollPos = prevScroll/
+        self.saveCurrentPdf(cleanup=False)
 
-            return
+        self.updateRenderedPages()
 
+    def pageExtendActive(self):
+        pIt = self.getCurrentPageNumber()
 
-    def pageDeleteActive(self):
-        # Get all visible pages
-        try:
-            renderedItems = self.scene.items(self.mapToScene(self.viewport().geometry()))
-        except Exception as e:
+        if pIt is None:
             return
 
-        # Iterate all visible items (shouldn't be that much normally)
-        for renderedItem in reversed(renderedItems):
-            # Check if we have a pdf view here (visible could be anything)
-            if type(renderedItem) != QPdfView:
-                continue
-
-            x1, y1 = renderedItem.getEndPos()
-            width, height = renderedItem.getSize()
-            pIt = renderedItem.pageNumber
-
-            # Delete after current page
-            if self.rendererWorker.pdf.deletePage(pIt):
-
-                # fileName = self.saveCurrentPdf(cleanup=False)
-                # self.rendererWorker.pdf.closePdf()
-                # os.replace(fileName, self.rendererWorker.pdf.filename)
-
-                # prevScroll = self.verticalScrollBar().value()
-
-                # self.setupScene()
-
-                # self.loadPdfToCurrentView(self.rendererWorker.pdf.filename, renderedItem.pageNumber+1)
-
+        self.rendererWorker.pdf.resizePage(self.rendererWorker.pdf.getPage(pIt), 10, 10)
 
+        self.rendererWorker.relayoutPages(pIt)
 
+        self.updateRenderedPages()
 
-                items = self.scene.items()
-
-                for item in items:
-                    if type(item) != QPdfView:
-                        continue
-
-                    if item.pageNumber > pIt:
+    def pageDeleteActive(self):
+        pIt = self.getCurrentPageNumber()
 
-                        item.pageNumber -= 1
-                        item.yOrigin = item.hOrigin - height - self.rendererWorker.DEFAULTPAGESPACE
-                        item.setPos(item.x(), item.y() - (height-self.rendererWorker.DEFAULTPAGESPACE))
+        if pIt is None:
+            return False
 
-                self.rendererWorker.removePdfPageFromCurrentView(renderedItem)
+        # Delete current page
+        if self.rendererWorker.pdf.deletePage(pIt):
+            self.rendererWorker.relayoutPages(pIt, -1)
 
-                self.scene.removeItem(renderedItem)
+            self.saveCurrentPdf(cleanup=False)
 
-                self.saveCurrentPdf(cleanup=False)
+            self.updateRenderedPages()
 
-                return True
-            else:
-                return False
+            return True
+        else:
+            return False
 
     def getCurrentPageNumber(self):
-        # Get all visible pages
-        try:
-            renderedItems = self.scene.items(self.mapToScene(self.viewport().geometry()))
-        except Exception as e:
-            return
+        '''
+        Returns the page at the top of the viewport
+        '''
+        lIdx, _ = self.visiblePageRange()
 
-        # Iterate all visible items (shouldn't be that much normally)
-        for renderedItem in reversed(renderedItems):
-            # Check if we have a pdf view here (visible could be anything)
-            if type(renderedItem) != QPdfView:
-                continue
+        if lIdx < 0:
+            return None
 
-            return renderedItem.pageNumber
+        return lIdx
 
     def pageGoto(self, pageNumber=-1):
-        if self.rendererWorker.pages and pageNumber in range(len(self.rendererWorker.pages)):
+        pageCount = self.rendererWorker.layout.pageCount()
+
+        if pageNumber in range(pageCount):
             if pageNumber >= 1:
-                predictedScrollPos = self.rendererWorker.pages[pageNumber - 1].yOrigin * self.rendererWorker.absZoomFactor
+                _, y, _, _ = self.rendererWorker.layout.pageRect(pageNumber - 1)
+                predictedScrollPos = y * self.rendererWorker.absZoomFactor
                 self.verticalScrollBar().setValue(predictedScrollPos)
             else:
                 self.verticalScrollBar().setValue(0)
@@ -2274,7 +3675,7 @@ class GraphicsViewHandler(QGraphicsView):
             self.updateRenderedPages()
 
         else:
-            if self.rendererWorker.pages and self.startPage in range(len(self.rendererWorker.pages)):
+            if self.startPage in range(pageCount):
                 self.pageGoto(self.startPage)
             else:
                 print('No valid page entered')
@@ -2290,32 +3691,26 @@ class GraphicsViewHandler(QGraphicsView):
     def zoomIn(self):
         zoomInFactor = 1.1
 
-        self.rendererWorker.absZoomFactor = self.rendererWorker.absZoomFactor * zoomInFactor
-        self.scale(zoomInFactor, zoomInFactor)
-
-        self.updateRenderedPages()
+        self.applyZoom(zoomInFactor)
 
     def zoomOut(self):
         zoomInFactor = 1.1
         zoomOutFactor = 1 / zoomInFactor
 
-        self.rendererWorker.absZoomFactor = self.rendererWorker.absZoomFactor * zoomOutFactor
-        self.scale(zoomOutFactor, zoomOutFactor)
-
-        self.updateRenderedPages()
+        self.applyZoom(zoomOutFactor)
 
     def zoomToFit(self):
-        pSize = self.getPageSize()
+        pageWidth = self.rendererWorker.layout.width()
+
+        if not pageWidth:
+            return
 
         rect = self.mapToScene(self.viewport().geometry()).boundingRect()
             # Store those properties for easy access
 
-        ratio = rect.width() / pSize[0]
+        ratio = rect.width() / pageWidth
 
-        self.rendererWorker.absZoomFactor = self.rendererWorker.absZoomFactor * ratio
-        self.scale(ratio, ratio)
-
-        self.updateRenderedPages()
+        self.applyZoom(ratio)
 
     @Slot(int, int, int, bool, str)
     def toolBoxTextInputEvent(self, x, y, pageNumber, result, content):
@@ -2357,6 +3752,46 @@ class GraphicsViewHandler(QGraphicsView):
         self.tempObj[-1].setBrush(QBrush(QColor(*rgb.fore), style = Qt.SolidPattern))
         self.scene.addItem(self.tempObj[-1])
 
+    @Slot(int)
+    def inkPending(self, pageNumber):
+        '''
+        A stroke was added to the overlay of the page. Strokes are written to the pdf once the user pauses or continues on another page
+        '''
+        if self.pendingInkPage not in (-1, pageNumber):
+            self.commitPendingInk()
+
+        self.pendingInkPage = pageNumber
+
+        try:
+            delay = int(Preferences.data['inkCommitDelay'])
+        except (KeyError, ValueError):
+            delay = self.INKCOMMITDELAY
+
+        self.inkCommitTimer.start(delay)
+
+    @Slot()
+    def inkCommitTimeout(self):
+        pdfView = self.rendererWorker.pages.get(self.pendingInkPage)
+
+        # Wait for the stroke which is drawn right now
+        if type(pdfView) == QPdfView and pdfView.ongoingEdit:
+            self.inkCommitTimer.start(self.INKCOMMITDELAY)
+            return
+
+        self.commitPendingInk()
+
+    def commitPendingInk(self):
+        '''
+        Writes the batch of pending strokes to the pdf and renders the page once for all of them
+        '''
+        pdfView = self.rendererWorker.pages.get(self.pendingInkPage)
+
+        self.inkCommitTimer.stop()
+        self.pendingInkPage = -1
+
+        if type(pdfView) == QPdfView and pdfView.commitInk():
+            self.updateRenderedPages(pdfView.pageNumber, force=True)
+
     @Slot()
     def deleteLastIndicatorPoint(self):
         try:
@@ -2372,6 +3807,36 @@ class GraphicsViewHandler(QGraphicsView):
     def updateSuggested(self):
         self.updateRenderedPages(force=True)
 
+    @Slot()
+    def undo(self):
+        self.applyHistory(self.rendererWorker.pdf.history.undo)
+
+    @Slot()
+    def redo(self):
+        self.applyHistory(self.rendererWorker.pdf.history.redo)
+
+    def applyHistory(self, step):
+        '''
+        History entries are applied to the pdf view of their page.
+        Pages which have no scene item right now are edited through a detached pdf view, which writes its ink right away
+        '''
+        detached = []
+
+        def pageEditor(pageNumber):
+            pdfView = self.rendererWorker.pages.get(pageNumber)
+
+            if type(pdfView) != QPdfView:
+                pdfView = QPdfView()
+                pdfView.setPage(self.rendererWorker.pdf.getPage(pageNumber), pageNumber, self.rendererWorker.pdf.history, self.rendererWorker.pdf.journal)
+                detached.append(pdfView)
+
+            return pdfView
+
+        step(pageEditor)
+
+        for pdfView in detached:
+            pdfView.commitInk()
+
     @Slot()
     def settingsUpdateSuggested(self):
         self.settingsChanged.emit()
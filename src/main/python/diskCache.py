@@ -0,0 +1,334 @@
+# ---------------------------------------------------------------
+# -- UNote Disk Cache File --
+#
+# Persistent cache for page renders and thumbnails
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import os
+import hashlib
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide2.QtGui import QImage, QImageWriter
+
+from tileCache import TileCache
+
+
+class DiskCache():
+    '''
+    Stores compressed page renders under <home>/UNote/cache/<document hash>/.
+    Files are named <page>_<zoom bucket>[i]_<annotation signature>.png, so pages with changed annotations are never taken from the cache.
+    Pages which are unchanged since the document was opened are as they are in the file, so they are stored as UNEDITED without reading their annotations.
+    Reading, writing and pruning happen in a background thread. The files of all documents are indexed once when the cache is created,
+    the index is kept in the order of use, so the least recently used files are pruned without looking at the disk once the size limit is exceeded
+    '''
+    CACHEDIR = Path.home() / "UNote" / "cache"
+    DEFAULTLIMIT = 512 * 1024 * 1024    # bytes
+    HASHCHUNK = 1024 * 1024             # bytes
+    ZOOMTOLERANCE = 0.01
+
+    # Signature of pages as they are in the file of the document hash
+    UNEDITED = 'file'
+
+    def __init__(self, cacheDir=CACHEDIR, limit=DEFAULTLIMIT):
+        super().__init__()
+
+        self.cacheDir = Path(cacheDir)
+        self.limit = limit
+
+        self.docHash = None
+        self.docDir = None
+
+        # path: size in bytes, least recently used first. Only changed by the background thread
+        self.entries = OrderedDict()
+        self.size = 0
+        self.indexed = False
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.executor.submit(self.indexWorker)
+
+    def terminate(self):
+        self.executor.shutdown(wait=True)
+
+    @staticmethod
+    def hashFile(filename):
+        docHash = hashlib.sha1()
+
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(DiskCache.HASHCHUNK), b''):
+                docHash.update(chunk)
+
+        return docHash.hexdigest()
+
+    def indexWorker(self):
+        entries = []
+
+        for entry in self.cacheDir.glob("*/*.png"):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, entry))
+
+        for _, entrySize, entry in sorted(entries, key=lambda e: e[0]):
+            self.entries[entry] = entrySize
+            self.size += entrySize
+
+        self.indexed = True
+
+        self.prune()
+
+    def indexAdd(self, path):
+        self.indexRemove(path)
+
+        try:
+            entrySize = path.stat().st_size
+        except OSError:
+            return
+
+        self.entries[path] = entrySize
+        self.size += entrySize
+
+    def indexRemove(self, path):
+        self.size -= self.entries.pop(path, 0)
+
+    def unlink(self, path):
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+        self.indexRemove(path)
+
+    def rename(self, path, newPath):
+        os.replace(path, newPath)
+
+        self.indexRemove(newPath)
+
+        if path in self.entries:
+            self.entries[newPath] = self.entries.pop(path)
+
+    @staticmethod
+    def annotSignature(page):
+        '''
+        Short hash over all annotations of the page
+        '''
+        signature = hashlib.sha1()
+
+        try:
+            for annot in page.annots():
+                signature.update(repr((annot.xref, annot.type[0], tuple(annot.rect), annot.colors, annot.border, annot.info.get("content"))).encode())
+        except (ValueError, RuntimeError) as identifier:
+            print(str(identifier))
+
+        return signature.hexdigest()[:16]
+
+    def openDocument(self, filename):
+        try:
+            self.setDocument(self.hashFile(filename))
+        except OSError as identifier:
+            print(str(identifier))
+            self.setDocument(None)
+
+    def setDocument(self, docHash):
+        '''
+        Selects the entries of the document with the given hash, e.g. when the hash was computed elsewhere
+        '''
+        self.docHash = docHash
+
+        if not docHash:
+            self.docDir = None
+            return
+
+        self.docDir = self.cacheDir / docHash
+        self.docDir.mkdir(parents=True, exist_ok=True)
+
+    def rekey(self, filename, editedPages=()):
+        '''
+        Called after saving. Moves the entries to the hash of the saved file, stale pages are sorted out by their signature later.
+        UNEDITED entries of the edited pages show the previous file, so they are dropped
+        '''
+        if not self.docDir or not filename:
+            return
+
+        self.executor.submit(self.rekeyWorker, filename, list(editedPages))
+
+    def rekeyWorker(self, filename, editedPages):
+        try:
+            newHash = self.hashFile(filename)
+        except OSError as identifier:
+            print(str(identifier))
+            return
+
+        for pageNumber in editedPages:
+            for entry in self.docDir.glob("%d_*_%s.png" % (pageNumber, self.UNEDITED)):
+                self.unlink(entry)
+
+        newDir = self.cacheDir / newHash
+
+        if newHash != self.docHash:
+            try:
+                newDir.mkdir(parents=True, exist_ok=True)
+
+                for entry in self.docDir.iterdir():
+                    self.rename(entry, newDir / entry.name)
+
+                self.docDir.rmdir()
+            except OSError as identifier:
+                print(str(identifier))
+
+        self.docHash = newHash
+        self.docDir = newDir
+
+    def shiftPages(self, pageNumber, delta):
+        '''
+        Called after a page was inserted (delta 1) or deleted (delta -1) at pageNumber. Entries of the following pages are renamed,
+        those of a deleted page are dropped. Both are saved right away, which moves the entries to the hash of the changed file, see rekey
+        '''
+        if self.docDir:
+            self.executor.submit(self.shiftWorker, self.docDir, pageNumber, delta)
+
+    def shiftWorker(self, docDir, pageNumber, delta):
+        entries = []
+
+        for entry in docDir.glob("*.png"):
+            try:
+                entryPage = int(entry.name.split('_', 1)[0])
+            except ValueError:
+                continue
+
+            if entryPage >= pageNumber:
+                entries.append((entryPage, entry))
+
+        # Each entry is moved to where the previous one was
+        for entryPage, entry in sorted(entries, key=lambda e: e[0], reverse=delta > 0):
+            try:
+                if delta < 0 and entryPage == pageNumber:
+                    self.unlink(entry)
+                else:
+                    self.rename(entry, docDir / ("%d_%s" % (entryPage + delta, entry.name.split('_', 1)[1])))
+            except OSError as identifier:
+                print(str(identifier))
+
+    def dropPage(self, pageNumber):
+        '''
+        Drops the entries of a page, e.g. after it was resized
+        '''
+        if self.docDir:
+            self.executor.submit(self.dropWorker, self.docDir, pageNumber)
+
+    def dropWorker(self, docDir, pageNumber):
+        for entry in docDir.glob("%d_*.png" % pageNumber):
+            self.unlink(entry)
+
+    def entryPrefix(self, pageNumber, zoom, invert):
+        return "%d_%d%s_" % (pageNumber, TileCache.zoomBucket(zoom), 'i' if invert else '')
+
+    def entryPath(self, pageNumber, zoom, signature, invert):
+        return self.docDir / (self.entryPrefix(pageNumber, zoom, invert) + signature + ".png")
+
+    def contains(self, pageNumber, zoom, signature, invert=False):
+        if self.docDir is None:
+            return False
+
+        path = self.entryPath(pageNumber, zoom, signature, invert)
+
+        # Until the index is built
+        if not self.indexed:
+            return path.is_file()
+
+        return path in self.entries
+
+    def load(self, pageNumber, zoom, signature, invert=False):
+        '''
+        Returns the cached image of the page and the zoom it was rendered at, or (None, None).
+        Decodes the image right away, which is fine for thumbnails. Pages are decoded in the background, see loadAsync
+        '''
+        if not self.contains(pageNumber, zoom, signature, invert):
+            return None, None
+
+        path = self.entryPath(pageNumber, zoom, signature, invert)
+
+        qImg = QImage(str(path))
+        if qImg.isNull():
+            return None, None
+
+        try:
+            renderZoom = float(qImg.text("zoom"))
+        except ValueError:
+            return None, None
+
+        qImg.setDevicePixelRatio(renderZoom)
+
+        self.executor.submit(self.touchWorker, path)
+
+        return qImg, renderZoom
+
+    def loadAsync(self, pageNumber, zoom, signature, invert=False):
+        '''
+        Same as load, but decodes the image in the background thread. Returns a future of (image, zoom)
+        '''
+        return self.executor.submit(self.load, pageNumber, zoom, signature, invert)
+
+    def touchWorker(self, path):
+        '''
+        Marks the entry as recently used
+        '''
+        try:
+            os.utime(path)
+        except OSError:
+            return
+
+        if path in self.entries:
+            self.entries.move_to_end(path)
+
+    def matchesZoom(self, renderZoom, zoom):
+        return renderZoom and abs(renderZoom / zoom - 1) < self.ZOOMTOLERANCE
+
+    def store(self, pageNumber, zoom, signature, qImg, invert=False):
+        if not self.docDir:
+            return
+
+        # Deep copy, the image may only wrap the samples of a pixmap which are freed before the worker gets to it
+        self.executor.submit(self.storeWorker, self.entryPrefix(pageNumber, zoom, invert), signature, qImg.copy(), zoom)
+
+    def storeWorker(self, prefix, signature, qImg, zoom):
+        docDir = self.docDir
+
+        # Remove entries with outdated annotations
+        for entry in docDir.glob(prefix + "*.png"):
+            self.unlink(entry)
+
+        path = docDir / (prefix + signature + ".png")
+        tempPath = docDir / (prefix + signature + ".tmp")
+
+        # Setting the text on the image itself would detach it
+        writer = QImageWriter(str(tempPath), b"PNG")
+        writer.setText("zoom", str(zoom))
+
+        if writer.write(qImg):
+            try:
+                os.replace(tempPath, path)
+            except OSError as identifier:
+                print(str(identifier))
+                return
+
+            self.indexAdd(path)
+
+        self.prune()
+
+    def prune(self):
+        '''
+        Deletes the least recently used entries of all documents until the cache fits into its limit
+        '''
+        while self.size > self.limit and self.entries:
+            entry, entrySize = self.entries.popitem(last=False)
+            self.size -= entrySize
+
+            try:
+                entry.unlink()
+            except OSError:
+                pass
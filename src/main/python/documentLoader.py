@@ -0,0 +1,143 @@
+# ---------------------------------------------------------------
+# -- UNote Document Loader File --
+#
+# Opens pdf documents in a separate process
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import time
+import queue
+import multiprocessing as mp
+
+import fitz
+
+from PySide2.QtCore import QObject, QTimer, Signal
+
+from diskCache import DiskCache
+
+
+def loadDocInProcess(path, startPage, zoom, invert, queInfo, chunkSize):
+    '''
+    Opens the document and reports back in the order the gui needs it:
+    the page count with the size of the start page, the rendering of the start page, the document hash and finally the sizes of all pages in chunks
+    '''
+    try:
+        doc = fitz.open(path)
+    except RuntimeError as identifier:
+        queInfo.put(('error', str(identifier)))
+        return
+
+    pageCount = doc.pageCount
+
+    if pageCount == 0:
+        queInfo.put(('error', 'Document has no pages'))
+        return
+
+    startPage = min(max(startPage, 0), pageCount - 1)
+
+    bound = doc.loadPage(startPage).bound()
+    queInfo.put(('count', pageCount, startPage, bound.width, bound.height))
+
+    try:
+        pix = doc.loadPage(startPage).getPixmap(matrix=fitz.Matrix(zoom, zoom))
+
+        if invert:
+            pix.invertIRect()
+
+        queInfo.put(('page', startPage, zoom, pix.samples, pix.width, pix.height, pix.stride, pix.alpha))
+    except RuntimeError as identifier:
+        print(str(identifier))
+
+    try:
+        queInfo.put(('hash', DiskCache.hashFile(path)))
+    except OSError as identifier:
+        print(str(identifier))
+
+    for chunkStart in range(0, pageCount, chunkSize):
+        sizes = []
+
+        for pageNumber in range(chunkStart, min(chunkStart + chunkSize, pageCount)):
+            bound = doc.loadPage(pageNumber).bound()
+            sizes.append((bound.width, bound.height))
+
+        queInfo.put(('sizes', chunkStart, sizes))
+
+    queInfo.put(('done',))
+
+    doc.close()
+
+
+class DocumentLoader(QObject):
+    '''
+    Asynchronous document open. Opening large or damaged files as well as reading the size of every page happens in a worker process,
+    while the gui shows the start page as soon as it is rendered. The page sizes are streamed in chunks, so the layout can be refined incrementally
+    '''
+    CHUNKSIZE = 200     # pages
+    POLLINTERVAL = 15   # ms
+
+    # pageCount, startPage, width, height
+    pageCountReady = Signal(int, int, float, float)
+    # pageNumber, zoom, (samples, width, height, stride, alpha)
+    firstPageReady = Signal(int, float, object)
+    documentHashReady = Signal(str)
+    # first page number, [(width, height)]
+    pageSizesReady = Signal(int, object)
+    finished = Signal()
+    failed = Signal(str)
+
+    def __init__(self, filename, startPage=0, zoom=1, invert=False):
+        super().__init__()
+
+        self.filename = filename
+        self.startTime = time.time()
+
+        self.queInfo = mp.Queue()
+        self.process = mp.Process(target=loadDocInProcess, args=(filename, startPage, zoom, invert, self.queInfo, self.CHUNKSIZE), daemon=True)
+
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.poll)
+
+    def start(self):
+        self.process.start()
+        self.timer.start(self.POLLINTERVAL)
+
+    def terminate(self):
+        self.timer.stop()
+
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def elapsed(self):
+        return time.time() - self.startTime
+
+    def poll(self):
+        while True:
+            try:
+                info = self.queInfo.get_nowait()
+            except queue.Empty:
+                return
+
+            command = info[0]
+
+            if command == 'count':
+                self.pageCountReady.emit(*info[1:])
+
+            elif command == 'page':
+                pageNumber, zoom = info[1:3]
+                self.firstPageReady.emit(pageNumber, zoom, info[3:])
+
+            elif command == 'hash':
+                self.documentHashReady.emit(info[1])
+
+            elif command == 'sizes':
+                self.pageSizesReady.emit(info[1], info[2])
+
+            elif command == 'done':
+                self.timer.stop()
+                self.finished.emit()
+                return
+
+            elif command == 'error':
+                self.timer.stop()
+                self.failed.emit(info[1])
+                return
@@ -0,0 +1,157 @@
+# ---------------------------------------------------------------
+# -- UNote Document Saver File --
+#
+# Compresses and writes pdf documents in a separate process
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import os
+import time
+import queue
+import shutil
+import tempfile
+import multiprocessing as mp
+
+import fitz
+
+from PySide2.QtCore import QObject, QTimer, Signal
+
+
+def saveDocInProcess(data, path, options, queInfo):
+    '''
+    Opens the snapshot, writes it with the provided save options to a temp file and replaces the document by it.
+    While the document is opened by the gui (Windows), the file is saved as <name>_m.pdf and replaced once the document is closed
+    '''
+    name, ext = os.path.splitext(path)
+    tempPath = None
+
+    try:
+        # Unique, so no file of the user is replaced
+        fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.pdf.tmp')
+        os.close(fd)
+
+        doc = fitz.open(stream=data, filetype="pdf")
+        del data
+
+        queInfo.put(('progress', 20, 'Compressing'))
+
+        doc.save(tempPath, **options)
+        doc.close()
+
+        queInfo.put(('progress', 80, 'Writing'))
+
+        with open(tempPath, 'rb+') as f:
+            os.fsync(f.fileno())
+
+        # mkstemp creates the file private to the user
+        if os.path.exists(path):
+            shutil.copymode(path, tempPath)
+
+        try:
+            os.replace(tempPath, path)
+        except PermissionError:
+            path = name + '_m' + ext
+            os.replace(tempPath, path)
+
+        queInfo.put(('done', path, os.path.getsize(path)))
+    except (RuntimeError, ValueError, OSError) as identifier:
+        try:
+            if tempPath:
+                os.remove(tempPath)
+        except OSError:
+            pass
+
+        queInfo.put(('error', str(identifier)))
+
+
+class DocumentSaver(QObject):
+    '''
+    Asynchronous document save. The gui only takes a snapshot of the document, which is cheap as nothing is compressed or cleaned up.
+    Compressing and writing happens in a worker process, so the user can continue to annotate meanwhile.
+    Progress is reported in coarse steps, MuPDF doesn't report the progress of a save itself
+    '''
+    POLLINTERVAL = 50   # ms
+
+    # percent, stage
+    progress = Signal(int, str)
+    # saved filename, size
+    finished = Signal(str, int)
+    failed = Signal(str)
+
+    def __init__(self):
+        super().__init__()
+
+        self.process = None
+        self.queInfo = None
+        self.startTime = 0.0
+
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.poll)
+
+    def isBusy(self):
+        return self.process is not None
+
+    def start(self, data, filename, options):
+        '''
+        data is the snapshot of the document, see pdfEngine.snapshot
+        '''
+        self.startTime = time.time()
+
+        self.queInfo = mp.Queue()
+        self.process = mp.Process(target=saveDocInProcess, args=(data, filename, options, self.queInfo), daemon=True)
+        self.process.start()
+
+        self.timer.start(self.POLLINTERVAL)
+        self.progress.emit(10, 'Saving')
+
+    def wait(self):
+        '''
+        Blocks until the running save is done, e.g. before quitting
+        '''
+        if not self.process:
+            return
+
+        self.process.join()
+        self.poll()
+
+        # The process ended without reporting back
+        if self.process:
+            self.stop()
+            self.failed.emit('Save process ended unexpectedly')
+
+    def terminate(self):
+        if self.process and self.process.is_alive():
+            self.process.terminate()
+
+        self.stop()
+
+    def stop(self):
+        self.timer.stop()
+        self.process = None
+        self.queInfo = None
+
+    def elapsed(self):
+        return time.time() - self.startTime
+
+    def poll(self):
+        while self.queInfo:
+            try:
+                info = self.queInfo.get_nowait()
+            except queue.Empty:
+                return
+
+            command = info[0]
+
+            if command == 'progress':
+                self.progress.emit(*info[1:])
+
+            elif command == 'done':
+                self.stop()
+                self.progress.emit(100, 'Saved')
+                self.finished.emit(*info[1:])
+                return
+
+            elif command == 'error':
+                self.stop()
+                self.failed.emit(info[1])
+                return
@@ -1,4 +1,4 @@
-# import numpy as np
+import numpy as np
 from scipy.signal import savgol_filter
 # from scipy.linalg import lstsq
 # from scipy import dot
@@ -158,6 +158,88 @@ def rotate(origin, point, angle):
 #         points = list(zip(kalman_x_flat_list, kalman_y_flat_list))
 #         return points
 
+class MotionPredictor():
+    '''
+    Constant velocity Kalman filter on the pen position, with the time step taken from the sample timestamps.
+    Extrapolates where the pen will be a few milliseconds ahead, which hides part of the latency between the pen and the screen
+    '''
+    PROCESSNOISE = 4e6          # variance of the acceleration, (pt/s^2)^2
+    MEASUREMENTNOISE = 0.05     # variance of the measured position, pt^2
+    MAXDISTANCE = 8             # pt, limits overshooting on sudden stops
+    MINSAMPLES = 3
+
+    H = np.array([[1., 0., 0., 0.],
+                  [0., 1., 0., 0.]])
+
+    def __init__(self, processNoise=PROCESSNOISE, measurementNoise=MEASUREMENTNOISE):
+        super().__init__()
+
+        self.processNoise = processNoise
+        self.measurementNoise = measurementNoise
+
+        self.reset()
+
+    def reset(self):
+        self.x = None       # x, y, vx, vy
+        self.P = None
+        self.lastTime = None
+        self.samples = 0
+
+    def update(self, xPos, yPos, timestamp):
+        '''
+        Feeds a measured position, timestamp in seconds
+        '''
+        self.samples += 1
+
+        if self.x is None:
+            self.x = np.array([xPos, yPos, 0., 0.])
+            self.P = np.diag([self.measurementNoise, self.measurementNoise, 1e4, 1e4])
+            self.lastTime = timestamp
+            return
+
+        dt = max(timestamp - self.lastTime, 1e-4)
+        self.lastTime = timestamp
+
+        F = np.eye(4)
+        F[0, 2] = F[1, 3] = dt
+
+        # White noise acceleration
+        q = self.processNoise
+        Q = q * np.array([[dt**4 / 4, 0, dt**3 / 2, 0],
+                          [0, dt**4 / 4, 0, dt**3 / 2],
+                          [dt**3 / 2, 0, dt**2, 0],
+                          [0, dt**3 / 2, 0, dt**2]])
+
+        # Predict
+        self.x = F @ self.x
+        self.P = F @ self.P @ F.T + Q
+
+        # Update with the measurement
+        residual = np.array([xPos, yPos]) - self.H @ self.x
+        S = self.H @ self.P @ self.H.T + np.eye(2) * self.measurementNoise
+        K = self.P @ self.H.T @ np.linalg.inv(S)
+
+        self.x = self.x + K @ residual
+        self.P = (np.eye(4) - K @ self.H) @ self.P
+
+    def predict(self, lookahead):
+        '''
+        Position lookahead seconds after the last sample, or None while there are too few samples
+        '''
+        if self.x is None or self.samples < self.MINSAMPLES:
+            return None
+
+        dx = self.x[2] * lookahead
+        dy = self.x[3] * lookahead
+
+        distance = sqrt(dx * dx + dy * dy)
+
+        if distance > self.MAXDISTANCE:
+            dx *= self.MAXDISTANCE / distance
+            dy *= self.MAXDISTANCE / distance
+
+        return (float(self.x[0] + dx), float(self.x[1] + dy))
+
 class Savgol():
 
     @staticmethod
@@ -273,43 +355,262 @@ class Savgol():
 #         err_per_point = np.sum((B-B_fit)**2,axis=1) # sum squared error per row
 #         return err_per_point
 
-def smoothLine(drawPoints, asQPoints=True):
+def savgolParameters(numPoints):
+    '''
+    Window length and polynom grade of the savgol filter for a line with numPoints points, None if the line is too short
+    '''
     # Odd window length for Savgol
     # Use even Polynoms for better results!
-    
-    xPoints, yPoints = tuplesToArrays(drawPoints)
-
-    if len(drawPoints) > 31:
-        WINDOW_LENGTH = 31 #odd!
-        POLYNOM_GRADE = 4
-    elif len(drawPoints) > 19:
-        WINDOW_LENGTH = 19 #odd!
-        POLYNOM_GRADE = 3
-    elif len(drawPoints) > 13:
-        WINDOW_LENGTH = 13 #odd!
-        POLYNOM_GRADE = 2
-    elif len(drawPoints) > 7:
-        WINDOW_LENGTH = 7 #odd!
-        POLYNOM_GRADE = 2
-    elif len(drawPoints) > 3:
-        WINDOW_LENGTH = 3 #odd!
-        POLYNOM_GRADE = 1
-    else:
-        if asQPoints:
-            return arraysToTuples(xPoints, yPoints)
-        else:
-            return xPoints, yPoints
+    if numPoints > 31:
+        return 31, 4
+    elif numPoints > 19:
+        return 19, 3
+    elif numPoints > 13:
+        return 13, 2
+    elif numPoints > 7:
+        return 7, 2
+    elif numPoints > 3:
+        return 3, 1
+
+    return None
+
+def smoothLine(xPoints, yPoints):
+    '''
+    Savgol smoothed copy of the coordinates. Works on numpy arrays, e.g. the columns of a stroke buffer
+    '''
+    parameters = savgolParameters(len(xPoints))
+
+    if not parameters:
+        return normalize(xPoints, yPoints)
+
+    WINDOW_LENGTH, POLYNOM_GRADE = parameters
+
+    return savgol_filter(xPoints, WINDOW_LENGTH, POLYNOM_GRADE), savgol_filter(yPoints, WINDOW_LENGTH, POLYNOM_GRADE)
+
+def normalize(xPoints, yPoints):
+    return np.array(xPoints, dtype=np.float64), np.array(yPoints, dtype=np.float64)
+
+def transformPoints(xPoints, yPoints, matrix):
+    '''
+    Applies an affine matrix (a, b, c, d, e, f as used by fitz) to all coordinates at once
+    '''
+    return matrix.a * xPoints + matrix.c * yPoints + matrix.e, matrix.b * xPoints + matrix.d * yPoints + matrix.f
+
+def smoothValues(values):
+    '''
+    Savgol smoothed copy of a single column, e.g. the pressure of a stroke
+    '''
+    parameters = savgolParameters(len(values))
+
+    if not parameters:
+        return np.array(values, dtype=np.float64)
+
+    WINDOW_LENGTH, POLYNOM_GRADE = parameters
+
+    return savgol_filter(values, WINDOW_LENGTH, POLYNOM_GRADE)
+
+WIDTHTOLERANCE = 0.15       # relative width change which starts a new segment
+MINSEGMENTPOINTS = 4
+
+def widthLevels(widths, tolerance=WIDTHTOLERANCE):
+    '''
+    Quantizes stroke widths logarithmically, so neighbouring levels differ by the tolerance
+    '''
+    return np.round(np.log(np.maximum(widths, 1e-3)) / np.log(1 + tolerance)).astype(np.int64)
+
+def widthSegments(widths, tolerance=WIDTHTOLERANCE, minPoints=MINSEGMENTPOINTS):
+    '''
+    Splits a variable width stroke into runs of similar width.
+    Returns (start, stop, width) for each run. Consecutive runs share their boundary point, so the drawn stroke has no gaps.
+    Runs shorter than minPoints are merged into the previous one, so jittery pressure doesn't produce a segment per sample
+    '''
+    numPoints = len(widths)
+
+    if numPoints == 0:
+        return []
+
+    boundaries = np.flatnonzero(np.diff(widthLevels(widths, tolerance))) + 1
+
+    runs = []
+    start = 0
+
+    for boundary in boundaries.tolist():
+        if boundary - start >= minPoints:
+            runs.append((start, boundary))
+            start = boundary
+
+    if runs and numPoints - start < minPoints:
+        start = runs.pop()[0]
+
+    runs.append((start, numPoints))
+
+    return [(start, min(stop + 1, numPoints), float(np.mean(widths[start:stop]))) for start, stop in runs]
+
+def segmentDistances(xRel, yRel, dx, dy):
+    '''
+    Distances of points to the segment from the origin to (dx, dy). Broadcasts, so several segments can be tested at once
+    '''
+    lengthSquared = dx * dx + dy * dy
+
+    # Degenerated segments are points, t is 0 for them anyway
+    t = np.clip((xRel * dx + yRel * dy) / np.where(lengthSquared == 0, 1, lengthSquared), 0, 1)
+
+    return np.hypot(xRel - t * dx, yRel - t * dy)
+
+def pathDistances(xPoints, yPoints, xPath, yPath, maxDistance=None):
+    '''
+    Distance of every point to the polyline along the path.
+    With maxDistance, segments of the path which are further away from all points are skipped, so larger distances may be reported as inf
+    '''
+    xPoints = np.asarray(xPoints, dtype=np.float64)
+    yPoints = np.asarray(yPoints, dtype=np.float64)
+    xPath = np.asarray(xPath, dtype=np.float64)
+    yPath = np.asarray(yPath, dtype=np.float64)
+
+    if len(xPath) == 1:
+        return np.hypot(xPoints - xPath[0], yPoints - yPath[0])
+
+    xStart, yStart = xPath[:-1], yPath[:-1]
+    dx, dy = np.diff(xPath), np.diff(yPath)
+
+    if maxDistance is not None and len(xPoints):
+        near = ((np.maximum(xStart, xPath[1:]) >= xPoints.min() - maxDistance) & (np.minimum(xStart, xPath[1:]) <= xPoints.max() + maxDistance) &
+                (np.maximum(yStart, yPath[1:]) >= yPoints.min() - maxDistance) & (np.minimum(yStart, yPath[1:]) <= yPoints.max() + maxDistance))
+
+        if not near.any():
+            return np.full(len(xPoints), np.inf)
+
+        xStart, yStart, dx, dy = xStart[near], yStart[near], dx[near], dy[near]
+
+    # One row per point, one column per segment of the path
+    distances = segmentDistances(xPoints[:, None] - xStart[None, :], yPoints[:, None] - yStart[None, :], dx[None, :], dy[None, :])
+
+    return distances.min(axis=1)
+
+def densifyLine(xPoints, yPoints, spacing, withOriginal=False):
+    '''
+    Inserts points into the polyline, so consecutive points are at most spacing apart. The original points are kept.
+    withOriginal additionally returns a mask of the original points
+    '''
+    xPoints = np.asarray(xPoints, dtype=np.float64)
+    yPoints = np.asarray(yPoints, dtype=np.float64)
+
+    if len(xPoints) < 2 or spacing <= 0:
+        if withOriginal:
+            return xPoints, yPoints, np.ones(len(xPoints), dtype=bool)
+
+        return xPoints, yPoints
+
+    dx = np.diff(xPoints)
+    dy = np.diff(yPoints)
+
+    counts = np.maximum(np.ceil(np.hypot(dx, dy) / spacing).astype(np.int64), 1)
+    segments = np.repeat(np.arange(len(counts)), counts)
+    t = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)) / counts[segments]
+
+    xDense = np.append(xPoints[segments] + t * dx[segments], xPoints[-1])
+    yDense = np.append(yPoints[segments] + t * dy[segments], yPoints[-1])
+
+    if withOriginal:
+        original = np.zeros(len(xDense), dtype=bool)
+        original[np.concatenate(([0], np.cumsum(counts)))] = True
+
+        return xDense, yDense, original
+
+    return xDense, yDense
+
+def splitLine(xPoints, yPoints, xPath, yPath, distance):
+    '''
+    Cuts the parts of the polyline which are closer than distance to the path, e.g. of an eraser.
+    Returns None if the polyline isn't touched, otherwise the remaining pieces as (xPoints, yPoints)
+    '''
+    # Dense enough that a crossing path always hits a point
+    xDense, yDense, original = densifyLine(xPoints, yPoints, distance / 2, withOriginal=True)
+
+    xPath = np.asarray(xPath, dtype=np.float64)
+    yPath = np.asarray(yPath, dtype=np.float64)
+
+    # Only points close to the path need the exact distance
+    near = ((xDense >= xPath.min() - distance) & (xDense <= xPath.max() + distance) &
+            (yDense >= yPath.min() - distance) & (yDense <= yPath.max() + distance))
+
+    erased = np.zeros(len(xDense), dtype=bool)
+
+    if near.any():
+        erased[near] = pathDistances(xDense[near], yDense[near], xPath, yPath, distance) <= distance
+
+    if not erased.any():
+        return None
+
+    # Boundaries of the runs of remaining points
+    changes = np.flatnonzero(np.diff(erased.astype(np.int8))) + 1
+    bounds = np.concatenate(([0], changes, [len(erased)]))
+
+    pieces = []
+
+    for start, stop in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        if erased[start] or stop - start < 2:
+            continue
+
+        # Drops the inserted points again, except the new ends
+        keep = original[start:stop].copy()
+        keep[0] = keep[-1] = True
+
+        pieces.append((xDense[start:stop][keep], yDense[start:stop][keep]))
+
+    return pieces
+
+def simplifyLine(xPoints, yPoints, tolerance):
+    '''
+    Ramer-Douglas-Peucker simplification of a polyline.
+    Returns a mask of the points to keep. No dropped point is further than the tolerance away from the simplified line, the end points are always kept
+    '''
+    numPoints = len(xPoints)
+    keep = np.zeros(numPoints, dtype=bool)
+
+    if numPoints < 3 or tolerance <= 0:
+        keep[:] = True
+        return keep
+
+    keep[0] = keep[-1] = True
+
+    # Iterative instead of recursive, as long strokes would exceed the recursion limit
+    ranges = [(0, numPoints - 1)]
+
+    while ranges:
+        start, stop = ranges.pop()
+
+        if stop - start < 2:
+            continue
+
+        distances = segmentDistances(xPoints[start + 1:stop] - xPoints[start], yPoints[start + 1:stop] - yPoints[start],
+                                     xPoints[stop] - xPoints[start], yPoints[stop] - yPoints[start])
+
+        farthest = int(np.argmax(distances))
+
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+
+            ranges.append((start, split))
+            ranges.append((split, stop))
+
+    return keep
+
+def lineDeviation(xPoints, yPoints, keep):
+    '''
+    Largest distance of a dropped point to the simplified line
+    '''
+    kept = np.flatnonzero(keep)
+    deviation = 0.0
 
+    for start, stop in zip(kept[:-1].tolist(), kept[1:].tolist()):
+        if stop - start < 2:
+            continue
 
-    if asQPoints:
-        return arraysToTuples(savgol_filter(xPoints, WINDOW_LENGTH, POLYNOM_GRADE), savgol_filter(yPoints, WINDOW_LENGTH, POLYNOM_GRADE))
-    else:
-        return savgol_filter(xPoints, WINDOW_LENGTH, POLYNOM_GRADE), savgol_filter(yPoints, WINDOW_LENGTH, POLYNOM_GRADE)
+        distances = segmentDistances(xPoints[start + 1:stop] - xPoints[start], yPoints[start + 1:stop] - yPoints[start],
+                                     xPoints[stop] - xPoints[start], yPoints[stop] - yPoints[start])
 
-def normalize(drawPoints, asQPoints=True):
-    xPoints, yPoints = tuplesToArrays(drawPoints)
+        deviation = max(deviation, float(np.max(distances)))
 
-    if asQPoints:
-        return arraysToTuples(xPoints, yPoints)
-    else:
-        return xPoints, yPoints
\ No newline at end of file
+    return deviation
@@ -1,74 +1,336 @@
 import sys
-from indexed import IndexedOrderedDict
+from collections import deque
+
+import numpy as np
+
+
+def estimateSize(obj, seen=None):
+    '''
+    Rough number of bytes held by the provided object, following containers and the attributes of plain objects
+    '''
+    if seen is None:
+        seen = set()
+
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return size
+
+    if isinstance(obj, dict):
+        return size + sum(estimateSize(key, seen) + estimateSize(value, seen) for key, value in obj.items())
+
+    if isinstance(obj, (list, tuple, set, deque)):
+        # Long lists of coordinates are estimated from their first element
+        if len(obj) > 16 and isinstance(next(iter(obj)), (int, float)):
+            return size + len(obj) * sys.getsizeof(0.0)
+
+        return size + sum(estimateSize(item, seen) for item in obj)
+
+    if hasattr(obj, '__dict__'):
+        return size + estimateSize(vars(obj), seen)
+
+    return size
+
+def annotRef(value):
+    '''
+    Annotations are referenced by their xref, live annot objects get stale once the annotation is deleted
+    '''
+    return getattr(value, 'xref', value)
+
+
+class HistoryEntry():
+    '''
+    Single change of a page. The functions take the pdf view of the page as first argument,
+    which is looked up when the change is undone or redone, as pdf views are recycled for other pages while scrolling.
+    The redo function returns the parameter for the next undo
+    '''
+
+    def __init__(self, pageNumber, undoFuncHandle, undoFuncParam, redoFuncHandle, redoFuncParam):
+        self.pageNumber = pageNumber
+
+        self.undoFuncHandle = undoFuncHandle
+        self.undoFuncParam = annotRef(undoFuncParam)
+        self.redoFuncHandle = redoFuncHandle
+        self.redoFuncParam = redoFuncParam
+
+        self.size = estimateSize(self.undoFuncParam) + estimateSize(redoFuncParam)
+
+    def undo(self, pageEditor):
+        self.undoFuncHandle(pageEditor(self.pageNumber), self.undoFuncParam)
+
+    def redo(self, pageEditor):
+        target = pageEditor(self.pageNumber)
+
+        if type(self.redoFuncParam) == tuple:
+            result = self.redoFuncHandle(target, *self.redoFuncParam)
+        else:
+            result = self.redoFuncHandle(target, self.redoFuncParam)
+
+        self.undoFuncParam = annotRef(result)
+
+    def pageNumbers(self):
+        return {self.pageNumber}
+
+
+class CompoundEntry():
+    '''
+    Several changes which are undone and redone in one step, e.g. all annotations cut by one eraser stroke
+    '''
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.size = sum(entry.size for entry in entries)
+
+    def undo(self, pageEditor):
+        for entry in reversed(self.entries):
+            entry.undo(pageEditor)
+
+    def redo(self, pageEditor):
+        for entry in self.entries:
+            entry.redo(pageEditor)
+
+    def pageNumbers(self):
+        return set().union(*(entry.pageNumbers() for entry in self.entries))
 
 
 class History():
+    '''
+    Undo and redo stacks of a document. The oldest changes are dropped once the entries hold more than MAXBYTES
+    '''
+    MAXBYTES = 64 * 1024 * 1024
+
+    def __init__(self, maxBytes=MAXBYTES):
+        super().__init__()
+
+        self.maxBytes = maxBytes
+
+        self.undoStack = deque()
+        self.redoStack = deque()
+        self.bytes = 0
+
+        self.compound = None
+        self.recentChanges = 0
+
+        # Counts every change, unlike recentChanges it isn't reverted by undo
+        self.revision = 0
+        # Revision of the latest change of every page changed since the document was opened
+        self.pageRevisions = dict()
+        # Revision of the file on the disk, and (pageNumber, revision) of the page inserts and deletes after that
+        self.savedRevision = 0
+        self.pageShifts = list()
 
-    MAXTIMELINELENGTH = 60
-    timeline = list()
-    pointer = -1 # Latest pointer
-    recentChanges = 0
+        # Annotations which are deleted and added again get a new xref, entries keep the one they know
+        self.xrefs = dict()
 
-    def __init__(self, parent):
-        super().__init__(parent)
+        # Functions which are undone or redone don't add entries themselves
+        self.replaying = False
 
+    def clear(self):
+        self.undoStack.clear()
+        self.redoStack.clear()
+        self.bytes = 0
 
-    @staticmethod
-    def resetHistoryChanges():
+        self.compound = None
+        self.recentChanges = 0
+
+        self.pageRevisions.clear()
+        self.xrefs.clear()
+
+        self.savedRevision = self.revision
+        self.pageShifts.clear()
+
+    def remapXref(self, oldXref, newXref):
         '''
-        Called e.g. when the pdf is saved
+        The annotation known as oldXref (or as any xref it was remapped from) is now newXref
         '''
-        History.recentChanges = 0
+        oldXref = self.resolveXref(oldXref)
 
-    @staticmethod
-    def undo():
-        if History.pointer+1 == len(History.timeline):
-            return
+        # A reused number is a different annotation now
+        self.xrefs.pop(newXref, None)
 
-        # Go back in time
-        History.pointer += 1
+        if oldXref != newXref:
+            self.xrefs[oldXref] = newXref
 
-        action = History.timeline[History.pointer]
+    def resolveXref(self, xRef):
+        seen = set()
+
+        while xRef in self.xrefs and xRef not in seen:
+            seen.add(xRef)
+            xRef = self.xrefs[xRef]
+
+        return xRef
+
+    def pagesChanged(self, pageNumber, delta):
+        '''
+        Called after a page was inserted (delta 1) or deleted (delta -1) at pageNumber.
+        Entries of the following pages are moved along, those of a deleted page are dropped
+        '''
+        def shifted(entry):
+            if isinstance(entry, CompoundEntry):
+                entries = [shiftedEntry for shiftedEntry in map(shifted, entry.entries) if shiftedEntry]
 
+                return CompoundEntry(entries) if entries else None
 
-        if type(action["undoFuncHandle"]) == tuple:
-            action["undoFuncHandle"](*action["undoFuncParam"])
+            if delta < 0 and entry.pageNumber == pageNumber:
+                return None
+
+            if entry.pageNumber >= pageNumber:
+                entry.pageNumber += delta
+
+            return entry
+
+        self.undoStack = deque(entry for entry in map(shifted, self.undoStack) if entry)
+        self.redoStack = deque(entry for entry in map(shifted, self.redoStack) if entry)
+
+        if self.compound is not None:
+            self.compound = [entry for entry in map(shifted, self.compound) if entry]
+
+        self.bytes = sum(entry.size for entry in self.undoStack) + sum(entry.size for entry in self.redoStack)
+
+        pageRevisions = dict()
+        for changedPage, revision in self.pageRevisions.items():
+            if changedPage < pageNumber:
+                pageRevisions[changedPage] = revision
+            elif delta > 0 or changedPage != pageNumber:
+                pageRevisions[changedPage + delta] = revision
+
+        self.pageRevisions = pageRevisions
+
+        # Not in the file of the document yet
+        if delta > 0:
+            self.pagesEdited([pageNumber])
         else:
-            action["undoFuncHandle"](action["undoFuncParam"])
+            self.revision += 1
 
-        History.recentChanges -= 1
+        self.pageShifts.append((pageNumber, self.revision))
 
-    @staticmethod
-    def redo():
-        if History.pointer == -1:
-            return
+    def pagesEdited(self, pageNumbers):
+        '''
+        Counts a change of the provided pages, e.g. when the journal was replayed
+        '''
+        self.revision += 1
 
-        action = History.timeline[History.pointer]
+        for pageNumber in pageNumbers:
+            self.pageRevisions[pageNumber] = self.revision
+
+    def isEdited(self, pageNumber):
+        '''
+        True if the page was changed since the document was opened, even if the changes were saved or undone meanwhile
+        '''
+        return pageNumber in self.pageRevisions
+
+    def pageRevision(self, pageNumber):
+        return self.pageRevisions.get(pageNumber, 0)
+
+    def pagesSaved(self, revision=None):
+        '''
+        Called once the document is saved as it was at the provided revision, the current one by default
+        '''
+        self.savedRevision = self.revision if revision is None else revision
+        self.pageShifts = [(pageNumber, shiftRevision) for pageNumber, shiftRevision in self.pageShifts if shiftRevision > self.savedRevision]
+
+    def isSaved(self, pageNumber):
+        '''
+        True if the page is the same as in the file on the disk, i.e. neither changed nor moved by inserting or deleting a page before it since the last save
+        '''
+        if self.pageRevision(pageNumber) > self.savedRevision:
+            return False
+
+        return all(pageNumber < shiftedPage for shiftedPage, _ in self.pageShifts)
+
+    def resetHistoryChanges(self):
+        '''
+        Called e.g. when the pdf is saved
+        '''
+        self.recentChanges = 0
+
+    def canUndo(self):
+        return len(self.undoStack) > 0
+
+    def canRedo(self):
+        return len(self.redoStack) > 0
+
+    def undo(self, pageEditor):
+        '''
+        pageEditor returns the pdf view for a page number
+        '''
+        if not self.undoStack:
+            return False
 
         # Go back in time
-        History.pointer -= 1
+        entry = self.undoStack.pop()
+
+        self.replaying = True
+        try:
+            entry.undo(pageEditor)
+        finally:
+            self.replaying = False
+
+        self.redoStack.append(entry)
+        self.recentChanges -= 1
+        self.pagesEdited(entry.pageNumbers())
+
+        return True
 
-        if type(action["redoFuncParam"]) == tuple:
-            action["undoFuncParam"] = action["redoFuncHandle"](*action["redoFuncParam"])
+    def redo(self, pageEditor):
+        if not self.redoStack:
+            return False
+
+        entry = self.redoStack.pop()
+
+        self.replaying = True
+        try:
+            entry.redo(pageEditor)
+        finally:
+            self.replaying = False
+
+        self.undoStack.append(entry)
+        self.recentChanges += 1
+        self.pagesEdited(entry.pageNumbers())
+
+        return True
+
+    def addToHistory(self, pageNumber, undoFuncHandle, undoFuncParam, redoFuncHandle, redoFuncParam):
+        if self.replaying:
+            return
+
+        entry = HistoryEntry(pageNumber, undoFuncHandle, undoFuncParam, redoFuncHandle, redoFuncParam)
+
+        if self.compound is not None:
+            self.compound.append(entry)
         else:
-            action["undoFuncParam"] = action["redoFuncHandle"](action["redoFuncParam"])
+            self.push(entry)
+
+    def beginCompound(self):
+        '''
+        The following entries are undone in one step, until endCompound
+        '''
+        self.compound = []
 
-        History.recentChanges += 1
+    def endCompound(self):
+        entries, self.compound = self.compound, None
 
-    @staticmethod
-    def addToHistory(undoFuncHandle, undoFuncParam, redoFuncHandle, redoFuncParam):
-        if History.pointer != -1:
-            del History.timeline[0:History.pointer]
-            History.pointer = -1
+        if entries:
+            self.push(CompoundEntry(entries))
 
-        # Add action to timeline
-        History.timeline.insert(0, {"undoFuncHandle":undoFuncHandle, "undoFuncParam":undoFuncParam, "redoFuncHandle":redoFuncHandle, "redoFuncParam":redoFuncParam})
+    def push(self, entry):
+        # A new change invalidates the undone ones
+        while self.redoStack:
+            self.bytes -= self.redoStack.pop().size
 
-        if len(History.timeline) > History.MAXTIMELINELENGTH:
-            del History.timeline[-1]
+        self.undoStack.append(entry)
+        self.bytes += entry.size
 
-        History.recentChanges += 1
+        # The latest change is kept in any case
+        while self.bytes > self.maxBytes and len(self.undoStack) > 1:
+            self.bytes -= self.undoStack.popleft().size
 
-    @staticmethod
-    def removeFromHistory():
-        pass
+        self.recentChanges += 1
+        self.pagesEdited(entry.pageNumbers())
@@ -0,0 +1,253 @@
+# ---------------------------------------------------------------
+# -- UNote History Test --
+#
+# Undoes and redoes edits of a page through the pdf view on the
+# offscreen platform
+#
+# Usage: python historyTest.py
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import os
+import sys
+import unittest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+import fitz
+
+from PySide2.QtWidgets import QApplication
+from PySide2.QtCore import QPointF
+
+from core import QPdfView
+from pendingInk import PendingStroke
+from historyHandler import History
+from preferences import Preferences
+from replayPerfTest import PREFERENCES
+
+
+class HistoryTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QApplication.instance() or QApplication(sys.argv)
+
+        for key, value in PREFERENCES.items():
+            Preferences.updateKeyValue(key, value)
+
+    def setUp(self):
+        self.doc = fitz.open()
+        self.doc.newPage()
+
+        self.history = History()
+
+        self.view = QPdfView()
+        self.view.setPage(self.doc[0], 0, self.history)
+
+    def pageEditor(self, pageNumber):
+        return self.view
+
+    def annotXrefs(self):
+        return [annot.xref for annot in self.view.page.annots()]
+
+    def strokeCount(self):
+        '''
+        Strokes of all ink annotations of the page
+        '''
+        return sum(len(annot.vertices) for annot in self.view.page.annots())
+
+    def draw(self, xPoints, yPoints):
+        '''
+        Same as finishing a freehand stroke, see QPdfView.applyDrawPoints
+        '''
+        stroke = PendingStroke([(np.array(xPoints, dtype=float), np.array(yPoints, dtype=float), 2.0)], self.view.derotationMatrix(), (0, 0, 0), (0, 0, 0))
+
+        self.view.queueInk(stroke)
+        self.history.addToHistory(self.view.pageNumber, QPdfView.removeInk, stroke, QPdfView.queueInk, (stroke,))
+        self.view.commitInk()
+
+        return stroke
+
+    def erase(self, xPoints, yPoints):
+        self.view.startEraser(QPointF(xPoints[0], yPoints[0]))
+
+        for x, y in zip(xPoints, yPoints):
+            self.view.updateEraserPoints(QPointF(x, y))
+
+        self.view.stopEraser(QPointF(xPoints[-1], yPoints[-1]))
+
+    def testUndoEraseAndStroke(self):
+        self.draw(np.linspace(100, 300, 50), np.full(50, 200))
+        self.assertEqual(len(self.annotXrefs()), 1)
+
+        # Cuts the stroke in two
+        self.erase([200, 200], [150, 250])
+        self.assertEqual(len(self.annotXrefs()), 1)
+        self.assertEqual(self.strokeCount(), 2)
+
+        # The stroke is added again with a new xref
+        self.history.undo(self.pageEditor)
+        self.assertEqual(len(self.annotXrefs()), 1)
+        self.assertEqual(self.strokeCount(), 1)
+
+        self.history.undo(self.pageEditor)
+        self.assertEqual(self.annotXrefs(), [])
+
+        self.history.redo(self.pageEditor)
+        self.view.commitInk()
+        self.history.redo(self.pageEditor)
+        self.assertEqual(len(self.annotXrefs()), 1)
+        self.assertEqual(self.strokeCount(), 2)
+
+    def testUndoRepeatedErase(self):
+        self.draw(np.linspace(100, 300, 50), np.full(50, 200))
+
+        self.erase([150, 150], [150, 250])
+        self.erase([250, 250], [150, 250])
+        self.assertEqual(self.strokeCount(), 3)
+
+        self.history.undo(self.pageEditor)
+        self.history.undo(self.pageEditor)
+        self.history.redo(self.pageEditor)
+        self.history.redo(self.pageEditor)
+        self.assertEqual(len(self.annotXrefs()), 1)
+        self.assertEqual(self.strokeCount(), 3)
+
+        for _ in range(3):
+            self.history.undo(self.pageEditor)
+
+        self.assertEqual(self.annotXrefs(), [])
+
+    def testEraseMissingStrokes(self):
+        self.draw(np.linspace(100, 300, 50), np.full(50, 200))
+        xrefs = self.annotXrefs()
+        undoEntries = len(self.history.undoStack)
+
+        # Ends just within reach of the stroke, between two of its points
+        self.erase([200, 200], [176, 196.03])
+        self.assertEqual(self.annotXrefs(), xrefs)
+        self.assertEqual(len(self.history.undoStack), undoEntries)
+
+    def testUndoEraseOfOtherAnnots(self):
+        self.view.addHighlightAnnot(fitz.Rect(100, 100, 300, 120), (1, 1, 0))
+        self.view.addLine(fitz.Point(100, 200), fitz.Point(300, 200), "", 2.0, (0, 0, 1))
+        self.view.addTextAnnot(fitz.Rect(100, 300, 200, 320), "text", 11.0, (fitz.Point(200, 310), fitz.Point(300, 400)))
+        self.assertEqual(len(self.annotXrefs()), 4)
+
+        # One stroke across all of them
+        self.erase([150, 150, 150], [90, 250, 330])
+        self.assertEqual(self.annotXrefs(), [])
+
+        self.history.undo(self.pageEditor)
+        annots = {annot.type[0]: annot for annot in self.view.page.annots()}
+        self.assertEqual(sorted(annots), sorted([fitz.PDF_ANNOT_HIGHLIGHT, fitz.PDF_ANNOT_LINE, fitz.PDF_ANNOT_FREE_TEXT]))
+        self.assertEqual(len(self.annotXrefs()), 4)
+        self.assertEqual(annots[fitz.PDF_ANNOT_FREE_TEXT].info["content"], "text")
+
+        self.history.redo(self.pageEditor)
+        self.assertEqual(self.annotXrefs(), [])
+
+        self.history.undo(self.pageEditor)
+        self.assertEqual(len(self.annotXrefs()), 4)
+
+    def testUndoEraseOfMultiLineHighlight(self):
+        quads = [fitz.Rect(100, 100, 300, 110).quad, fitz.Rect(100, 120, 200, 130).quad]
+        vertices = self.view.addHighlightAnnot(quads, (1, 1, 0)).vertices
+
+        self.erase([150, 150], [90, 140])
+        self.assertEqual(self.annotXrefs(), [])
+
+        # Still one quad per line, not their bounding box
+        self.history.undo(self.pageEditor)
+        annot = next(self.view.page.annots())
+        np.testing.assert_allclose(annot.vertices, vertices, atol=0.01)
+
+    def testUndoEraseOfLinkedArrow(self):
+        self.view.addTextAnnot(fitz.Rect(100, 300, 200, 320), "text", 11.0, (fitz.Point(200, 310), fitz.Point(300, 400)))
+        self.assertEqual(len(self.annotXrefs()), 2)
+
+        # Only the arrow is hit, the text box goes along with it
+        self.erase([250, 250], [330, 380])
+        self.assertEqual(self.annotXrefs(), [])
+
+        self.history.undo(self.pageEditor)
+        annots = {annot.type[0]: annot for annot in self.view.page.annots()}
+        self.assertEqual(sorted(annots), sorted([fitz.PDF_ANNOT_LINE, fitz.PDF_ANNOT_FREE_TEXT]))
+        self.assertEqual(annots[fitz.PDF_ANNOT_FREE_TEXT].info["subject"], str(annots[fitz.PDF_ANNOT_LINE].xref))
+
+    def testUndoAfterPageInsertAndDelete(self):
+        self.doc.newPage()
+        self.view.setPage(self.doc[1], 1, self.history)
+
+        self.draw(np.linspace(100, 300, 50), np.full(50, 200))
+
+        views = dict()
+
+        def pageEditor(pageNumber):
+            if pageNumber not in views:
+                views[pageNumber] = QPdfView()
+                views[pageNumber].setPage(self.doc[pageNumber], pageNumber, self.history)
+
+            return views[pageNumber]
+
+        # The stroke moves to page 2
+        self.doc.newPage(0)
+        self.history.pagesChanged(0, 1)
+
+        self.history.undo(pageEditor)
+        self.assertEqual(len(list(self.doc[2].annots())), 0)
+
+        self.history.redo(pageEditor)
+        pageEditor(2).commitInk()
+        self.assertEqual(len(list(self.doc[2].annots())), 1)
+        self.assertEqual(len(list(self.doc[1].annots())), 0)
+
+        # Changes of a deleted page are gone
+        self.doc.deletePage(2)
+        self.history.pagesChanged(2, -1)
+        self.assertFalse(self.history.canUndo())
+
+    def testEditedPages(self):
+        self.doc.newPage()
+        self.doc.newPage()
+        self.view.setPage(self.doc[1], 1, self.history)
+
+        self.draw(np.linspace(100, 300, 50), np.full(50, 200))
+        self.assertEqual(sorted(self.history.pageRevisions), [1])
+
+        # Undone changes still differ from the file until it's saved
+        self.history.undo(self.pageEditor)
+        self.assertTrue(self.history.isEdited(1))
+
+        # The inserted page isn't in the file either
+        self.history.pagesChanged(0, 1)
+        self.assertEqual(sorted(self.history.pageRevisions), [0, 2])
+
+        self.history.pagesChanged(2, -1)
+        self.assertEqual(sorted(self.history.pageRevisions), [0])
+
+    def testSavedPages(self):
+        self.doc.newPage()
+        self.doc.newPage()
+        self.view.setPage(self.doc[1], 1, self.history)
+
+        self.draw(np.linspace(100, 300, 50), np.full(50, 200))
+        self.assertEqual([self.history.isSaved(pageNumber) for pageNumber in range(3)], [True, False, True])
+
+        self.history.pagesSaved()
+        self.assertTrue(self.history.isSaved(1))
+
+        # The following pages moved, so the file on the disk shows others there
+        self.history.pagesChanged(1, -1)
+        self.assertEqual([self.history.isSaved(pageNumber) for pageNumber in range(2)], [True, False])
+
+        # A background save of an earlier revision leaves later changes unsaved
+        revision = self.history.revision
+        self.history.pagesChanged(0, 1)
+        self.history.pagesSaved(revision)
+        self.assertEqual([self.history.isSaved(pageNumber) for pageNumber in range(3)], [False, False, False])
+
+
+if __name__ == "__main__":
+    unittest.main()
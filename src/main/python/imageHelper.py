@@ -18,10 +18,15 @@ class imageHelper(QWidget):
 
         return pixImg
 
+    def invertsPdf(self):
+        '''
+        Checks if the current theme requires inverted pdf pages
+        '''
+        return toBool(Preferences.data["radioButtonAffectsPDF"]) == True and int(Preferences.data["comboBoxThemeSelect"]) == 0
+
     def applyTheme(self, qimage):
-        if toBool(Preferences.data["radioButtonAffectsPDF"]) == True:
-            if int(Preferences.data["comboBoxThemeSelect"]) == 0:
-                qimage.invertPixels()
+        if self.invertsPdf():
+            qimage.invertPixels()
 
 
         return qimage
\ No newline at end of file
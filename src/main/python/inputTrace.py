@@ -0,0 +1,98 @@
+# ---------------------------------------------------------------
+# -- UNote Input Trace File --
+#
+# Records and loads pointer input, so drawing sessions can be replayed
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import csv
+import time
+
+
+class InputEvent():
+    '''
+    Single pointer event. Positions are scene coordinates, which don't depend on the zoom or the scroll position
+    '''
+    TABLET = 'tablet'
+    MOUSE = 'mouse'
+
+    PRESS = 'press'
+    MOVE = 'move'
+    RELEASE = 'release'
+
+    FIELDS = ('timestamp', 'source', 'type', 'x', 'y', 'pressure', 'button')
+
+    def __init__(self, timestamp, source, eventType, x, y, pressure=0.0, button=0):
+        self.timestamp = timestamp
+        self.source = source
+        self.type = eventType
+        self.x = x
+        self.y = y
+        self.pressure = pressure
+        self.button = button
+
+    def row(self):
+        return ('%.6f' % self.timestamp, self.source, self.type, '%.4f' % self.x, '%.4f' % self.y, '%.4f' % self.pressure, str(self.button))
+
+    @staticmethod
+    def fromRow(row):
+        return InputEvent(float(row[0]), row[1], row[2], float(row[3]), float(row[4]), float(row[5]), int(row[6]))
+
+
+class InputTrace():
+    '''
+    Pointer events of a drawing session in the order they arrived. Stored as csv with the columns of InputEvent.FIELDS
+    '''
+
+    def __init__(self, events=None):
+        super().__init__()
+
+        self.events = events if events is not None else list()
+        self.startTime = None
+
+    def __len__(self):
+        return len(self.events)
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def record(self, source, eventType, x, y, pressure=0.0, button=0):
+        now = time.perf_counter()
+
+        if self.startTime is None:
+            self.startTime = now
+
+        self.events.append(InputEvent(now - self.startTime, source, eventType, x, y, pressure, button))
+
+    def duration(self):
+        if not self.events:
+            return 0.0
+
+        return self.events[-1].timestamp - self.events[0].timestamp
+
+    def strokeCount(self):
+        return sum(1 for event in self.events if event.type == InputEvent.PRESS)
+
+    def save(self, path):
+        try:
+            with open(path, 'w', newline='') as traceFile:
+                writer = csv.writer(traceFile)
+                writer.writerow(InputEvent.FIELDS)
+
+                for event in self.events:
+                    writer.writerow(event.row())
+        except OSError as identifier:
+            print(str(identifier))
+
+    @staticmethod
+    def load(path):
+        events = list()
+
+        with open(path, newline='') as traceFile:
+            for row in csv.reader(traceFile):
+                if not row or row[0].startswith('#') or row[0] == InputEvent.FIELDS[0]:
+                    continue
+
+                events.append(InputEvent.fromRow(row))
+
+        return InputTrace(events)
@@ -0,0 +1,114 @@
+# ---------------------------------------------------------------
+# -- UNote Pen Latency Test --
+#
+# Replays tablet traces through the motion predictor and reports
+# how far the painted stroke end trails the pen
+#
+# Usage: python latencyPerfTest.py [trace.csv ...]
+#
+# A trace has the columns timestamp (s), x, y (pdf points) and
+# pressure. Without traces a synthetic handwriting trace is used
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import sys
+import csv
+
+import numpy as np
+
+from filters import MotionPredictor
+
+
+SAMPLERATE = 200        # Hz of the synthetic trace
+DISPLAYLATENCY = 0.025  # s from the tablet event until the frame is visible
+LOOKAHEADS = (0, 0.008, 0.016, 0.024, 0.032)
+SEARCHWINDOW = 0.25     # s of the trace searched for the painted position
+
+
+def loadTrace(path):
+    with open(path, newline='') as traceFile:
+        rows = [row for row in csv.reader(traceFile) if row and not row[0].startswith('#')]
+
+    # Optional header
+    if not rows[0][0].replace('.', '', 1).isdigit():
+        rows = rows[1:]
+
+    return np.array(rows, dtype=np.float64)[:, :4]
+
+def syntheticTrace(duration=10, seed=0):
+    '''
+    Cursive like loops moving to the right, with sensor noise and varying speed
+    '''
+    rng = np.random.default_rng(seed)
+
+    t = np.arange(0, duration, 1 / SAMPLERATE)
+    phase = 2 * np.pi * (2.5 * t + 0.3 * np.sin(0.7 * t))
+
+    x = 40 + 25 * t + 6 * np.cos(phase)
+    y = 300 + 9 * np.sin(phase) + 3 * np.sin(0.5 * phase)
+    pressure = 0.6 + 0.2 * np.sin(t)
+
+    x += rng.normal(0, 0.05, len(t))
+    y += rng.normal(0, 0.05, len(t))
+
+    return np.column_stack((t, x, y, pressure))
+
+def perceivedLatency(trace, lookahead):
+    '''
+    For every event the painted stroke end is compared with the pen, which moved on until the frame is visible.
+    The latency is the time since the pen was at the painted position, the error the distance of the painted position to the pen path
+    '''
+    timestamps, xPoints, yPoints = trace[:, 0], trace[:, 1], trace[:, 2]
+
+    # Reference path of the pen
+    denseTimes = np.arange(timestamps[0], timestamps[-1], 0.0005)
+    xDense = np.interp(denseTimes, timestamps, xPoints)
+    yDense = np.interp(denseTimes, timestamps, yPoints)
+
+    predictor = MotionPredictor()
+
+    latencies = []
+    errors = []
+
+    for timestamp, xPos, yPos in zip(timestamps.tolist(), xPoints.tolist(), yPoints.tolist()):
+        predictor.update(xPos, yPos, timestamp)
+
+        painted = predictor.predict(lookahead) if lookahead > 0 else None
+        xPainted, yPainted = painted if painted else (xPos, yPos)
+
+        displayTime = timestamp + DISPLAYLATENCY
+
+        # The painted position matches the pen at some point of the recent path, or slightly ahead of the event when predicting
+        window = (denseTimes >= displayTime - SEARCHWINDOW) & (denseTimes <= displayTime)
+
+        if not window.any() or displayTime > timestamps[-1]:
+            continue
+
+        distances = np.hypot(xDense[window] - xPainted, yDense[window] - yPainted)
+        closest = int(np.argmin(distances))
+
+        latencies.append(displayTime - denseTimes[window][closest])
+        errors.append(distances[closest])
+
+    return np.array(latencies), np.array(errors)
+
+def main():
+    if len(sys.argv) > 1:
+        traces = [(path, loadTrace(path)) for path in sys.argv[1:]]
+    else:
+        traces = [('synthetic', syntheticTrace())]
+
+    print('--- display latency %.0f ms ---' % (DISPLAYLATENCY * 1000))
+
+    for name, trace in traces:
+        print('%s: %d samples, %.1f s' % (name, len(trace), trace[-1, 0] - trace[0, 0]))
+
+        for lookahead in LOOKAHEADS:
+            latencies, errors = perceivedLatency(trace, lookahead)
+
+            print('  prediction %2.0f ms: latency median %.1f ms, p95 %.1f ms, off path p95 %.2f pt, max %.2f pt' %
+                  (lookahead * 1000, np.median(latencies) * 1000, np.percentile(latencies, 95) * 1000, np.percentile(errors, 95), errors.max()))
+
+
+if __name__ == "__main__":
+    main()
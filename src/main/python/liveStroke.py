@@ -0,0 +1,186 @@
+# ---------------------------------------------------------------
+# -- UNote Live Stroke File --
+#
+# Incrementally smoothed path of the stroke which is currently drawn
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import numpy as np
+from scipy.signal import savgol_filter
+
+from PySide2.QtCore import Qt, QPointF, QRectF
+from PySide2.QtGui import QPainterPath, QPolygonF, QPen
+
+from filters import savgolParameters, widthLevels, WIDTHTOLERANCE
+
+
+class LiveStroke():
+    '''
+    Path of the stroke which is currently drawn, built incrementally.
+    Once the stroke is longer than the largest savgol window, the smoothed position of a point doesn't change anymore as soon as half a window followed it.
+    Those points are appended to the cached paths, so only the trailing points are smoothed again for every new point.
+    The paths are split into chunks of similar width (the same levels the saved stroke is segmented by) and of limited size,
+    which allows painting to skip the ones outside the exposed area
+    '''
+    CHUNKSIZE = 256     # points per path
+    MINPRESSURE = 0.1
+
+    def __init__(self, strokeBuffer, smooth=True, widthScale=1):
+        super().__init__()
+
+        self.strokeBuffer = strokeBuffer
+        self.smooth = smooth
+        self.widthScale = widthScale
+        self.maxWindow, _ = savgolParameters(float('inf'))
+
+        self.clear()
+
+    def clear(self):
+        '''
+        Drops the cached paths. The stroke buffer is cleared by its owner
+        '''
+        self.chunks = []        # [QPainterPath, width]
+        self.chunkPoints = 0
+        self.chunkLevel = None
+        self.finalCount = 0     # number of points in the chunks
+        self.lastFinal = None
+
+        self.tail = []          # smoothed (point, width) after the last final one, starting with it
+
+        # Extrapolated pen position. Only painted, it never becomes part of the stroke
+        self.prediction = None
+
+    def __len__(self):
+        return len(self.strokeBuffer)
+
+    def widths(self, pressures):
+        return np.maximum(pressures, self.MINPRESSURE) * self.widthScale
+
+    def update(self):
+        '''
+        To be called after a sample was appended to the stroke buffer. Returns the area which changed, including the pen width
+        '''
+        xPoints = self.strokeBuffer.xs
+        yPoints = self.strokeBuffer.ys
+        pressures = self.strokeBuffer.pressures
+
+        oldTail = self.tail
+
+        numPoints = len(xPoints)
+        parameters = savgolParameters(numPoints)
+
+        if not self.smooth or not parameters:
+            smoothStart = 0
+            xSmooth, ySmooth, pSmooth = xPoints, yPoints, pressures
+            finalUntil = numPoints if not self.smooth else 0
+        else:
+            windowLength, polynomGrade = parameters
+
+            if windowLength < self.maxWindow:
+                # The window still grows with the stroke, so every point may change
+                smoothStart = 0
+                finalUntil = 0
+            else:
+                halfWindow = windowLength // 2
+                smoothStart = max(0, min(self.finalCount - halfWindow, numPoints - windowLength))
+                finalUntil = numPoints - halfWindow
+
+            xSmooth = savgol_filter(xPoints[smoothStart:], windowLength, polynomGrade)
+            ySmooth = savgol_filter(yPoints[smoothStart:], windowLength, polynomGrade)
+            pSmooth = savgol_filter(pressures[smoothStart:], windowLength, polynomGrade)
+
+        wSmooth = self.widths(pSmooth)
+
+        def smoothedPoint(it):
+            return (QPointF(xSmooth[it - smoothStart], ySmooth[it - smoothStart]), wSmooth[it - smoothStart])
+
+        newFinal = [smoothedPoint(it) for it in range(self.finalCount, max(finalUntil, self.finalCount))]
+        self.appendFinal(newFinal)
+
+        tailStart = max(self.finalCount - 1, 0)
+        self.tail = [smoothedPoint(it) for it in range(tailStart, numPoints)]
+
+        changed = oldTail + newFinal + self.tail
+        margin = max(width for _, width in changed) / 2 + 2
+
+        return QPolygonF([point for point, _ in changed]).boundingRect().adjusted(-margin, -margin, margin, margin)
+
+    def appendFinal(self, points):
+        for point, width in points:
+            level = int(widthLevels(width))
+
+            if self.lastFinal is None or self.chunkPoints >= self.CHUNKSIZE or level != self.chunkLevel:
+                path = QPainterPath()
+                path.moveTo(self.lastFinal if self.lastFinal is not None else point)
+
+                self.chunks.append([path, (1 + WIDTHTOLERANCE) ** level])
+                self.chunkPoints = 0
+                self.chunkLevel = level
+
+            self.chunks[-1][0].lineTo(point)
+
+            self.lastFinal = point
+            self.chunkPoints += 1
+            self.finalCount += 1
+
+    def setPrediction(self, point):
+        '''
+        Sets the predicted position (QPointF or None) the stroke is painted to. Returns the area which changed
+        '''
+        oldPrediction = self.prediction
+        self.prediction = point
+
+        if not self.tail:
+            return QRectF()
+
+        end, width = self.tail[-1]
+        points = [end] + [point for point in (oldPrediction, point) if point is not None]
+        margin = width / 2 + 2
+
+        return QPolygonF(points).boundingRect().adjusted(-margin, -margin, margin, margin)
+
+    def bounds(self):
+        '''
+        Area covered by the stroke, including the pen width
+        '''
+        rect = QRectF()
+
+        for path, width in self.chunks:
+            margin = width / 2 + 1
+            rect = rect.united(path.controlPointRect().adjusted(-margin, -margin, margin, margin))
+
+        if self.tail:
+            margin = max(width for _, width in self.tail) / 2 + 1
+            rect = rect.united(QPolygonF([point for point, _ in self.tail]).boundingRect().adjusted(-margin, -margin, margin, margin))
+
+        return rect
+
+    def paint(self, painter, exposedRect=None):
+        '''
+        Draws the stroke with the color of the current pen of the painter
+        '''
+        painter.setBrush(Qt.NoBrush)
+
+        pen = QPen(painter.pen())
+        pen.setCapStyle(Qt.RoundCap)
+        pen.setJoinStyle(Qt.RoundJoin)
+
+        for path, width in self.chunks:
+            margin = width / 2 + 1
+
+            if exposedRect is None or path.controlPointRect().adjusted(-margin, -margin, margin, margin).intersects(exposedRect):
+                pen.setWidthF(width)
+                painter.setPen(pen)
+                painter.drawPath(path)
+
+        for (start, width), (stop, _) in zip(self.tail, self.tail[1:]):
+            pen.setWidthF(width)
+            painter.setPen(pen)
+            painter.drawLine(start, stop)
+
+        if self.prediction is not None and self.tail:
+            end, width = self.tail[-1]
+
+            pen.setWidthF(width)
+            painter.setPen(pen)
+            painter.drawLine(end, self.prediction)
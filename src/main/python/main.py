@@ -16,6 +16,7 @@ import argparse  # parsing cmdline arguments
 import os  # launching external python script
 import sys  # exit script, file parsing
 import atexit
+import multiprocessing
 from pathlib import Path, PurePath
 
 from PySide2.QtGui import QIcon, QDrag, QClipboard
@@ -25,6 +26,7 @@ from PySide2.QtCore import QTimer, Qt, QRect, QObject, Signal, Slot
 SCRIPTDIR = os.path.dirname(os.path.realpath(__file__))
 
 from core import GraphicsViewHandler
+from autoSave import AutoSaver
 from unote_receivers import Receivers
 from preferences import Preferences
 from toolbox import ToolBoxWidget
@@ -53,6 +55,9 @@ class App(QObject):
     TOOLBOXSTARTX = 400
     TOOLBOXSTARTY = 500
 
+    # Pointer events are recorded to this csv file if set, see replayPerfTest.py
+    RECORDINPUTENV = "UNOTE_RECORD_INPUT"
+
     # MAINWINDOWSTARTX = 0
     # MAINWINDOWSTARTY = 0
     # MAINWINDOWWIDTH = 1920
@@ -126,6 +131,12 @@ class UNote(App):
         # Simply use the whole window
         self.ui.gridLayout.addWidget(self.ui.graphicsView, 0, 0)
 
+        # Saves a copy of the document in the interval of the preferences
+        self.autoSaver = AutoSaver(self.ui.graphicsView)
+
+        if os.environ.get(self.RECORDINPUTENV):
+            self.ui.graphicsView.startInputRecording(os.path.abspath(os.environ[self.RECORDINPUTENV]))
+
         # Initialize a floating toolboxwidget. This is used for storing tools and editing texts
         self.ui.floatingToolBox = ToolBoxWidget(self.MainWindow)
         self.ui.floatingToolBox.setWindowFlags(Qt.WindowTitleHint | Qt.FramelessWindowHint)
@@ -176,7 +187,7 @@ class UNote(App):
             print("Unable to restore window size: " + str(identifier))
 
         # Initialize auto saving
-        # self.autoSaveReceiver()
+        self.autoSaver.start()
     def onAppResize(self):
         self.PreferenceWindow.move(self.MainWindow.width()/2 - 500, self.MainWindow.height()/2 - 250)
         self.ui.floatingToolBox.move(self.MainWindow.width() - self.TOOLBOXWIDTH, self.TOOLBOXHEIGHT)
@@ -193,6 +204,9 @@ class UNote(App):
         Preferences.updateKeyValue('state', self.MainWindow.saveState())
 
         self.ui.graphicsView.terminate()
+        self.autoSaver.terminate()
+        print(self.autoSaver.report())
+        print(self.ui.graphicsView.rendererWorker.pdf.savePlanner.report())
         self.receiversInst.terminate()
         self.preferencesGui.terminate()
 
@@ -263,8 +277,13 @@ class UNote(App):
         # Suggest update signal
         self.ui.floatingToolBox.suggestUpdate.connect(self.ui.graphicsView.updateSuggested)
 
+        # The split view shows the same document, so its history is undone through the main view
+        self.ui.floatingToolBox.undoRequested.connect(self.ui.graphicsView.undo)
+        self.ui.floatingToolBox.redoRequested.connect(self.ui.graphicsView.redo)
+
         self.ui.floatingToolBox.settingsChanged.connect(self.ui.graphicsView.settingsUpdateSuggested)
         self.preferencesGui.finished.connect(self.ui.graphicsView.settingsUpdateSuggested)
+        self.preferencesGui.finished.connect(self.autoSaver.start)
 
         # Toolboxspecific events
         self.ui.floatingToolBox.textInputFinished.connect(self.ui.graphicsView.toolBoxTextInputEvent)
@@ -329,6 +348,9 @@ def main():
     Main method handling the flow
     '''
 
+    # Required for the render processes in a frozen executable
+    multiprocessing.freeze_support()
+
     # -----------------------------------------------------
     # -----------------At Exit Register------------------
     atexit.register(exitMethod)
@@ -0,0 +1,102 @@
+# ---------------------------------------------------------------
+# -- UNote Page Cache File --
+#
+# Keeps track of the memory held by rendered page images
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+from collections import OrderedDict
+
+
+class PageCache():
+    '''
+    Bookkeeping for the rendered page images of the pdf views and the thumbnails kept in memory.
+    Once the byte budget is exceeded, the pages farthest from the viewport are suggested for eviction (least recently used first on ties).
+    Pages within KEEPDISTANCE of the visible pages are never evicted
+    '''
+    DEFAULTBUDGET = 512 * 1024 * 1024   # bytes
+    KEEPDISTANCE = 3                    # pages
+
+    def __init__(self, budget=DEFAULTBUDGET):
+        super().__init__()
+
+        self.budget = budget
+        self.size = 0
+        self.pages = OrderedDict()  # pageNumber: bytes, in lru order
+        self.thumbnails = dict()    # pageNumber: bytes, dropped with the scene item of the page
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def setBudget(self, budget):
+        self.budget = budget
+
+    def add(self, pageNumber, numBytes):
+        self.remove(pageNumber)
+
+        self.pages[pageNumber] = numBytes
+        self.size += numBytes
+
+    def remove(self, pageNumber):
+        numBytes = self.pages.pop(pageNumber, None)
+        if numBytes is not None:
+            self.size -= numBytes
+
+    def addThumbnail(self, pageNumber, numBytes):
+        self.removeThumbnail(pageNumber)
+
+        self.thumbnails[pageNumber] = numBytes
+        self.size += numBytes
+
+    def removeThumbnail(self, pageNumber):
+        numBytes = self.thumbnails.pop(pageNumber, None)
+        if numBytes is not None:
+            self.size -= numBytes
+
+    def hit(self, pageNumber):
+        self.hits += 1
+
+        if pageNumber in self.pages:
+            self.pages.move_to_end(pageNumber)
+
+    def miss(self):
+        self.misses += 1
+
+    def evict(self, pageNumber):
+        self.remove(pageNumber)
+        self.evictions += 1
+
+    def clear(self):
+        self.pages.clear()
+        self.thumbnails.clear()
+        self.size = 0
+
+    def evictionCandidates(self, firstVisible, lastVisible):
+        '''
+        Returns the page numbers which have to be dropped to get back within the budget
+        '''
+        if self.size <= self.budget:
+            return []
+
+        def distance(pageNumber):
+            return max(firstVisible - pageNumber, pageNumber - lastVisible, 0)
+
+        lruOrder = {pageNumber: it for it, pageNumber in enumerate(self.pages)}
+
+        candidates = sorted((pageNumber for pageNumber in self.pages if distance(pageNumber) > self.KEEPDISTANCE), key=lambda pageNumber: (-distance(pageNumber), lruOrder[pageNumber]))
+
+        evict = []
+        size = self.size
+
+        for pageNumber in candidates:
+            if size <= self.budget:
+                break
+
+            size -= self.pages[pageNumber]
+            evict.append(pageNumber)
+
+        return evict
+
+    def report(self):
+        return "Page cache: %d pages, %d thumbnails, %.1f/%.1f MB, %d hits, %d misses, %d evictions" % (len(self.pages), len(self.thumbnails), self.size / 1024 / 1024, self.budget / 1024 / 1024, self.hits, self.misses, self.evictions)
@@ -0,0 +1,93 @@
+# ---------------------------------------------------------------
+# -- UNote Page Layout File --
+#
+# Geometry index of the pages in the scene
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+from bisect import bisect_right
+from itertools import accumulate
+
+
+class PageLayout():
+    '''
+    Holds the size and the vertical offset of every page in scene coordinates (pdf points).
+    Pages are stacked from top to bottom, separated by pageSpace. Lookups by position are binary searches on the offsets,
+    so no scene item is needed for pages which are not close to the viewport
+    '''
+
+    def __init__(self, pageSpace=7):
+        super().__init__()
+
+        self.pageSpace = pageSpace
+
+        self.sizes = []     # (width, height) per page
+        self.offsets = []   # y of the upper edge per page
+        self.maxWidth = 0
+
+    def build(self, sizes):
+        self.sizes = list(sizes)
+        self.update()
+
+    def update(self):
+        '''
+        Recomputes the offsets after the page sizes changed
+        '''
+        self.offsets = [0] + list(accumulate(height + self.pageSpace for _, height in self.sizes[:-1]))
+        self.offsets = self.offsets[:len(self.sizes)]
+
+        self.maxWidth = max((width for width, _ in self.sizes), default=0)
+
+    def pageCount(self):
+        return len(self.sizes)
+
+    def width(self):
+        return self.maxWidth
+
+    def height(self):
+        if not self.sizes:
+            return 0
+
+        return self.offsets[-1] + self.sizes[-1][1]
+
+    def pageRect(self, pageNumber):
+        '''
+        Returns (x, y, width, height) of the page in scene coordinates
+        '''
+        width, height = self.sizes[pageNumber]
+
+        return (0, self.offsets[pageNumber], width, height)
+
+    def pageAt(self, y):
+        '''
+        Page at the vertical scene position. Positions in the space below a page belong to that page
+        '''
+        if not self.sizes:
+            return -1
+
+        return min(max(bisect_right(self.offsets, y) - 1, 0), len(self.sizes) - 1)
+
+    def pagesInRange(self, y0, y1):
+        '''
+        Returns the first and the last page intersecting the vertical range
+        '''
+        return self.pageAt(y0), self.pageAt(y1)
+
+    def insertPage(self, pageNumber, size):
+        self.sizes.insert(pageNumber, size)
+        self.update()
+
+    def removePage(self, pageNumber):
+        del self.sizes[pageNumber]
+        self.update()
+
+    def resizePage(self, pageNumber, size):
+        self.sizes[pageNumber] = size
+        self.update()
+
+    def resizePages(self, firstPage, sizes):
+        '''
+        Replaces the sizes of consecutive pages at once, e.g. when the real sizes replace estimated ones
+        '''
+        self.sizes[firstPage:firstPage + len(sizes)] = sizes
+        self.update()
@@ -1,30 +1,79 @@
 import os
 import fitz
 from PIL import Image, ImageQt
+from PySide2.QtGui import QImage
+
+from historyHandler import History
+from annotJournal import AnnotJournal
+from savePlanner import SavePlanner
+
+
+class SampleQImage(QImage):
+    '''
+    QImage directly on top of a sample buffer.
+    The QImage doesn't own the buffer, so it keeps a reference to it (and to its owner) as long as the image lives
+    '''
+    def __init__(self, samples, width, height, stride, alpha, owner=None):
+        fmt = QImage.Format_RGBA8888 if alpha else QImage.Format_RGB888
+
+        super().__init__(samples, width, height, stride, fmt)
+
+        self.samples = samples
+        self.owner = owner
 
 
 class pdfEngine():
     filename = None
-    doc = None
     incremental = True
 
+    # Opened on first access while openPending, see openPdf
+    _doc = None
+    openPending = False
+
+    # Saved copy which replaces the document once it's closed, see DocumentSaver
+    pendingReplace = None
+
+    # garbage=1 only drops unused objects, so the xrefs kept by the history and the journal stay valid
+    FULLSAVEOPTIONS = {"garbage": 1, "deflate": 1, "clean": 1}
+
     def __init__(self):
         super().__init__()
 
+        # Shared by all views of the document
+        self.history = History()
+
+        # Survives crashes until the changes are saved
+        self.journal = AnnotJournal()
+
+        # Incremental or full saves
+        self.savePlanner = SavePlanner()
+
+    @property
+    def doc(self):
+        if self.openPending:
+            self.loadPending()
+
+        return self._doc
+
+    @doc.setter
+    def doc(self, doc):
+        self._doc = doc
+        self.openPending = False
+
     def __del__(self):
-        if self.doc:
-            self.doc.close()
+        if self._doc:
+            self._doc.close()
 
-            if not self.incremental:
+            if self.pendingReplace:
                 print("Replacing temp file")
-                name, ext = os.path.splitext(self.filename)
-                name = name + '_m'
 
-                os.replace(name + ext, self.filename)
+                os.replace(self.pendingReplace, self.filename)
 
     def newPdf(self, filename):
         self.doc = fitz.open()
         self.filename = filename
+        self.history.clear()
+        self.savePlanner.reset(self.doc)
 
         # Insert empty page
         self.doc.newPage(0)
@@ -39,47 +88,118 @@ class pdfEngine():
         r = page.rect
         r = fitz.Rect(r.x0, r.y0-height, r.x1+width, r.y1+height)
         page.setMediaBox(r)
+
+        self.history.pagesEdited([page.number])
+        self.journal.recordResizePage(page.number, r)
+
         return page
 
-    def openPdf(self, filename):
-        # import fitz
+    def openPdf(self, filename, lazy=False):
+        '''
+        Opening damaged files takes as long as MuPDF needs to repair them. With lazy, the document is opened once it's first needed
+        '''
         self.filename = filename
+        self.history.clear()
+
+        if lazy:
+            self._doc = None
+            self.openPending = True
+
+            return None
+
         self.doc = fitz.open(filename)
+        self.savePlanner.reset(self.doc)
+
+        # Changes of a previous session which ended before they were saved
+        if self.journal.open(filename, self.doc):
+            self.history.recentChanges = 1
+            self.history.pagesEdited(range(len(self.doc)))
 
         return self.doc
 
+    def loadPending(self):
+        '''
+        Opens the document of a lazy openPdf. Returns False if there was nothing to open
+        '''
+        if not self.openPending:
+            return False
+
+        self.openPending = False
+        self.openPdf(self.filename)
+
+        return True
+
     def closePdf(self):
         self.doc.close()
 
 
-    def savePdf(self,cleanup=False):
-        name, ext = os.path.splitext(self.filename)
+    def savePdf(self):
+        '''
+        Appends the changes to the document. Returns None if the document can't be saved incrementally,
+        it has to be written as a whole then, see SavePlanner and DocumentSaver
+        '''
+        if not self.incremental:
+            return None
+
         try:
-            if self.incremental:
-                self.doc.save(name + ext, incremental = self.incremental)
-                return self.filename
-            else:
-                name = name + '_m'
-                if cleanup:
-                    self.doc.save(name + ext, incremental = self.incremental,garbage=1, deflate=1, clean=1)
-                else:
-                    self.doc.save(name + ext, incremental = self.incremental)
-
-                #Suggest new filename
-                return (name + ext)
-        except RuntimeError as identifier:
+            self.doc.save(self.filename, incremental = True)
+        except (RuntimeError, ValueError) as identifier:
             print(str(identifier))
-            if self.incremental:
-                self.incremental = False
-    
-                return self.savePdf(cleanup)
 
-        except ValueError as identifier:
+            return None
+
+        print('PDF saved')
+
+        return self.filename
+
+    def fullSaveDone(self, savedFilename, reopen):
+        '''
+        The document was written as a whole by the DocumentSaver. The file doesn't match the document in memory anymore,
+        so it's opened again if there were no changes meanwhile. Returns True if incremental saves are possible again
+        '''
+        self.incremental = False
+
+        if savedFilename != self.filename:
+            # The file is still in use, it's replaced when closing
+            self.pendingReplace = savedFilename
+
+            return False
+
+        self.pendingReplace = None
+
+        if reopen:
+            return self.reopenPdf()
+
+        return False
+
+    def reopenPdf(self):
+        '''
+        Incremental saves are only possible to the file the document was read from
+        '''
+        try:
+            doc = fitz.open(self.filename)
+        except RuntimeError as identifier:
             print(str(identifier))
             self.incremental = False
 
+            return False
 
-        print('PDF saved')
+        self.doc.close()
+        self.doc = doc
+        self.incremental = True
+
+        return True
+
+    def snapshot(self):
+        '''
+        The document as it is in memory. Nothing is compressed or cleaned up, so this is fast even for large documents
+        '''
+        try:
+            return self.doc.write()
+        except (RuntimeError, ValueError) as identifier:
+            print(str(identifier))
+
+        return None
 
     def savePdfAs(self, filename):
         name, ext = os.path.splitext(filename)
@@ -124,11 +244,16 @@ class pdfEngine():
 
         page = self.doc.newPage(pageNumber, width=width, height=height)
 
+        self.history.pagesChanged(pageNumber, 1)
+        self.journal.recordInsertPage(pageNumber, width, height)
+
         return page
 
     def deletePage(self, pageNumber):
         try:
             self.doc.deletePage(pageNumber)
+            self.history.pagesChanged(pageNumber, -1)
+            self.journal.recordDeletePage(pageNumber)
             return True
         except IndexError:
             return False
@@ -141,15 +266,52 @@ class pdfEngine():
 
         return page.bound().width, page.bound().height
 
-    def renderPixmap(self, pageNumber=0, mat = None, clip = None, alpha = False):
+    def getPageSizes(self):
+        '''
+        Returns the (width, height) of every page. Mixed page sizes are common, e.g. for inserted slides
+        '''
+        sizes = []
+
+        for page in self.doc:
+            bound = page.bound()
+            sizes.append((bound.width, bound.height))
+
+        return sizes
+
+    def renderPixmap(self, pageNumber=0, mat = None, clip = None, alpha = False, invert = False):
         try:
-            return self.doc[pageNumber].getPixmap(matrix = mat, clip = clip, alpha = alpha)
+            pixmap = self.doc[pageNumber].getPixmap(matrix = mat, clip = clip, alpha = alpha)
         except RuntimeError as identifier:
             raise RuntimeError(identifier)
 
+        # Inverting in place is cheaper than a detached copy of the QImage later on
+        if invert:
+            pixmap.invertIRect()
+
+        return pixmap
 
     def getQImage(self, pixmap):
+        '''
+        Returns a QImage on top of the pixmap samples.
+        Newer PyMuPDF versions expose the sample buffer itself, older ones return a single copy of it
+        '''
+        samples = getattr(pixmap, "samples_mv", None)
+        if samples is None:
+            samples = pixmap.samples
+
+        return SampleQImage(samples, pixmap.width, pixmap.height, pixmap.stride, pixmap.alpha, owner=pixmap)
+
+    def getQImageCopy(self, pixmap):
+        '''
+        Former conversion via PIL. Kept as reference for the render benchmark
+        '''
         mode = "RGBA" if pixmap.alpha else "RGB"
 
         img = Image.frombytes(mode, [pixmap.width, pixmap.height], pixmap.samples)
-        return ImageQt.ImageQt(img)
\ No newline at end of file
+        return ImageQt.ImageQt(img)
+
+    def getQImageFromSamples(self, samples, width, height, stride, alpha):
+        '''
+        Wraps raw samples, e.g. sent by a render process, into a QImage
+        '''
+        return SampleQImage(samples, width, height, stride, alpha)
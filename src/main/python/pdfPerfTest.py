@@ -115,10 +115,14 @@ class DocForm(QtWidgets.QWidget):
             ret = self.queDoc.get(False)
             if isinstance(ret, int):
                 self.timerWaiting.stop()
+                print("open time: {:.3f}s".format(time.perf_counter() - self.startTime))
                 self.pageCount = ret
                 self.label.setText("{}/{}".format(self.curPageNum + 1, self.pageCount))
             else:  # tuple, pixmap info
                 num, samples, width, height, stride, alpha = ret
+                if self.startTime:
+                    print("time to first page: {:.3f}s".format(time.perf_counter() - self.startTime))
+                    self.startTime = None
                 self.curPageNum = num
                 self.label.setText("{}/{}".format(self.curPageNum + 1, self.pageCount))
                 fmt = (
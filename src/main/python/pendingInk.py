@@ -0,0 +1,68 @@
+# ---------------------------------------------------------------
+# -- UNote Pending Ink File --
+#
+# Finished freehand strokes which are not written to the pdf yet
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import numpy as np
+
+from PySide2.QtCore import Qt, QPointF, QRectF
+from PySide2.QtGui import QPainterPath, QPen, QColor
+
+from filters import transformPoints
+
+
+class PendingStroke():
+    '''
+    Freehand stroke which is painted as an overlay of the page until it's written to the pdf together with the other strokes of its batch.
+    Holds the runs of similar width in item coordinates for painting and in pdf coordinates for the ink annotations
+    '''
+
+    def __init__(self, runs, matrix, color, annotColor):
+        '''
+        runs are (xPoints, yPoints, width) in item coordinates, matrix transforms those to pdf coordinates
+        '''
+        super().__init__()
+
+        self.color = color              # rgb 0-255, as painted
+        self.annotColor = annotColor    # rgb 0-1, as written to the pdf
+
+        self.paths = []                 # [QPainterPath, width]
+        self.segments = []              # [[pdf points], width]
+        self.bounds = QRectF()
+
+        self.annots = None              # ink annotations once committed
+        self.previousAnnots = None      # of the last commit, once undone
+
+        for xPoints, yPoints, width in runs:
+            path = QPainterPath(QPointF(xPoints[0], yPoints[0]))
+
+            # A single point is painted as a dot
+            for x, y in zip(xPoints.tolist(), yPoints.tolist()):
+                path.lineTo(x, y)
+
+            margin = width / 2 + 1
+            self.bounds = self.bounds.united(path.controlPointRect().adjusted(-margin, -margin, margin, margin))
+            self.paths.append((path, width))
+
+            xPdf, yPdf = transformPoints(xPoints, yPoints, matrix)
+            self.segments.append((np.column_stack((xPdf, yPdf)).tolist(), width))
+
+    def isCommitted(self):
+        return self.annots is not None
+
+    def paint(self, painter, exposedRect=None):
+        if exposedRect is not None and not self.bounds.intersects(exposedRect):
+            return
+
+        pen = QPen(QColor(*self.color))
+        pen.setCapStyle(Qt.RoundCap)
+        pen.setJoinStyle(Qt.RoundJoin)
+
+        painter.setBrush(Qt.NoBrush)
+
+        for path, width in self.paths:
+            pen.setWidthF(width)
+            painter.setPen(pen)
+            painter.drawPath(path)
@@ -243,6 +243,12 @@ class PreferencesGUI(App):
             Preferences.updateKeyValue('freehandSize', "70")
         if Preferences.data['freehandColor'] == "":
             Preferences.updateKeyValue('freehandColor', "('0', '0', '0')")
+        if Preferences.data['simplifyTolerance'] == "":
+            Preferences.updateKeyValue('simplifyTolerance', "0.5")
+        if Preferences.data['inkCommitDelay'] == "":
+            Preferences.updateKeyValue('inkCommitDelay', "1000")
+        if Preferences.data['penPrediction'] == "":
+            Preferences.updateKeyValue('penPrediction', "0")
         if Preferences.data['formSize'] == "":
             Preferences.updateKeyValue('formSize', "70")
         if Preferences.data['formColor'] == "":
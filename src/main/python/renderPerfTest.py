@@ -0,0 +1,108 @@
+# ---------------------------------------------------------------
+# -- UNote Render Performance Test --
+#
+# Compares the former PIL based pixmap conversion with the
+# zero-copy QImage path of the pdfEngine
+#
+# Usage: python renderPerfTest.py <pdf> [zoom] [pages]
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import sys
+import time
+
+import numpy as np
+import fitz
+from PIL import Image, ImageQt
+from PySide2.QtGui import QGuiApplication, QPixmap
+
+from pdfEngine import pdfEngine
+
+
+def bufferAddress(buffer):
+    return np.frombuffer(buffer, dtype=np.uint8).ctypes.data
+
+
+def frameCopies(pixmap, buffers, opaqueCopies=0):
+    '''
+    Counts the full frame buffers a conversion allocated in addition to the MuPDF pixmap itself, by the addresses of its intermediate buffers.
+    Intermediate objects which don't expose their buffer are passed as opaqueCopies
+    '''
+    addresses = set(bufferAddress(buffer) for buffer in buffers)
+
+    # Older PyMuPDF versions don't expose the pixmap buffer, pixmap.samples is a copy there
+    pixmapBuffer = getattr(pixmap, "samples_mv", None)
+    if pixmapBuffer is not None:
+        addresses.discard(bufferAddress(pixmapBuffer))
+
+    return len(addresses) + opaqueCopies
+
+
+def frameCopiesQImage(engine, pixmap):
+    qImg = engine.getQImage(pixmap)
+
+    return frameCopies(pixmap, [qImg.samples, qImg.constBits()])
+
+
+def frameCopiesPil(engine, pixmap):
+    '''
+    Same steps as pdfEngine.getQImageCopy
+    '''
+    samples = pixmap.samples
+    img = Image.frombytes("RGBA" if pixmap.alpha else "RGB", [pixmap.width, pixmap.height], samples)
+    qImg = ImageQt.ImageQt(img)
+
+    # The PIL image always holds its own memory, but doesn't expose it
+    return frameCopies(pixmap, [samples, qImg.constBits()], opaqueCopies=1)
+
+
+def benchmark(engine, convert, zoom, pages):
+    renderTime = 0.0
+    convertTime = 0.0
+
+    for pageNumber in pages:
+        start = time.perf_counter()
+        pixmap = engine.renderPixmap(pageNumber, mat=fitz.Matrix(zoom, zoom))
+        renderTime += time.perf_counter() - start
+
+        start = time.perf_counter()
+        qImg = convert(pixmap)
+        # Include the upload, as this is what happens in the pdf view as well
+        QPixmap.fromImage(qImg)
+        convertTime += time.perf_counter() - start
+
+    return renderTime / len(pages), convertTime / len(pages), pixmap
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit('Usage: python renderPerfTest.py <pdf> [zoom] [pages]')
+
+    filename = sys.argv[1]
+    zoom = float(sys.argv[2]) if len(sys.argv) > 2 else 4.0
+
+    app = QGuiApplication(sys.argv)
+
+    engine = pdfEngine()
+    engine.openPdf(filename)
+
+    numPages = int(sys.argv[3]) if len(sys.argv) > 3 else engine.doc.pageCount
+    pages = range(min(numPages, engine.doc.pageCount))
+
+    # Warm up MuPDF caches, so both runs see the same conditions
+    benchmark(engine, engine.getQImage, zoom, pages[:1])
+
+    renderPil, convertPil, pixmap = benchmark(engine, engine.getQImageCopy, zoom, pages)
+    renderQImg, convertQImg, pixmap = benchmark(engine, engine.getQImage, zoom, pages)
+
+    frameSize = pixmap.stride * pixmap.height / 1024 / 1024
+
+    print('--- %d pages at zoom %.1f, %.1f MB per frame ---' % (len(pages), zoom, frameSize))
+    print('PIL path:    render %.2f ms, convert %.2f ms, %d frame copies' % (renderPil * 1000, convertPil * 1000, frameCopiesPil(engine, pixmap)))
+    print('QImage path: render %.2f ms, convert %.2f ms, %d frame copies' % (renderQImg * 1000, convertQImg * 1000, frameCopiesQImage(engine, pixmap)))
+
+    engine.closePdf()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+# ---------------------------------------------------------------
+# -- UNote Render Pool File --
+#
+# Rasterizes pdf pages in separate worker processes
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import os
+import queue
+import multiprocessing as mp
+from collections import OrderedDict
+
+import fitz
+
+
+def renderDocInProcess(path, queJob, queResult, workerIdx):
+    '''
+    Worker loop. Each process holds its own fitz document, as MuPDF documents can't be shared between processes.
+    Jobs are tuples of (command, args). The raw samples are sent back, so the gui process only has to wrap them.
+    A worker which can't open the document, e.g. while it's replaced by a save, reports it and stops, see RenderPool.poll
+    '''
+    try:
+        doc = fitz.open(path)
+    except (RuntimeError, OSError, ValueError) as identifier:
+        queResult.put(('failed', workerIdx, str(identifier)))
+        return
+
+    while True:
+        job = queJob.get()
+
+        if job is None:
+            break
+
+        command, args = job
+
+        if command == 'open':
+            doc.close()
+
+            try:
+                doc = fitz.open(args)
+            except (RuntimeError, OSError, ValueError) as identifier:
+                queResult.put(('failed', workerIdx, str(identifier)))
+                return
+
+        elif command == 'render':
+            jobId, key, pageNumber, zoom, clip, alpha, invert = args
+
+            try:
+                page = doc.loadPage(pageNumber)
+                pix = page.getPixmap(matrix=fitz.Matrix(zoom, zoom), clip=fitz.Rect(clip) if clip else None, alpha=alpha)
+
+                if invert:
+                    pix.invertIRect()
+
+                queResult.put(('rendered', workerIdx, jobId, key, zoom, pix.samples, pix.width, pix.height, pix.stride, pix.alpha))
+            except (RuntimeError, ValueError, IndexError) as identifier:
+                # Report back anyway, so the worker is marked as idle again
+                print(str(identifier))
+                queResult.put(('rendered', workerIdx, jobId, key, zoom, None, 0, 0, 0, alpha))
+
+    doc.close()
+
+
+class RenderPool():
+    '''
+    Pool of render processes. Every worker gets at most one job at a time.
+    Pending jobs are kept per key (the page number or e.g. a tile), so a newer request for the same key replaces (cancels) the stale one.
+    Results of jobs which got superseded while rendering are dropped in poll().
+    Workers which stopped are never used again, their running job is handed to another one. Once all of them stopped, the
+    unfinished jobs have to be rendered elsewhere, see isAlive and unfinishedJobs
+    '''
+    MAXWORKERS = 4
+
+    def __init__(self, filename, numWorkers=None):
+        super().__init__()
+
+        if not numWorkers:
+            numWorkers = max(1, min(self.MAXWORKERS, (os.cpu_count() or 2) - 1))
+
+        self.filename = filename
+
+        self.queResult = mp.Queue()
+        self.queJobs = []
+        self.processes = []
+        self.idle = []
+        self.alive = []
+
+        self.nextJobId = 0
+        self.latestJob = dict()     # key: jobId
+        self.pending = OrderedDict() # key: job args
+        self.running = dict()        # jobId: (workerIdx, job args)
+
+        for workerIdx in range(numWorkers):
+            queJob = mp.Queue()
+            process = mp.Process(target=renderDocInProcess, args=(filename, queJob, self.queResult, workerIdx), daemon=True)
+            process.start()
+
+            self.queJobs.append(queJob)
+            self.processes.append(process)
+            self.idle.append(True)
+            self.alive.append(True)
+
+    def terminate(self):
+        for queJob in self.queJobs:
+            queJob.put(None)
+
+        for process in self.processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+
+        self.processes = []
+        self.queJobs = []
+        self.pending.clear()
+        self.running.clear()
+
+    def reload(self, filename):
+        '''
+        Reopens the document in all workers, e.g. after the pdf was saved
+        '''
+        self.filename = filename
+
+        for queJob in self.queJobs:
+            queJob.put(('open', filename))
+
+    def submit(self, pageNumber, zoom, clip=None, alpha=False, invert=False, key=None, urgent=True):
+        '''
+        Queues a render job and returns its id. An older pending job with the same key is cancelled.
+        Urgent jobs are dispatched before all pending jobs, others are appended
+        '''
+        if key is None:
+            key = pageNumber
+
+        jobId = self.nextJobId
+        self.nextJobId += 1
+
+        self.latestJob[key] = jobId
+
+        self.pending.pop(key, None)
+        self.pending[key] = (jobId, key, pageNumber, zoom, clip, alpha, invert)
+
+        if urgent:
+            self.pending.move_to_end(key, last=False)
+
+        self.dispatch()
+
+        return jobId
+
+    def cancel(self, key):
+        self.pending.pop(key, None)
+        self.latestJob.pop(key, None)
+
+    def cancelAll(self):
+        self.pending.clear()
+        self.latestJob.clear()
+
+    def isBusy(self):
+        return len(self.pending) > 0 or len(self.running) > 0
+
+    def isAlive(self):
+        return any(self.alive)
+
+    def unfinishedJobs(self):
+        '''
+        Args of the jobs which are neither done nor superseded, see submit
+        '''
+        return [job for _, job in self.running.values() if self.latestJob.get(job[1]) == job[0]] + list(self.pending.values())
+
+    def workerStopped(self, workerIdx, message):
+        if not self.alive[workerIdx]:
+            return
+
+        print('Render worker ' + str(workerIdx) + ' stopped: ' + message)
+
+        self.alive[workerIdx] = False
+        self.idle[workerIdx] = False
+
+        # Its job is run by another worker
+        for jobId, (runningIdx, job) in list(self.running.items()):
+            if runningIdx != workerIdx:
+                continue
+
+            del self.running[jobId]
+
+            key = job[1]
+            if self.latestJob.get(key) == jobId and key not in self.pending:
+                self.pending[key] = job
+                self.pending.move_to_end(key, last=False)
+
+    def dispatch(self):
+        for workerIdx, idle in enumerate(self.idle):
+            if not self.pending:
+                return
+
+            if idle and self.alive[workerIdx]:
+                _, job = self.pending.popitem(last=False)
+
+                self.idle[workerIdx] = False
+                self.running[job[0]] = (workerIdx, job)
+                self.queJobs[workerIdx].put(('render', job))
+
+    def poll(self):
+        '''
+        Collects all finished jobs. Returns a list of (jobId, key, zoom, samples, width, height, stride, alpha) which are still up to date
+        '''
+        results = []
+
+        while True:
+            try:
+                result = self.queResult.get_nowait()
+            except queue.Empty:
+                break
+
+            if result[0] == 'failed':
+                self.workerStopped(*result[1:])
+                continue
+
+            _, workerIdx, jobId, key, zoom, samples, width, height, stride, alpha = result
+
+            self.idle[workerIdx] = self.alive[workerIdx]
+            self.running.pop(jobId, None)
+
+            # Drop stale results
+            if self.latestJob.get(key) != jobId:
+                continue
+
+            # Failed jobs are done as well, so the key doesn't look busy forever
+            del self.latestJob[key]
+
+            if samples is None:
+                continue
+
+            results.append((jobId, key, zoom, samples, width, height, stride, alpha))
+
+        # Crashed without reporting back
+        for workerIdx, process in enumerate(self.processes):
+            if self.alive[workerIdx] and not process.is_alive():
+                self.workerStopped(workerIdx, 'exit code ' + str(process.exitcode))
+
+        self.dispatch()
+
+        return results
@@ -0,0 +1,147 @@
+# ---------------------------------------------------------------
+# -- UNote Render Scheduler File --
+#
+# Prioritizes page renderings by viewport distance and scrolling
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import time
+import heapq
+from math import exp
+
+from PySide2.QtCore import QObject, QTimer
+
+
+class RenderScheduler(QObject):
+    '''
+    Priority queue of page render jobs. Visible pages come first, followed by the pages in scroll direction.
+    The faster the user scrolls, the more pages ahead are scheduled and the less the pages behind matter.
+    There is at most one job per page, so a newer job (e.g. for another zoom) replaces the old one.
+    '''
+    LOOKAHEAD = 3               # pages beyond the visible ones when not scrolling
+    MAXLOOKAHEAD = 12           # pages
+    VELOCITYSCALE = 2000.0      # px/s which doubles the weight of the scroll direction
+    VELOCITYDECAY = 0.5         # s
+    JOBSPERTICK = 1
+
+    URGENT = -1
+    VISIBLE = 0
+
+    def __init__(self, renderCallback):
+        '''
+        :param renderCallback: Called with (pageNumber, zoom, visible, force) for every job
+        '''
+        super().__init__()
+
+        self.renderCallback = renderCallback
+
+        self.queue = []         # (priority, seq, pageNumber)
+        self.jobs = dict()      # pageNumber: (seq, zoom, visible, force)
+        self.seq = 0
+
+        self.velocity = 0.0
+        self.velocityTime = 0.0
+
+        self.paused = False
+
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.tick)
+
+    def updateVelocity(self, velocity):
+        '''
+        Scroll velocity in px/s. Positive values scroll towards the end of the document
+        '''
+        self.velocity = velocity
+        self.velocityTime = time.time()
+
+    def currentVelocity(self):
+        return self.velocity * exp(-(time.time() - self.velocityTime) / self.VELOCITYDECAY)
+
+    def push(self, pageNumber, priority, zoom, visible=False, force=False):
+        self.seq += 1
+        self.jobs[pageNumber] = (self.seq, zoom, visible, force)
+
+        heapq.heappush(self.queue, (priority, self.seq, pageNumber))
+
+    def schedule(self, firstVisible, lastVisible, pageCount, zoom, needsRender, force=False):
+        '''
+        Replaces all queued jobs by the ones for the current viewport. Forced jobs are kept.
+        needsRender(pageNumber, visible) tells whether a page has to be rendered at all
+        '''
+        forced = [(pageNumber, job) for pageNumber, job in self.jobs.items() if job[3]]
+
+        self.queue = []
+        self.jobs.clear()
+
+        for pageNumber, (_, jobZoom, visible, _) in forced:
+            self.push(pageNumber, self.URGENT, jobZoom, visible, True)
+
+        for pageNumber in range(firstVisible, lastVisible + 1):
+            if force or needsRender(pageNumber, True):
+                self.push(pageNumber, self.VISIBLE, zoom, True, force)
+
+        velocity = self.currentVelocity()
+        weight = 1 + abs(velocity) / self.VELOCITYSCALE
+        lookahead = min(self.MAXLOOKAHEAD, int(self.LOOKAHEAD * weight))
+
+        for distance in range(1, lookahead + 1):
+            for pageNumber, ahead in ((lastVisible + distance, velocity >= 0), (firstVisible - distance, velocity <= 0)):
+                if pageNumber < 0 or pageNumber >= pageCount or pageNumber in self.jobs:
+                    continue
+
+                if not needsRender(pageNumber, False):
+                    continue
+
+                priority = distance / weight if ahead else distance * weight
+
+                self.push(pageNumber, priority, zoom)
+
+        self.start()
+
+    def scheduleUrgent(self, pageNumber, zoom, force=True):
+        '''
+        Single page which has to be updated before anything else, e.g. after drawing
+        '''
+        self.push(pageNumber, self.URGENT, zoom, True, force)
+
+        self.start()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+        self.start()
+
+    def start(self):
+        if self.queue and not self.paused and not self.timer.isActive():
+            self.timer.start(0)
+
+    def clear(self):
+        self.queue = []
+        self.jobs.clear()
+
+    def tick(self):
+        if self.paused:
+            return
+
+        for _ in range(self.JOBSPERTICK):
+            job = None
+
+            # Skip entries of replaced jobs
+            while self.queue and not job:
+                priority, seq, pageNumber = heapq.heappop(self.queue)
+
+                if pageNumber in self.jobs and self.jobs[pageNumber][0] == seq:
+                    job = self.jobs.pop(pageNumber)
+
+            if not job:
+                return
+
+            _, zoom, visible, force = job
+
+            self.renderCallback(pageNumber, zoom, visible, force)
+
+        self.start()
@@ -0,0 +1,276 @@
+# ---------------------------------------------------------------
+# -- UNote Input Replay Test --
+#
+# Replays recorded pointer input through the graphics view on the
+# offscreen platform and reports where the drawing pipeline spends
+# its time
+#
+# Usage: python replayPerfTest.py file.pdf [trace.csv] [speed]
+#
+# Traces are recorded by starting UNote with the environment
+# variable UNOTE_RECORD_INPUT set to the csv file. Without a trace
+# synthetic handwriting is drawn on the first page. speed scales
+# the recorded timing, 0 replays as fast as possible
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+
+from PySide2.QtWidgets import QApplication, QWidget
+from PySide2.QtCore import Qt, QEvent, QPointF
+from PySide2.QtGui import QTabletEvent, QMouseEvent
+
+import core
+from core import GraphicsViewHandler, QPdfView, Renderer
+from liveStroke import LiveStroke
+from pdfEngine import pdfEngine
+from preferences import Preferences
+from editHelper import editModes
+from inputTrace import InputTrace, InputEvent
+from latencyPerfTest import syntheticTrace
+
+
+VIEWWIDTH = 1280
+VIEWHEIGHT = 960
+
+STROKEDURATION = 0.8    # s of pen down per synthetic stroke
+STROKEGAP = 0.15        # s of pen up between synthetic strokes
+
+LOADTIMEOUT = 30        # s
+
+# Mirrors PreferencesGUI.ensureValidData, without pulling in the preferences window
+PREFERENCES = {
+    'radioButtonAffectsPDF': 'True',
+    'comboBoxThemeSelect': 1,
+    'radioButtonUsePenAsDefault': 'True',
+    'radioButtonSmoothLines': 'True',
+    'comboBoxDrawingMode': 0,
+    'radioButtonSaveOnExit': 'False',
+    'comboBoxAutosaveMode': 0,
+    'radioButtonNoInteractionWhileEditing': 'True',
+    'textSize': "('0', '0', '0')",
+    'markerSize': '70',
+    'markerColor': ('0', '0', '0'),
+    'freehandSize': '70',
+    'freehandColor': ('0', '0', '0'),
+    'simplifyTolerance': '0.5',
+    'inkCommitDelay': '1000',
+    'penPrediction': '0',
+    'formSize': '70',
+    'formColor': ('0', '0', '0'),
+}
+
+
+class StageTimer():
+    '''
+    Wraps functions and methods to sum up the time spent in them per stage
+    '''
+
+    def __init__(self):
+        self.times = dict()
+        self.calls = dict()
+
+    def wrap(self, owner, name, stage):
+        function = getattr(owner, name)
+
+        self.times.setdefault(stage, 0.0)
+        self.calls.setdefault(stage, 0)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.times[stage] += time.perf_counter() - start
+                self.calls[stage] += 1
+
+        setattr(owner, name, timed)
+
+    def report(self):
+        for stage in self.times:
+            print('  %-12s %8.1f ms in %5d calls' % (stage, self.times[stage] * 1000, self.calls[stage]))
+
+
+def processEvents(duration=0):
+    '''
+    Runs the event loop, so timers fire and queued repaints are painted
+    '''
+    end = time.perf_counter() + duration
+
+    while True:
+        QApplication.sendPostedEvents()
+        QApplication.processEvents()
+
+        if time.perf_counter() >= end:
+            break
+
+        time.sleep(0.001)
+
+def syntheticInput(view):
+    '''
+    Cuts the synthetic handwriting into strokes and places it on the first page
+    '''
+    origin = view.rendererWorker.pages[0].sceneBoundingRect().topLeft()
+    trace = syntheticTrace()
+
+    events = []
+    penDown = False
+
+    for timestamp, x, y, pressure in trace.tolist():
+        down = timestamp % (STROKEDURATION + STROKEGAP) < STROKEDURATION
+
+        if down:
+            eventType = InputEvent.MOVE if penDown else InputEvent.PRESS
+            events.append(InputEvent(timestamp, InputEvent.TABLET, eventType, origin.x() + x, origin.y() + y, pressure, int(Qt.LeftButton)))
+        elif penDown:
+            events.append(InputEvent(timestamp, InputEvent.TABLET, InputEvent.RELEASE, events[-1].x, events[-1].y, 0.0, 0))
+
+        penDown = down
+
+    if penDown:
+        events.append(InputEvent(events[-1].timestamp, InputEvent.TABLET, InputEvent.RELEASE, events[-1].x, events[-1].y, 0.0, 0))
+
+    return InputTrace(events)
+
+def toViewport(view, event):
+    '''
+    Inverse of GraphicsViewHandler.recordInput
+    '''
+    return (QPointF(event.x, event.y) - view.viewportOrigin()) * view.rendererWorker.absZoomFactor
+
+def dispatch(view, event):
+    localPos = toViewport(view, event)
+    pos = localPos.toPoint()
+    globalPos = QPointF(view.viewport().mapToGlobal(pos)) + (localPos - QPointF(pos))
+
+    if event.source == InputEvent.TABLET:
+        eventType = {InputEvent.PRESS: QEvent.TabletPress, InputEvent.RELEASE: QEvent.TabletRelease}.get(event.type, QEvent.TabletMove)
+        button = Qt.LeftButton if event.type != InputEvent.MOVE else Qt.NoButton
+
+        tabletEvent = QTabletEvent(eventType, localPos, globalPos, QTabletEvent.Stylus, QTabletEvent.Pen, event.pressure,
+                                   0, 0, 0.0, 0.0, 0, Qt.NoModifier, 1, button, Qt.MouseButtons(event.button))
+
+        view.tabletEvent(tabletEvent)
+    else:
+        eventType = {InputEvent.PRESS: QEvent.MouseButtonPress, InputEvent.RELEASE: QEvent.MouseButtonRelease}.get(event.type, QEvent.MouseMove)
+        button = Qt.MouseButton(event.button) if event.type != InputEvent.MOVE else Qt.NoButton
+        buttons = Qt.MouseButtons(event.button) if event.type != InputEvent.RELEASE else Qt.NoButton
+
+        # Through the viewport, so the scene delivers it to the page items
+        QApplication.sendEvent(view.viewport(), QMouseEvent(eventType, localPos, localPos, globalPos, button, buttons, Qt.NoModifier))
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python replayPerfTest.py file.pdf [trace.csv] [speed]')
+        sys.exit(1)
+
+    tracePath = sys.argv[2] if len(sys.argv) > 2 else None
+    speed = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+
+    app = QApplication(sys.argv)
+
+    for key, value in PREFERENCES.items():
+        Preferences.updateKeyValue(key, value)
+
+    # The document is modified, so work on a copy
+    workDir = tempfile.mkdtemp()
+    filename = os.path.join(workDir, os.path.basename(sys.argv[1]))
+    shutil.copy(sys.argv[1], filename)
+
+    window = QWidget()
+    window.resize(VIEWWIDTH, VIEWHEIGHT)
+
+    view = GraphicsViewHandler(window)
+    view.resize(VIEWWIDTH, VIEWHEIGHT)
+    window.show()
+
+    loaded = []
+    view.rendererWorker.pdfRenderFinished.connect(lambda: loaded.append(True))
+
+    pdf = pdfEngine()
+    pdf.openPdf(filename)
+    view.loadPdfInstanceToCurrentView(pdf)
+
+    start = time.perf_counter()
+    while not loaded and time.perf_counter() - start < LOADTIMEOUT:
+        processEvents(0.01)
+
+    if not loaded:
+        print('Timeout while loading ' + filename)
+        sys.exit(1)
+
+    processEvents(0.5)
+
+    view.editModeChangeRequest(editModes.freehand)
+
+    trace = InputTrace.load(tracePath) if tracePath else syntheticInput(view)
+
+    print('%s: %d events, %d strokes, %.1f s' % (tracePath or 'synthetic', len(trace), trace.strokeCount(), trace.duration()))
+
+    timer = StageTimer()
+    timer.wrap(QPdfView, 'paint', 'paint')
+    timer.wrap(LiveStroke, 'update', 'live stroke')
+    timer.wrap(core, 'smoothLine', 'smoothing')
+    timer.wrap(core, 'smoothValues', 'smoothing')
+    timer.wrap(QPdfView, 'simplifyStroke', 'simplify')
+    timer.wrap(QPdfView, 'addInkAnnot', 'addInkAnnot')
+    timer.wrap(Renderer, 'updatePage', 'render')
+
+    latencies = {InputEvent.PRESS: [], InputEvent.MOVE: [], InputEvent.RELEASE: []}
+
+    replayStart = time.perf_counter()
+    firstTimestamp = trace.events[0].timestamp if len(trace) else 0
+
+    for event in trace:
+        # Keep the recorded pace, so the ink commit timer fires like it did while recording
+        if speed > 0:
+            due = replayStart + (event.timestamp - firstTimestamp) / speed
+            processEvents(max(due - time.perf_counter(), 0))
+
+        eventStart = time.perf_counter()
+
+        dispatch(view, event)
+        processEvents()
+
+        latencies[event.type].append(time.perf_counter() - eventStart)
+
+    replayTime = time.perf_counter() - replayStart
+
+    commitStart = time.perf_counter()
+    view.commitPendingInk()
+    processEvents()
+    commitTime = time.perf_counter() - commitStart
+
+    outFilename = os.path.join(workDir, 'replayed.pdf')
+    view.saveCurrentPdfAs(outFilename)
+
+    print('--- replayed within %.2f s, final commit %.1f ms ---' % (replayTime, commitTime * 1000))
+
+    for eventType, times in latencies.items():
+        if not times:
+            continue
+
+        times = np.array(times) * 1000
+        print('  %-8s %5d events: p50 %6.2f ms, p95 %6.2f ms, p99 %6.2f ms, max %6.2f ms' %
+              (eventType, len(times), np.percentile(times, 50), np.percentile(times, 95), np.percentile(times, 99), times.max()))
+
+    print('--- time per stage ---')
+    timer.report()
+
+    print('--- pdf size %.1f kB (input %.1f kB) ---' % (os.path.getsize(outFilename) / 1024, os.path.getsize(sys.argv[1]) / 1024))
+
+    view.terminate()
+    shutil.rmtree(workDir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# ---------------------------------------------------------------
+# -- UNote Save Planner File --
+#
+# Decides between incremental saves and rewriting the whole pdf
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import os
+
+
+class SaveDecision():
+    '''
+    How the pdf is saved and why. Sizes are bytes, times seconds. The outcome is filled in once the save is done
+    '''
+    def __init__(self, mode, reason, fileSize, estimate, appended):
+        self.mode = mode
+        self.reason = reason
+
+        self.fileSize = fileSize
+        self.estimate = estimate        # bytes an incremental save would append
+        self.appended = appended        # bytes appended since the pdf was written as a whole
+
+        self.snapshotTime = 0.0
+        self.saveTime = None
+        self.savedSize = None
+
+    def done(self, saveTime, savedSize):
+        self.saveTime = saveTime
+        self.savedSize = savedSize
+
+    def __str__(self):
+        text = '%-11s %-18s file %.1f MB, estimate %.1f kB, appended %.1f kB' % (self.mode, self.reason, self.fileSize / 1e6, self.estimate / 1e3, self.appended / 1e3)
+
+        if self.saveTime is not None:
+            text += ', saved %.1f MB within %.0f ms (snapshot %.0f ms)' % (self.savedSize / 1e6, self.saveTime * 1000, self.snapshotTime * 1000)
+
+        return text
+
+
+class SavePlanner():
+    '''
+    Incremental saves append the changed objects to the pdf, which is fast but grows the file with every save.
+    The appended size is estimated from the journal records since the last save, scaled by what previous incremental saves actually appended per journal byte.
+    Once the appended revisions exceed COMPACTRATIO of the file, the pdf is compacted by a full save in the background.
+    Incremental saves which fail fall back to a full save and are tried again after the next full save
+    '''
+    INCREMENTAL = 'incremental'
+    FULL = 'full'
+    COMPACT = 'compact'
+
+    COMPACTRATIO = 0.25         # appended bytes per file size
+    MAXREVISIONS = 100          # incremental updates in the file
+    SAVEOVERHEAD = 2048         # bytes of xref and trailer per incremental save
+    BYTESPERRECORD = 4.0        # pdf bytes per journal byte until measured
+    MAXREPORTED = 20
+
+    def __init__(self):
+        super().__init__()
+
+        self.bytesPerRecord = self.BYTESPERRECORD
+
+        # Per document
+        self.appended = 0
+        self.revisions = 0
+        self.failures = 0
+        # Until the next full save
+        self.incrementalFailing = False
+
+        self.decisions = list()
+
+    def reset(self, doc):
+        '''
+        Called once a document is opened. Revisions appended by previous sessions are counted, their size is unknown
+        '''
+        self.appended = 0
+        self.revisions = self.versionCount(doc)
+        self.failures = 0
+        self.incrementalFailing = False
+
+    @staticmethod
+    def versionCount(doc):
+        try:
+            count = getattr(doc, 'versionCount', None)
+
+            if count is None:
+                count = getattr(doc, 'version_count', 1)
+
+            return max(int(count) - 1, 0)
+        except (TypeError, ValueError, RuntimeError):
+            return 0
+
+    @staticmethod
+    def fileSize(filename):
+        try:
+            return os.path.getsize(filename)
+        except (OSError, TypeError):
+            return 0
+
+    def estimate(self, journalBytes):
+        return int(journalBytes * self.bytesPerRecord) + self.SAVEOVERHEAD
+
+    def fragmented(self, fileSize, appended):
+        return self.revisions >= self.MAXREVISIONS or (fileSize > 0 and appended > fileSize * self.COMPACTRATIO)
+
+    def plan(self, pdf, cleanup):
+        '''
+        Returns the decision for saving the pdf. cleanup without changes asks for a full save
+        '''
+        fileSize = self.fileSize(pdf.filename)
+        estimate = self.estimate(pdf.journal.mark())
+
+        if cleanup and pdf.history.recentChanges == 0:
+            mode, reason = self.FULL, 'cleanup'
+        elif not pdf.incremental or self.incrementalFailing:
+            mode, reason = self.FULL, 'not incremental'
+        elif self.fragmented(fileSize + estimate, self.appended + estimate):
+            # The incremental save would be compacted right after
+            mode, reason = self.FULL, 'fragmented'
+        else:
+            mode, reason = self.INCREMENTAL, 'changes'
+
+        return self.record(SaveDecision(mode, reason, fileSize, estimate, self.appended))
+
+    def incrementalFailed(self, decision):
+        self.failures += 1
+        self.incrementalFailing = True
+
+        return self.record(SaveDecision(self.FULL, 'incremental failed', decision.fileSize, decision.estimate, self.appended))
+
+    def incrementalSaved(self, decision, saveTime, savedSize):
+        decision.done(saveTime, savedSize)
+
+        appended = max(savedSize - decision.fileSize, 0)
+
+        # Learn the size of the appended objects per journal byte
+        journalBytes = (decision.estimate - self.SAVEOVERHEAD) / self.bytesPerRecord
+        if journalBytes > 0:
+            self.bytesPerRecord = 0.5 * self.bytesPerRecord + 0.5 * max(appended - self.SAVEOVERHEAD, 0) / journalBytes
+
+        self.appended += appended
+        self.revisions += 1
+
+    def needsCompaction(self, fileSize):
+        '''
+        Checked after an incremental save
+        '''
+        if not self.fragmented(fileSize, self.appended):
+            return None
+
+        return self.record(SaveDecision(self.COMPACT, 'fragmented', fileSize, 0, self.appended))
+
+    def fullSaved(self, decision, saveTime, savedSize):
+        decision.done(saveTime, savedSize)
+
+        self.appended = 0
+        self.revisions = 0
+        self.incrementalFailing = False
+
+    def record(self, decision):
+        self.decisions.append(decision)
+        del self.decisions[:-self.MAXREPORTED]
+
+        print('Save plan: ' + str(decision))
+
+        return decision
+
+    def report(self):
+        if not self.decisions:
+            return 'Save planner: nothing saved'
+
+        lines = ['Save planner: %d decisions, %.1f pdf bytes per journal byte, %d failed incremental saves' % (len(self.decisions), self.bytesPerRecord, self.failures)]
+        lines += ['  ' + str(decision) for decision in self.decisions]
+
+        return '\n'.join(lines)
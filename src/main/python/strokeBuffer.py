@@ -0,0 +1,78 @@
+# ---------------------------------------------------------------
+# -- UNote Stroke Buffer File --
+#
+# Growable sample buffer of a pen or mouse stroke
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import time
+
+import numpy as np
+
+from PySide2.QtCore import QPointF
+
+
+class StrokeBuffer():
+    '''
+    Samples of a stroke in a single float array with the columns x, y, pressure and timestamp.
+    The capacity doubles when it's exhausted, so appending is amortized O(1). The column accessors return views without copying
+    '''
+    X = 0
+    Y = 1
+    PRESSURE = 2
+    TIME = 3
+
+    INITIALCAPACITY = 256   # samples
+
+    def __init__(self, capacity=INITIALCAPACITY):
+        super().__init__()
+
+        self.data = np.empty((capacity, 4), dtype=np.float64)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, x, y, pressure=1.0, timestamp=None):
+        if self.size == len(self.data):
+            self.data = np.concatenate((self.data, np.empty_like(self.data)))
+
+        self.data[self.size] = (x, y, pressure, time.time() if timestamp is None else timestamp)
+        self.size += 1
+
+    def appendQPoint(self, qpos, pressure=1.0, timestamp=None):
+        self.append(qpos.x(), qpos.y(), pressure, timestamp)
+
+    def clear(self):
+        self.size = 0
+
+    @property
+    def xs(self):
+        return self.data[:self.size, self.X]
+
+    @property
+    def ys(self):
+        return self.data[:self.size, self.Y]
+
+    @property
+    def pressures(self):
+        return self.data[:self.size, self.PRESSURE]
+
+    @property
+    def timestamps(self):
+        return self.data[:self.size, self.TIME]
+
+    def qPoint(self, index):
+        return QPointF(self.data[index, self.X], self.data[index, self.Y])
+
+    def firstQPoint(self):
+        return self.qPoint(0)
+
+    def lastQPoint(self):
+        return self.qPoint(self.size - 1)
+
+    def qPoints(self):
+        '''
+        Only meant for short strokes, as this creates an object per sample
+        '''
+        return [QPointF(x, y) for x, y in self.data[:self.size, :2].tolist()]
@@ -0,0 +1,144 @@
+# ---------------------------------------------------------------
+# -- UNote Stroke Performance Test --
+#
+# Compares the former Queue based stroke handling with the
+# numpy stroke buffer for long strokes and reports how much the
+# simplification reduces the saved vertices. Exits with an error
+# if a simplified stroke deviates more than the tolerance
+#
+# Usage: python strokePerfTest.py [points] [runs]
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+import sys
+import time
+from queue import Queue
+from math import sin, cos
+
+import fitz
+from scipy.signal import savgol_filter
+from PySide2.QtCore import QPointF
+
+from filters import smoothLine, transformPoints, tuplesToArrays, savgolParameters, simplifyLine, lineDeviation
+from strokeBuffer import StrokeBuffer
+from liveStroke import LiveStroke
+
+
+def samplePoints(numPoints):
+    '''
+    Handwriting like curve in page coordinates
+    '''
+    return [(100 + it * 0.05 + 8 * sin(it / 7), 300 + 12 * cos(it / 5), 0.5 + 0.4 * sin(it / 50)) for it in range(numPoints)]
+
+
+def queueStroke(samples, matrix):
+    '''
+    Capture and commit as done before: Queue of [QPointF, pressure], converted with python loops
+    '''
+    start = time.perf_counter()
+
+    tempPoints = Queue()
+    for x, y, pressure in samples:
+        tempPoints.put([QPointF(x, y), pressure])
+
+    captureTime = time.perf_counter() - start
+    start = time.perf_counter()
+
+    tempList = list(zip(*list(tempPoints.queue)))
+    xPoints, yPoints = tuplesToArrays(tempList[0])
+    windowLength, polynomGrade = savgolParameters(len(xPoints))
+    xPoints = savgol_filter(xPoints, windowLength, polynomGrade)
+    yPoints = savgol_filter(yPoints, windowLength, polynomGrade)
+
+    pointList = list()
+    for point in zip(xPoints, yPoints):
+        fpt = fitz.Point(point[0], point[1]) * matrix
+        pointList.append([fpt.x, fpt.y])
+
+    return captureTime, time.perf_counter() - start
+
+
+def bufferStroke(samples, matrix):
+    start = time.perf_counter()
+
+    tempPoints = StrokeBuffer()
+    for x, y, pressure in samples:
+        tempPoints.append(x, y, pressure)
+
+    captureTime = time.perf_counter() - start
+    start = time.perf_counter()
+
+    xPoints, yPoints = smoothLine(tempPoints.xs, tempPoints.ys)
+    xPoints, yPoints = transformPoints(xPoints, yPoints, matrix)
+
+    pointList = list(zip(xPoints.tolist(), yPoints.tolist()))
+
+    return captureTime, time.perf_counter() - start
+
+
+def liveStroke(samples):
+    '''
+    Per sample cost of the live rendering while drawing
+    '''
+    tempPoints = StrokeBuffer()
+    stroke = LiveStroke(tempPoints)
+
+    start = time.perf_counter()
+
+    for x, y, pressure in samples:
+        tempPoints.append(x, y, pressure)
+        stroke.update()
+
+    return (time.perf_counter() - start) / len(samples)
+
+
+def simplification(samples, tolerance, zoom):
+    '''
+    Vertex reduction of the smoothed stroke and the largest deviation in screen pixels
+    '''
+    xPoints, yPoints = smoothLine(*zip(*[(x, y) for x, y, _ in samples]))
+
+    start = time.perf_counter()
+    keep = simplifyLine(xPoints, yPoints, tolerance / zoom)
+    duration = time.perf_counter() - start
+
+    return keep.sum() / len(keep), lineDeviation(xPoints, yPoints, keep) * zoom, duration
+
+
+def best(function, runs, *args):
+    results = [function(*args) for _ in range(runs)]
+
+    return [min(values) for values in zip(*results)]
+
+
+def main():
+    numPoints = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    samples = samplePoints(numPoints)
+    matrix = fitz.Matrix(0, 1, -1, 0, 842, 0)
+
+    captureQueue, commitQueue = best(queueStroke, runs, samples, matrix)
+    captureBuffer, commitBuffer = best(bufferStroke, runs, samples, matrix)
+
+    print('--- %d points, best of %d runs ---' % (numPoints, runs))
+    print('Queue:        capture %.2f ms, commit %.2f ms' % (captureQueue * 1000, commitQueue * 1000))
+    print('StrokeBuffer: capture %.2f ms, commit %.2f ms' % (captureBuffer * 1000, commitBuffer * 1000))
+    print('Live stroke:  %.1f us per sample' % (liveStroke(samples) * 1000000))
+
+    failed = False
+
+    for zoom in (1, 2, 4):
+        for tolerance in (0.25, 0.5, 1):
+            ratio, deviation, duration = simplification(samples, tolerance, zoom)
+            failed |= deviation > tolerance
+
+            print('Simplify:     zoom %d, tolerance %.2f px: %.1f%% of the vertices kept, max deviation %.3f px, %.2f ms' %
+                  (zoom, tolerance, ratio * 100, deviation, duration * 1000))
+
+    if failed:
+        sys.exit('Simplified stroke deviates more than the tolerance')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# ---------------------------------------------------------------
+# -- UNote Tile Cache File --
+#
+# LRU cache for rendered page tiles at high zoom levels
+#
+# Author: Melvin Strobl
+# ---------------------------------------------------------------
+from math import log2, floor, ceil
+from collections import OrderedDict
+
+
+class TileCache():
+    '''
+    Stores rendered tiles keyed by (pageNumber, zoomBucket, tx, ty).
+    The least recently used tiles are dropped once the memory budget is exceeded
+    '''
+    TILESIZE = 512                      # px
+    BUCKETSPEROCTAVE = 2                # zoom buckets between two powers of two
+    DEFAULTBUDGET = 256 * 1024 * 1024   # bytes
+
+    def __init__(self, budget=DEFAULTBUDGET):
+        super().__init__()
+
+        self.budget = budget
+        self.size = 0
+        self.tiles = OrderedDict()
+
+    @staticmethod
+    def zoomBucket(zoom):
+        '''
+        Quantizes the zoom, so tiles can be reused for slightly different zoom factors
+        '''
+        return round(log2(zoom) * TileCache.BUCKETSPEROCTAVE)
+
+    @staticmethod
+    def bucketZoom(bucket):
+        return 2 ** (bucket / TileCache.BUCKETSPEROCTAVE)
+
+    @staticmethod
+    def tileRect(tx, ty, zoom):
+        '''
+        Returns the area (x0, y0, x1, y1) in page coordinates covered by the tile
+        '''
+        tileSize = TileCache.TILESIZE / zoom
+
+        return (tx * tileSize, ty * tileSize, (tx + 1) * tileSize, (ty + 1) * tileSize)
+
+    @staticmethod
+    def tilesInRect(x0, y0, x1, y1, zoom):
+        '''
+        Returns all tile indices intersecting the area given in page coordinates
+        '''
+        tileSize = TileCache.TILESIZE / zoom
+
+        return [(tx, ty) for ty in range(max(0, floor(y0 / tileSize)), ceil(y1 / tileSize))
+                         for tx in range(max(0, floor(x0 / tileSize)), ceil(x1 / tileSize))]
+
+    def get(self, key):
+        try:
+            self.tiles.move_to_end(key)
+        except KeyError:
+            return None
+
+        return self.tiles[key]
+
+    def put(self, key, qImg):
+        self.remove(key)
+
+        self.tiles[key] = qImg
+        self.size += qImg.sizeInBytes()
+
+        while self.size > self.budget and len(self.tiles) > 1:
+            _, oldImg = self.tiles.popitem(last=False)
+            self.size -= oldImg.sizeInBytes()
+
+    def remove(self, key):
+        qImg = self.tiles.pop(key, None)
+        if qImg is not None:
+            self.size -= qImg.sizeInBytes()
+
+    def invalidate(self, pageNumber):
+        '''
+        Drops all tiles of a page, e.g. after an annotation was changed
+        '''
+        for key in [key for key in self.tiles if key[0] == pageNumber]:
+            self.remove(key)
+
+    def shiftPages(self, pageNumber, delta):
+        '''
+        Called after a page was inserted (delta 1) or deleted (delta -1) at pageNumber. Tiles of the following pages are moved along
+        '''
+        tiles = OrderedDict()
+
+        for key, qImg in self.tiles.items():
+            if key[0] < pageNumber:
+                tiles[key] = qImg
+            elif delta > 0 or key[0] != pageNumber:
+                tiles[(key[0] + delta,) + key[1:]] = qImg
+            else:
+                self.size -= qImg.sizeInBytes()
+
+        self.tiles = tiles
+
+    def clear(self):
+        self.tiles.clear()
+        self.size = 0
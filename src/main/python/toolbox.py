@@ -11,7 +11,6 @@ import assets
 
 from editHelper import editModes
 from preferences import Preferences
-from historyHandler import History
 
 from style.styledef import rgb, norm_rgb, pdf_annots
 from util import toBool
@@ -57,6 +56,9 @@ class ToolBoxWidget(QWidget):
 
     suggestUpdate = Signal()
 
+    undoRequested = Signal()
+    redoRequested = Signal()
+
     settingsChanged = Signal()
 
     editTextBox = False
@@ -662,11 +664,11 @@ class ToolBoxWidget(QWidget):
             self.currentY = -1
 
     def handleUndoButton(self):
-        History.undo()
+        self.undoRequested.emit()
         self.suggestUpdate.emit()
 
     def handleRedoButton(self):
-        History.redo()
+        self.redoRequested.emit()
         self.suggestUpdate.emit()
 
     def restoreSliderValue(self):
@@ -6,6 +6,7 @@
 # Author: Melvin Strobl
 # ---------------------------------------------------------------
 import os
+import shutil
 import webbrowser
 
 
@@ -15,9 +16,10 @@ from preferences import Preferences
 from guiHelper import GuiHelper, QHLine
 
 from core import GraphicsViewHandler
+from autoSave import AutoSaver
+from annotJournal import AnnotJournal
 
 from util import toBool
-from historyHandler import History
 
 
 class Receivers(QObject):
@@ -37,6 +39,10 @@ class Receivers(QObject):
         self.ui.splitView = None
         self.ui.graphicsView.changesMade.connect(self.changesMadeReceiver)
 
+        # Shown in the title while the document is saved in the background
+        self.saveStatus = ''
+        self.ui.graphicsView.saveProgress.connect(self.saveProgressReceiver)
+
     def terminate(self):
         pass
 
@@ -84,6 +90,7 @@ class Receivers(QObject):
         if pdfFileName == '':
             return
 
+        pdfFileName = self.recoverAutosave(pdfFileName)
 
         self.ui.graphicsView.loadPdfToCurrentView(pdfFileName)
 
@@ -92,11 +99,66 @@ class Receivers(QObject):
         self.updateWindowTitle(pdfFileName)
 
 
+    def recoverAutosave(self, pdfFileName):
+        '''
+        An autosave newer than the document is left from a crash. The user decides whether it's opened as <name>_recovered.pdf,
+        the document itself is left as it is. The journal of the document is more recent than any autosave, so it's replayed instead, see AnnotJournal.open.
+        Returns the filename to open
+        '''
+        autosave = AutoSaver.staleAutosave(pdfFileName)
+
+        if not autosave:
+            return pdfFileName
+
+        if AnnotJournal.pending(pdfFileName):
+            print('Journal of ' + pdfFileName + ' supersedes the autosave')
+            AutoSaver.remove(autosave)
+            return pdfFileName
+
+        if self.guiHelper.confirmDialog("Recover unsaved changes", "UNote was not closed properly. Open the autosaved version of " + os.path.basename(pdfFileName) + " as a copy?"):
+            try:
+                pdfFileName = self.copyRecovered(autosave, pdfFileName)
+            except OSError as identifier:
+                print(str(identifier))
+                return pdfFileName
+
+        AutoSaver.remove(autosave)
+
+        return pdfFileName
+
+    @staticmethod
+    def copyRecovered(autosave, pdfFileName):
+        '''
+        Copies the autosave next to the document, without replacing any existing file
+        '''
+        name, ext = os.path.splitext(pdfFileName)
+        recoveredFileName = name + '_recovered' + ext
+
+        index = 1
+        while True:
+            try:
+                dst = open(recoveredFileName, 'xb')
+            except FileExistsError:
+                index += 1
+                recoveredFileName = name + '_recovered_' + str(index) + ext
+                continue
+
+            try:
+                with open(autosave, 'rb') as src, dst:
+                    shutil.copyfileobj(src, dst)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            except OSError:
+                # No partial copies
+                os.remove(recoveredFileName)
+                raise
+
+            return recoveredFileName
+
     def savePdf(self):
         self.ui.graphicsView.saveCurrentPdf()
 
-        self.updateWindowTitle(self.ui.graphicsView.rendererWorker.pdf.filename, False)
-        History.resetHistoryChanges()
+        self.changesMadeReceiver(self.ui.graphicsView.rendererWorker.pdf.history.recentChanges != 0)
 
 
     def savePdfAs(self, pdfFileName = None):
@@ -109,7 +171,7 @@ class Receivers(QObject):
         self.ui.graphicsView.saveCurrentPdfAs(pdfFileName)
 
         self.updateWindowTitle(pdfFileName, False)
-        History.resetHistoryChanges()
+        self.ui.graphicsView.rendererWorker.pdf.history.resetHistoryChanges()
 
     @Slot(bool)
     def changesMadeReceiver(self, made):
@@ -118,11 +180,20 @@ class Receivers(QObject):
         else:
             self.updateWindowTitle(self.ui.graphicsView.rendererWorker.pdf.filename, False)
 
+    @Slot(int, str)
+    def saveProgressReceiver(self, percent, stage):
+        if percent < 100:
+            self.saveStatus = ' (' + stage + ' ' + str(percent) + '%)'
+        else:
+            self.saveStatus = ''
+
+        self.changesMadeReceiver(self.ui.graphicsView.rendererWorker.pdf.history.recentChanges != 0)
+
     def updateWindowTitle(self, var, isDraft=False):
         if isDraft:
-            self.titleUpdate.emit(var, ' *')
+            self.titleUpdate.emit(var, ' *' + self.saveStatus)
         else:
-            self.titleUpdate.emit(var, '')
+            self.titleUpdate.emit(var, self.saveStatus)
 
     def pageInsertHere(self):
         self.ui.graphicsView.pageInsertHere()
@@ -135,7 +206,7 @@ class Receivers(QObject):
             self.ui.graphicsView.pageDeleteActive()
 
     def pageGoto(self):
-        pageNumber, ok = self.guiHelper.openInputDialog('Goto Page', 'Page Number (<' + str(len(self.ui.graphicsView.rendererWorker.pages)) + '): ', int)
+        pageNumber, ok = self.guiHelper.openInputDialog('Goto Page', 'Page Number (<' + str(self.ui.graphicsView.rendererWorker.layout.pageCount()) + '): ', int)
 
         if ok:
             self.ui.graphicsView.pageGoto(pageNumber)